@@ -0,0 +1,94 @@
+package common
+
+import (
+	"fmt"
+)
+
+// MAX_BATCH_RETRIES cantidad de veces que se reenvia la ventana despues de que
+// el servidor reporta un lote fallido
+const MAX_BATCH_RETRIES = 3
+
+// inflightBatch es un lote enviado cuya confirmacion todavia no llego
+type inflightBatch struct {
+	requestID uint32
+	op        OperationCode
+	payload   []byte
+}
+
+// sendBatchWindowed envia el lote sin esperar su confirmacion mientras haya
+// lugar en la ventana. El request id de la sesion es el numero de secuencia
+// del lote
+func (c *Client) sendBatchWindowed(bets []Bet) error {
+	for len(c.inflight) >= c.config.BatchWindow {
+		if err := c.awaitWindowAck(); err != nil {
+			return err
+		}
+	}
+
+	op, payload := c.encodeBatch(bets)
+	c.nextRequestID++
+	batch := inflightBatch{requestID: c.nextRequestID, op: op, payload: payload}
+	protocol := SimpleProtocol{Compress: c.compression}
+	if err := protocol.SerializeSessionToSocket(c.conn, batch.op, batch.requestID, batch.payload); err != nil {
+		return err
+	}
+	c.inflight = append(c.inflight, batch)
+	return nil
+}
+
+// flushWindow espera la confirmacion de todos los lotes en vuelo
+func (c *Client) flushWindow() error {
+	for len(c.inflight) > 0 {
+		if err := c.awaitWindowAck(); err != nil {
+			return err
+		}
+	}
+	return nil
+}
+
+// awaitWindowAck procesa una respuesta del servidor. Las confirmaciones son
+// acumulativas. Un ERROR confirma los lotes anteriores al fallido; el
+// servidor descarta los siguientes, por lo que se reenvia la ventana desde el
+// lote fallido
+func (c *Client) awaitWindowAck() error {
+	protocol := SimpleProtocol{Compress: c.compression}
+	opCode, requestID, message, err := protocol.DeserializeSessionFromSocket(c.conn)
+	if err != nil {
+		if c.isRunning() {
+			log.Errorf("action: confirmacion_recibida | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		}
+		return err
+	}
+
+	switch opCode {
+	case CONFIRMACION:
+		acked := c.dropInflightBefore(requestID + 1)
+		log.Infof("action: confirmacion_recibida | result: success | client_id: %v | message: %s | lotes: %d", c.config.ID, message, acked)
+		return nil
+	case ERROR:
+		c.dropInflightBefore(requestID)
+		c.batchRetries++
+		if c.batchRetries > MAX_BATCH_RETRIES {
+			return &SerializationError{Msg: fmt.Sprintf("Lote %d rechazado: %s", requestID, message)}
+		}
+		log.Warningf("action: reenvio_lotes | result: in_progress | client_id: %v | desde_lote: %d | error: %s", c.config.ID, requestID, message)
+		for _, batch := range c.inflight {
+			if err := protocol.SerializeSessionToSocket(c.conn, batch.op, batch.requestID, batch.payload); err != nil {
+				return err
+			}
+		}
+		return nil
+	}
+	return &SerializationError{Msg: fmt.Sprintf("Respuesta inesperada a un lote: %s", opCode.String())}
+}
+
+// dropInflightBefore descarta los lotes con request id menor a requestID y
+// retorna cuantos descarto
+func (c *Client) dropInflightBefore(requestID uint32) int {
+	dropped := 0
+	for dropped < len(c.inflight) && c.inflight[dropped].requestID < requestID {
+		dropped++
+	}
+	c.inflight = c.inflight[dropped:]
+	return dropped
+}
@@ -0,0 +1,87 @@
+package common
+
+import (
+	"encoding/binary"
+	"fmt"
+	"math"
+	"strconv"
+	"time"
+)
+
+// Formato binario de un lote de apuestas (BATCH_BINARY), big endian:
+//   - 4 bytes: cantidad de apuestas (N)
+//   - N registros de largo fijo: agencia (uint32), documento (uint32),
+//     fecha de nacimiento en dias desde 1970-01-01 (int32), numero (uint32)
+//   - N pares de nombre y apellido, cada uno con 2 bytes de largo + UTF-8
+//
+// El servidor guarda la agencia y el numero como int32 y rechaza con un
+// ERROR los lotes con valores mayores a 2^31-1 o con fechas de nacimiento
+// fuera del rango de fechas validas.
+const (
+	batchCountSize  = 4
+	fixedRecordSize = 16
+	nameLengthSize  = 2
+	secondsPerDay   = 24 * 60 * 60
+)
+
+// encodeBinaryBatch codifica las apuestas en el formato binario. Retorna error
+// si algun campo no se puede representar (por ejemplo un documento con ceros
+// a la izquierda), en cuyo caso el lote debe enviarse como texto
+func encodeBinaryBatch(bets []Bet) ([]byte, error) {
+	fixed := make([]byte, batchCountSize, batchCountSize+len(bets)*fixedRecordSize)
+	binary.BigEndian.PutUint32(fixed, uint32(len(bets)))
+	names := []byte{}
+
+	record := make([]byte, fixedRecordSize)
+	for _, bet := range bets {
+		agency, err := parseUint32(bet.Agency)
+		if err != nil {
+			return nil, err
+		}
+		document, err := parseUint32(bet.Document)
+		if err != nil {
+			return nil, err
+		}
+		number, err := parseUint32(bet.Number)
+		if err != nil {
+			return nil, err
+		}
+		birthdate, err := time.Parse("2006-01-02", bet.Birthdate)
+		if err != nil {
+			return nil, err
+		}
+		days := birthdate.Unix() / secondsPerDay
+		if birthdate.Unix()%secondsPerDay != 0 || days < math.MinInt32 || days > math.MaxInt32 {
+			return nil, fmt.Errorf("fecha de nacimiento fuera de rango: %s", bet.Birthdate)
+		}
+
+		binary.BigEndian.PutUint32(record[0:4], agency)
+		binary.BigEndian.PutUint32(record[4:8], document)
+		binary.BigEndian.PutUint32(record[8:12], uint32(int32(days)))
+		binary.BigEndian.PutUint32(record[12:16], number)
+		fixed = append(fixed, record...)
+
+		for _, name := range []string{bet.Name, bet.LastName} {
+			if len(name) > math.MaxUint16 {
+				return nil, fmt.Errorf("nombre demasiado largo: %d bytes", len(name))
+			}
+			names = append(names, byte(len(name)>>8), byte(len(name)))
+			names = append(names, name...)
+		}
+	}
+
+	return append(fixed, names...), nil
+}
+
+// parseUint32 solo acepta la representacion decimal canonica, para que el
+// servidor reconstruya exactamente el mismo texto
+func parseUint32(value string) (uint32, error) {
+	parsed, err := strconv.ParseUint(value, 10, 32)
+	if err != nil {
+		return 0, err
+	}
+	if strconv.FormatUint(parsed, 10) != value {
+		return 0, fmt.Errorf("valor no canonico: %s", value)
+	}
+	return uint32(parsed), nil
+}
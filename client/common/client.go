@@ -2,6 +2,7 @@ package common
 
 import (
 	"bufio"
+	"fmt"
 	"net"
 	"os"
 	"os/signal"
@@ -27,6 +28,11 @@ type ClientConfig struct {
 	LoopAmount    int
 	LoopPeriod    time.Duration
 	MaxBatchAmount int
+	BinaryBatch    bool
+	SubscribeWinners bool
+	Session          bool
+	BatchWindow      int
+	Compression      bool
 }
 
 // Client Entity that encapsulates how
@@ -34,6 +40,18 @@ type Client struct {
 	config ClientConfig
 	conn   net.Conn
 	running bool
+	binaryBatch bool
+	subscribeWinners bool
+	// con una sesion todos los mensajes van por la misma conexion con request ids
+	session       bool
+	nextRequestID uint32
+	pendingIDs    []uint32
+	// con ventana de lotes se envian hasta BatchWindow lotes sin esperar confirmacion
+	batchWindow  bool
+	inflight     []inflightBatch
+	batchRetries int
+	// con compresion los lotes se envian comprimidos por la conexion negociada
+	compression bool
 }
 
 // NewClient Initializes a new client receiving the configuration
@@ -87,6 +105,8 @@ func (c *Client) createClientSocket() error {
 		return err
 	}
 	c.conn = conn
+	// la compresion se negocia por conexion
+	c.compression = false
 	return nil
 }
 
@@ -98,7 +118,11 @@ func (c *Client) StartClientLoop() {
 		return
 	}
 
-	err = c.getWinnersFromServer()
+	if c.subscribeWinners {
+		err = c.awaitPushedWinners()
+	} else {
+		err = c.getWinnersFromServer()
+	}
 	if err != nil {
 		c.cleanup()
 		return
@@ -111,15 +135,18 @@ func (c *Client) getWinnersFromServer() error {
 	gotWinners := false
 
 	for !gotWinners && c.isRunning() {
-		err := c.createClientSocket()
-		if err != nil {
-			if c.isRunning() {
-				log.Errorf("action: create_socket | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		// en una sesion se consulta por la misma conexion
+		if !c.session {
+			err := c.createClientSocket()
+			if err != nil {
+				if c.isRunning() {
+					log.Errorf("action: create_socket | result: fail | client_id: %v | error: %v", c.config.ID, err)
+				}
+				return err
 			}
-			return err
 		}
 	
-		err = c.askServerForWinners()
+		err := c.askServerForWinners()
 		if err != nil {
 			return err
 		}
@@ -133,6 +160,7 @@ func (c *Client) getWinnersFromServer() error {
 			gotWinners = true
 			log.Infof("action: ganadores_recibidos | result: success | client_id: %v | winners: %s", c.config.ID, strings.Join(winners, ","))
 		} else {
+			c.endSession()
 			time.Sleep(SLEEP_TIME * time.Second)
 		}
 	}
@@ -141,10 +169,25 @@ func (c *Client) getWinnersFromServer() error {
 }
 
 
+// awaitPushedWinners espera en la misma conexion del SUBSCRIBE a que el
+// servidor envie los ganadores apenas se hace el sorteo
+func (c *Client) awaitPushedWinners() error {
+	winners, err := c.awaitWinners()
+	if err != nil {
+		return err
+	}
+	if winners == nil {
+		// respuesta inesperada, se vuelve a consultar como sin suscripcion
+		return c.getWinnersFromServer()
+	}
+	log.Infof("action: consulta_ganadores | result: success | cant_ganadores: %d", len(winners))
+	log.Infof("action: ganadores_recibidos | result: success | client_id: %v | winners: %s", c.config.ID, strings.Join(winners, ","))
+	return nil
+}
+
 func (c *Client) awaitWinners() ([]string, error) {
 	winners := []string{}
-	protocol := SimpleProtocol{}
-	opCode, message, err := protocol.DeserializeFromSocket(c.conn)
+	opCode, message, err := c.receive()
 	if err != nil {
 		if c.isRunning() {
 			log.Errorf("action: ganadores_recibidos | result: fail | client_id: %v | error: %v", c.config.ID, err)
@@ -165,9 +208,20 @@ func (c *Client) awaitWinners() ([]string, error) {
 }
 
 
+// endSession cierra la sesion despues de una consulta antes del sorteo: el
+// servidor la termina para no retener un worker, y las siguientes consultas
+// van cada una por una conexion nueva
+func (c *Client) endSession() {
+	if !c.session {
+		return
+	}
+	c.conn.Close()
+	c.session = false
+	c.pendingIDs = nil
+}
+
 func (c *Client) askServerForWinners() error {
-	protocol := SimpleProtocol{}
-	err := protocol.SerializeToSocket(c.conn, WINNERS, c.config.ID)
+	err := c.send(WINNERS, []byte(c.config.ID))
 	if err != nil {
 		log.Errorf("action: consulta_ganadores | result: fail | client_id: %v | error: %v", c.config.ID, err)
 		return err
@@ -188,6 +242,18 @@ func (c *Client) sendBetsToServer() error {
 		return err
 	}
 
+	if c.config.BinaryBatch || c.config.SubscribeWinners || c.config.Session || c.config.Compression {
+		accepted, err := c.negotiateCapabilities()
+		if err != nil {
+			return err
+		}
+		c.binaryBatch = c.config.BinaryBatch && accepted[BINARY_BATCH_CAPABILITY]
+		c.subscribeWinners = c.config.SubscribeWinners && accepted[SUBSCRIBE_WINNERS_CAPABILITY]
+		c.session = c.config.Session && accepted[SESSION_CAPABILITY]
+		c.batchWindow = c.session && c.config.BatchWindow > 1 && accepted[BATCH_WINDOW_CAPABILITY]
+		c.compression = c.config.Compression && accepted[COMPRESSION_CAPABILITY]
+	}
+
 	err = c.sendBetsFromFile(BETS_FILE, AWAIT_CONFIRMATION)
 
 	if err != nil {
@@ -201,6 +267,50 @@ func (c *Client) sendBetsToServer() error {
 	return nil
 }
 
+// negotiateCapabilities pregunta al servidor que capacidades del protocolo
+// acepta (lotes binarios, suscripcion a los ganadores, compresion). Si el servidor no
+// entiende el HANDSHAKE cierra la conexion, por lo que se abre una nueva y se
+// sigue sin ninguna
+func (c *Client) negotiateCapabilities() (map[string]bool, error) {
+	requested := []string{}
+	if c.config.BinaryBatch {
+		requested = append(requested, BINARY_BATCH_CAPABILITY)
+	}
+	if c.config.SubscribeWinners {
+		requested = append(requested, SUBSCRIBE_WINNERS_CAPABILITY)
+	}
+	if c.config.Session {
+		requested = append(requested, SESSION_CAPABILITY)
+		if c.config.BatchWindow > 1 {
+			requested = append(requested, BATCH_WINDOW_CAPABILITY)
+		}
+	}
+	if c.config.Compression {
+		requested = append(requested, COMPRESSION_CAPABILITY)
+	}
+
+	protocol := SimpleProtocol{}
+	err := protocol.SerializeToSocket(c.conn, HANDSHAKE, strings.Join(requested, ","))
+	if err == nil {
+		var opCode OperationCode
+		var message string
+		opCode, message, err = protocol.DeserializeFromSocket(c.conn)
+		if err == nil && opCode == HANDSHAKE {
+			accepted := map[string]bool{}
+			for _, capability := range strings.Split(message, ",") {
+				accepted[capability] = true
+			}
+			log.Infof("action: handshake | result: success | client_id: %v | binary_batch: %v | subscribe_winners: %v | session: %v | batch_window: %v | compression: %v",
+				c.config.ID, accepted[BINARY_BATCH_CAPABILITY], accepted[SUBSCRIBE_WINNERS_CAPABILITY], accepted[SESSION_CAPABILITY], accepted[BATCH_WINDOW_CAPABILITY], accepted[COMPRESSION_CAPABILITY])
+			return accepted, nil
+		}
+	}
+
+	log.Infof("action: handshake | result: fail | client_id: %v | binary_batch: false | subscribe_winners: false | session: false | batch_window: false | compression: false", c.config.ID)
+	c.conn.Close()
+	return map[string]bool{}, c.createClientSocket()
+}
+
 func (c *Client) cleanup() {
 	log.Infof("action: client_cleanup | result: in_progress | client_id: %v", c.config.ID)
 	
@@ -214,9 +324,45 @@ func (c *Client) cleanup() {
 }
 
 
-func (c *Client) awaitConfirmation(){
+// send envia un mensaje al servidor. En una sesion le asigna el proximo
+// request id y lo deja pendiente hasta recibir su respuesta
+func (c *Client) send(op OperationCode, payload []byte) error {
+	protocol := SimpleProtocol{Compress: c.compression}
+	if !c.session {
+		return protocol.SerializeBytesToSocket(c.conn, op, payload)
+	}
+	c.nextRequestID++
+	if err := protocol.SerializeSessionToSocket(c.conn, op, c.nextRequestID, payload); err != nil {
+		return err
+	}
+	// READY no tiene respuesta
+	if op != READY {
+		c.pendingIDs = append(c.pendingIDs, c.nextRequestID)
+	}
+	return nil
+}
+
+// receive lee la proxima respuesta del servidor. En una sesion las respuestas
+// llegan en el orden de los pedidos, por lo que se verifica que el request id
+// sea el del pedido pendiente mas antiguo
+func (c *Client) receive() (OperationCode, string, error) {
 	protocol := SimpleProtocol{}
-	opCode, message, err := protocol.DeserializeFromSocket(c.conn)
+	if !c.session {
+		return protocol.DeserializeFromSocket(c.conn)
+	}
+	opCode, requestID, message, err := protocol.DeserializeSessionFromSocket(c.conn)
+	if err != nil {
+		return 0, "", err
+	}
+	if len(c.pendingIDs) == 0 || c.pendingIDs[0] != requestID {
+		return 0, "", &SerializationError{Msg: fmt.Sprintf("Respuesta con request id inesperado: %d", requestID)}
+	}
+	c.pendingIDs = c.pendingIDs[1:]
+	return opCode, message, nil
+}
+
+func (c *Client) awaitConfirmation(){
+	opCode, message, err := c.receive()
 	if err != nil {
 		if c.isRunning() {
 			log.Errorf("action: confirmacion_recibida | result: fail | client_id: %v | error: %v", c.config.ID, err)
@@ -259,35 +405,38 @@ func (c *Client)sendBetsFromFile(filePath string, awaitConfirmation bool) error
 		betsToSend = append(betsToSend, bet)
 
 		if amount++; amount >=  c.config.MaxBatchAmount {
-			if err := sendBetListToSocket(betsToSend, c.conn, BATCH); err != nil {
+			if err := c.uploadBatch(betsToSend, awaitConfirmation); err != nil {
 				// no se toleran fallos del servidor, si se produce uno se debe detener el envío
 				log.Errorf("action: envio_en_lote | result: fail | error: %v", err)
 				return err
 			}
-			if awaitConfirmation {
-				c.awaitConfirmation()
-			}
 			betsToSend = []Bet{}
 			amount = 0
 		}
 	}
 	if len(betsToSend) > 0 {
-		if err := sendBetListToSocket(betsToSend, c.conn, BATCH); err != nil {
+		if err := c.uploadBatch(betsToSend, awaitConfirmation); err != nil {
 			log.Errorf("action: envio_en_lote | result: fail | error: %v", err)
 			return err
 		}
-		if awaitConfirmation {
-			c.awaitConfirmation()
-		}
 	}
 
-	// en caso de no querer esperar todos las confirmaciones, espero solo una, queda del lado del servidor compartir la misma configuracion que la del cliente
-	if !awaitConfirmation {
+	if c.batchWindow {
+		if err := c.flushWindow(); err != nil {
+			log.Errorf("action: envio_en_lote | result: fail | error: %v", err)
+			return err
+		}
+	} else if !awaitConfirmation {
+		// en caso de no querer esperar todos las confirmaciones, espero solo una, queda del lado del servidor compartir la misma configuracion que la del cliente
 		c.awaitConfirmation()
 	}
 
-	protocol := SimpleProtocol{}
-	err = protocol.SerializeToSocket(c.conn, READY, c.config.ID)
+	// con suscripcion la conexion queda abierta hasta que el servidor envie los ganadores
+	readyOp := READY
+	if c.subscribeWinners {
+		readyOp = SUBSCRIBE
+	}
+	err = c.send(readyOp, []byte(c.config.ID))
 	if err != nil {
 		log.Errorf("action: aviso_listo | result: fail | client_id: %v | error: %v", c.config.ID, err)
 		return err
@@ -297,12 +446,38 @@ func (c *Client)sendBetsFromFile(filePath string, awaitConfirmation bool) error
 	return nil
 }
 
-func sendBetListToSocket(bets []Bet, socket net.Conn, op OperationCode) error {
+// uploadBatch envia un lote: con ventana sin esperar su confirmacion, y si no
+// esperando la confirmacion si awaitConfirmation
+func (c *Client) uploadBatch(bets []Bet, awaitConfirmation bool) error {
+	if c.batchWindow {
+		return c.sendBatchWindowed(bets)
+	}
+	if err := c.send(c.encodeBatch(bets)); err != nil {
+		return err
+	}
+	if awaitConfirmation {
+		c.awaitConfirmation()
+	}
+	return nil
+}
+
+// encodeBatch codifica el lote en formato binario si fue negociado, y como
+// texto si no o si alguna apuesta no se puede representar en binario
+func (c *Client) encodeBatch(bets []Bet) (OperationCode, []byte) {
+	if c.binaryBatch {
+		payload, err := encodeBinaryBatch(bets)
+		if err == nil {
+			return BATCH_BINARY, payload
+		}
+		log.Debugf("action: envio_en_lote | result: in_progress | format: text | reason: %v", err)
+	}
+	return BATCH, []byte(betListMessage(bets))
+}
+
+func betListMessage(bets []Bet) string {
 	message := ""
 	for _, bet := range bets {
 		message += bet.getRawBet() + ";"
 	}
-	message = strings.TrimSuffix(message, ";") // Remove the trailing semicolon
-	protocol := SimpleProtocol{}
-	return protocol.SerializeToSocket(socket, op, message)
+	return strings.TrimSuffix(message, ";") // Remove the trailing semicolon
 }
\ No newline at end of file
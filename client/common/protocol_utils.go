@@ -2,6 +2,7 @@ package common
 
 import (
 	"bytes"
+	"compress/zlib"
 	"encoding/binary"
 	"fmt"
 	"io"
@@ -19,8 +20,34 @@ const (
 	WINNERS      OperationCode = 5
 	NOT_READY    OperationCode = 6
 	READY        OperationCode = 7
+	BATCH_BINARY OperationCode = 8
+	HANDSHAKE    OperationCode = 9
+	SUBSCRIBE    OperationCode = 10
+	LOOKUP       OperationCode = 11
 )
 
+// Capacidades que se pueden negociar con HANDSHAKE (separadas por coma)
+const (
+	BINARY_BATCH_CAPABILITY      = "BINARY_BATCH"
+	SUBSCRIBE_WINNERS_CAPABILITY = "SUBSCRIBE_WINNERS"
+	SESSION_CAPABILITY           = "SESSION"
+	BATCH_WINDOW_CAPABILITY      = "BATCH_WINDOW"
+	COMPRESSION_CAPABILITY       = "COMPRESSION"
+)
+
+// Si se negocio COMPRESSION, los mensajes de estas operaciones de al menos
+// CompressionThreshold bytes se envian comprimidos con zlib y con
+// CompressedFlag en el byte del codigo de operacion. Se comprime el payload
+// completo, request id incluido
+const (
+	CompressedFlag       = 0x80
+	CompressionThreshold = 1024
+)
+
+func (op OperationCode) compressible() bool {
+	return op == BATCH || op == BATCH_BINARY || op == WINNERS || op == LOOKUP
+}
+
 func (op OperationCode) String() string {
 	switch op {
 	case APUESTA:
@@ -37,6 +64,14 @@ func (op OperationCode) String() string {
 		return "NOT_READY"
 	case READY:
 		return "READY"
+	case BATCH_BINARY:
+		return "BATCH_BINARY"
+	case HANDSHAKE:
+		return "HANDSHAKE"
+	case SUBSCRIBE:
+		return "SUBSCRIBE"
+	case LOOKUP:
+		return "LOOKUP"
 	default:
 		return fmt.Sprintf("UNKNOWN(%d)", uint8(op))
 	}
@@ -51,11 +86,15 @@ func (e *SerializationError) Error() string {
 	return e.Msg
 }
 
-// SimpleProtocol implementa el protocolo de serialización
-type SimpleProtocol struct{}
+// SimpleProtocol implementa el protocolo de serialización. Compress indica
+// si se negocio COMPRESSION en la conexion
+type SimpleProtocol struct {
+	Compress bool
+}
 
 const (
 	HeaderSize      = 5
+	RequestIDSize   = 4 // request id al inicio de cada mensaje de una sesion
 	MaxMessageSize  = (1 << 32) - 1 // 2^32 - 1
 	DefaultTimeout  = 30 * time.Second
 )
@@ -84,12 +123,29 @@ func (sp *SimpleProtocol) sendAll(conn net.Conn, data []byte) error {
 
 
 func (sp *SimpleProtocol) SerializeToSocket(conn net.Conn, opCode OperationCode, message string) error {
+	// Convertir mensaje a bytes UTF-8
+	return sp.SerializeBytesToSocket(conn, opCode, []byte(message))
+}
+
+// SerializeBytesToSocket envía un mensaje con payload binario
+func (sp *SimpleProtocol) SerializeBytesToSocket(conn net.Conn, opCode OperationCode, messageBytes []byte) error {
 	if conn == nil {
 		return &SerializationError{Msg: "Conexión no puede ser nil"}
 	}
 	
-	// Convertir mensaje a bytes UTF-8
-	messageBytes := []byte(message)
+	rawOpCode := uint8(opCode)
+	if sp.Compress && opCode.compressible() && len(messageBytes) >= CompressionThreshold {
+		compressed, err := deflate(messageBytes)
+		if err != nil {
+			return err
+		}
+		// solo se envia comprimido si se achica
+		if len(compressed) < len(messageBytes) {
+			messageBytes = compressed
+			rawOpCode |= CompressedFlag
+		}
+	}
+
 	messageLength := uint32(len(messageBytes))
 	
 	if messageLength > MaxMessageSize {
@@ -102,7 +158,7 @@ func (sp *SimpleProtocol) SerializeToSocket(conn net.Conn, opCode OperationCode,
 	var header bytes.Buffer
 	
 	// Escribir código de operación (1 byte)
-	if err := binary.Write(&header, binary.BigEndian, uint8(opCode)); err != nil {
+	if err := binary.Write(&header, binary.BigEndian, rawOpCode); err != nil {
 		return &SerializationError{
 			Msg: fmt.Sprintf("Error al escribir código de operación: %v", err),
 		}
@@ -124,6 +180,28 @@ func (sp *SimpleProtocol) SerializeToSocket(conn net.Conn, opCode OperationCode,
 	return sp.sendAll(conn, completeMessage)
 }
 
+// SerializeSessionToSocket envía un mensaje de una sesión: el payload empieza
+// con el request id (4 bytes, big endian)
+func (sp *SimpleProtocol) SerializeSessionToSocket(conn net.Conn, opCode OperationCode, requestID uint32, messageBytes []byte) error {
+	payload := make([]byte, RequestIDSize+len(messageBytes))
+	binary.BigEndian.PutUint32(payload, requestID)
+	copy(payload[RequestIDSize:], messageBytes)
+	return sp.SerializeBytesToSocket(conn, opCode, payload)
+}
+
+// DeserializeSessionFromSocket lee un mensaje de una sesión y separa el request id
+func (sp *SimpleProtocol) DeserializeSessionFromSocket(conn net.Conn) (OperationCode, uint32, string, error) {
+	opCode, message, err := sp.DeserializeFromSocket(conn)
+	if err != nil {
+		return 0, 0, "", err
+	}
+	if len(message) < RequestIDSize {
+		return 0, 0, "", &SerializationError{Msg: "Mensaje de sesión sin request id"}
+	}
+	requestID := binary.BigEndian.Uint32([]byte(message[:RequestIDSize]))
+	return opCode, requestID, message[RequestIDSize:], nil
+}
+
 func (sp *SimpleProtocol) readExact(conn net.Conn, numBytes int) ([]byte, error) {
 	buffer := make([]byte, numBytes)
 	
@@ -171,7 +249,8 @@ func (sp *SimpleProtocol) DeserializeFromSocket(conn net.Conn) (OperationCode, s
 		}
 	}
 	
-	opCode := OperationCode(opCodeRaw)
+	compressed := opCodeRaw&CompressedFlag != 0
+	opCode := OperationCode(opCodeRaw &^ CompressedFlag)
 	
 	// Si no hay mensaje, retornar cadena vacía
 	if messageLength == 0 {
@@ -190,9 +269,45 @@ func (sp *SimpleProtocol) DeserializeFromSocket(conn net.Conn) (OperationCode, s
 	if err != nil {
 		return 0, "", err
 	}
+	if compressed {
+		messageBytes, err = inflate(messageBytes)
+		if err != nil {
+			return 0, "", err
+		}
+	}
 	
 	// Convertir bytes a string UTF-8
 	message := string(messageBytes)
 	
 	return opCode, message, nil
-}
\ No newline at end of file
+}
+
+// deflate comprime un payload con zlib
+func deflate(data []byte) ([]byte, error) {
+	var buffer bytes.Buffer
+	writer, err := zlib.NewWriterLevel(&buffer, zlib.BestSpeed)
+	if err == nil {
+		_, err = writer.Write(data)
+	}
+	if err == nil {
+		err = writer.Close()
+	}
+	if err != nil {
+		return nil, &SerializationError{Msg: fmt.Sprintf("Error al comprimir: %v", err)}
+	}
+	return buffer.Bytes(), nil
+}
+
+// inflate descomprime un payload marcado con CompressedFlag
+func inflate(data []byte) ([]byte, error) {
+	reader, err := zlib.NewReader(bytes.NewReader(data))
+	if err != nil {
+		return nil, &SerializationError{Msg: fmt.Sprintf("Error al descomprimir: %v", err)}
+	}
+	defer reader.Close()
+	inflated, err := io.ReadAll(reader)
+	if err != nil {
+		return nil, &SerializationError{Msg: fmt.Sprintf("Error al descomprimir: %v", err)}
+	}
+	return inflated, nil
+}
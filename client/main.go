@@ -34,10 +34,15 @@ func InitConfig() (*viper.Viper, error) {
 	// Add env variables supported
 	v.BindEnv("id")
 	v.BindEnv("server", "address")
+	v.BindEnv("server", "session")
 	v.BindEnv("loop", "period")
 	v.BindEnv("loop", "amount")
 	v.BindEnv("log", "level")
 	v.BindEnv("batch", "maxAmount")
+	v.BindEnv("batch", "binary")
+	v.BindEnv("batch", "window")
+	v.BindEnv("batch", "compression")
+	v.BindEnv("winners", "subscribe")
 
 	// Try to read configuration from config file. If config file
 	// does not exists then ReadInConfig will fail but configuration
@@ -82,13 +87,18 @@ func InitLogger(logLevel string) error {
 // PrintConfig Print all the configuration parameters of the program.
 // For debugging purposes only
 func PrintConfig(v *viper.Viper) {
-	log.Infof("action: config | result: success | client_id: %s | server_address: %s | loop_amount: %v | loop_period: %v | log_level: %s | max_batch_amount: %d",
+	log.Infof("action: config | result: success | client_id: %s | server_address: %s | loop_amount: %v | loop_period: %v | log_level: %s | max_batch_amount: %d | binary_batch: %v | batch_window: %d | compression: %v | subscribe_winners: %v | session: %v",
 		v.GetString("id"),
 		v.GetString("server.address"),
 		v.GetInt("loop.amount"),
 		v.GetDuration("loop.period"),
 		v.GetString("log.level"),
 		v.GetInt("batch.maxAmount"),
+		v.GetBool("batch.binary"),
+		v.GetInt("batch.window"),
+		v.GetBool("batch.compression"),
+		v.GetBool("winners.subscribe"),
+		v.GetBool("server.session"),
 	)
 }
 
@@ -111,6 +121,11 @@ func main() {
 		LoopAmount:    v.GetInt("loop.amount"),
 		LoopPeriod:    v.GetDuration("loop.period"),
 		MaxBatchAmount: v.GetInt("batch.maxAmount"),
+		BinaryBatch:    v.GetBool("batch.binary"),
+		SubscribeWinners: v.GetBool("winners.subscribe"),
+		Session:          v.GetBool("server.session"),
+		BatchWindow:      v.GetInt("batch.window"),
+		Compression:      v.GetBool("batch.compression"),
 	}
 
 	client := common.NewClient(clientConfig)
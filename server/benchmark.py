@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the lottery server.
+
+Simulates N agencies speaking the real SimpleProtocol against a local
+server: every agency uploads synthetic bets (shaped like the ones in
+.data/dataset.zip) in batches, marks itself ready and waits for the
+winners. Reports bets/sec, batch ack latency percentiles, the time from
+the last READY to the last WINNERS and the peak RSS of the server, and
+saves them as JSON so runs of different server modes can be compared.
+
+Example:
+    python benchmark.py --start-server --server-env SERVER_MODE=asyncio --output asyncio.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import binary_batch
+from common.protocol_uitls import (BATCH_WINDOW_CAPABILITY, BINARY_BATCH_CAPABILITY, COMPRESSION_CAPABILITY, SESSION_CAPABILITY,
+                                   SUBSCRIBE_WINNERS_CAPABILITY, OperationCode, SimpleProtocol)
+from common.utils import Bet
+
+FIRST_NAMES = ("Santiago", "Valentina", "Mateo", "Martina", "Joaquín", "Sofía", "Benjamín", "Catalina", "Tomás", "Lucía")
+LAST_NAMES = ("González", "Rodríguez", "Fernández", "López", "Martínez", "Pérez", "Gómez", "Díaz", "Sosa", "Romero")
+SERVER_START_TIMEOUT = 10
+SERVER_STOP_TIMEOUT = 30
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the lottery server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--agencies", type=int, default=5, help="agencies uploading bets at the same time")
+    parser.add_argument("--bets", type=int, default=20000, help="bets per agency")
+    parser.add_argument("--batch-size", type=int, default=150, help="bets per batch")
+    parser.add_argument("--window", type=int, default=1,
+                        help="batches in flight per agency; above 1 uses a SESSION with BATCH_WINDOW")
+    parser.add_argument("--text", action="store_true", help="send text batches instead of BINARY_BATCH")
+    parser.add_argument("--compress", action="store_true", help="negotiate COMPRESSION and send compressed batches")
+    parser.add_argument("--winners", choices=("subscribe", "poll"), default="subscribe",
+                        help="wait for the winners with SUBSCRIBE or by polling WINNERS")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=7574)
+    parser.add_argument("--start-server", action="store_true",
+                        help="start main.py in a temporary directory and stop it when done")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment of the started server, e.g. SERVER_MODE=processes (repeatable)")
+    parser.add_argument("--server-pid", type=int, help="pid of an already running server, for its peak RSS")
+    parser.add_argument("--output", help="JSON file where the results are saved")
+    return parser.parse_args(argv)
+
+
+def synthetic_bets(agency: int, amount: int, rng: random.Random) -> list:
+    """ Bets with the same shape as the dataset: numeric documents, adult birthdates and numbers up to 9999 """
+    bets = []
+    for _ in range(amount):
+        birthdate = datetime.date(1950, 1, 1) + datetime.timedelta(days=rng.randrange(20000))
+        bets.append(Bet(agency, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                        str(rng.randrange(10000000, 99999999)), birthdate.isoformat(), rng.randrange(10000)))
+    return bets
+
+
+def encode_batch(bets: list, text: bool):
+    if text:
+        return OperationCode.BATCH, ";".join(
+            f"{bet.agency},{bet.first_name},{bet.last_name},{bet.document},{bet.birthdate.isoformat()},{bet.number}"
+            for bet in bets)
+    return OperationCode.BATCH_BINARY, binary_batch.encode_bets(bets)
+
+
+def percentile(values: list, fraction: float) -> float:
+    """ Nearest-rank percentile; 0 if there are no values """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[rank]
+
+
+class AgencyResult:
+    def __init__(self, agency: int):
+        self.agency = agency
+        self.bets = 0
+        self.ack_latencies = []
+        self.ready_at = None
+        self.winners_at = None
+        self.winners = 0
+        self.error = None
+
+
+class Agency:
+    """ One simulated agency: uploads its batches, marks itself ready and waits for the winners """
+    def __init__(self, args, agency: int, batches: list, result: AgencyResult):
+        self._args = args
+        self._agency = agency
+        self._batches = batches
+        self._result = result
+        self._session = args.window > 1
+        self._next_request_id = 0
+
+    def run(self):
+        try:
+            with socket.create_connection((self._args.host, self._args.port)) as sock:
+                self._handshake(sock)
+                if self._session:
+                    self._upload_windowed(sock)
+                else:
+                    self._upload(sock)
+                self._await_winners(sock)
+        except Exception as e:
+            self._result.error = str(e)
+
+    def _send(self, sock, op, message):
+        request_id = None
+        if self._session:
+            self._next_request_id += 1
+            request_id = self._next_request_id
+        SimpleProtocol.serialize_to_socket(sock, op, message, request_id, self._args.compress)
+        return request_id
+
+    def _receive(self, sock):
+        """ Returns (op, request id or None, message) """
+        if self._session:
+            return SimpleProtocol.deserialize_session_from_socket(sock, self._args.compress)
+        op, message = SimpleProtocol.deserialize_from_socket(sock, self._args.compress)
+        return op, None, message
+
+    def _handshake(self, sock):
+        capabilities = [] if self._args.text else [BINARY_BATCH_CAPABILITY]
+        if self._args.winners == "subscribe":
+            capabilities.append(SUBSCRIBE_WINNERS_CAPABILITY)
+        if self._session:
+            capabilities += [SESSION_CAPABILITY, BATCH_WINDOW_CAPABILITY]
+        if self._args.compress:
+            capabilities.append(COMPRESSION_CAPABILITY)
+        # the handshake itself is never part of a session
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.HANDSHAKE, ",".join(capabilities))
+        op, message = SimpleProtocol.deserialize_from_socket(sock)
+        accepted = set(message.split(",")) if message else set()
+        missing = set(capabilities) - accepted
+        if op != OperationCode.HANDSHAKE or missing:
+            raise RuntimeError(f"handshake rejected: {op.name} {sorted(missing)}")
+
+    def _upload(self, sock):
+        for op, payload, amount in self._batches:
+            sent_at = time.monotonic()
+            self._send(sock, op, payload)
+            response, _, message = self._receive(sock)
+            if response != OperationCode.CONFIRMACION:
+                raise RuntimeError(f"batch rejected: {message}")
+            self._result.ack_latencies.append(time.monotonic() - sent_at)
+            self._result.bets += amount
+
+    def _upload_windowed(self, sock):
+        in_flight = {}
+        batches = iter(self._batches)
+        pending = True
+        while pending or in_flight:
+            while pending and len(in_flight) < self._args.window:
+                batch = next(batches, None)
+                if batch is None:
+                    pending = False
+                    break
+                op, payload, amount = batch
+                sent_at = time.monotonic()
+                in_flight[self._send(sock, op, payload)] = (sent_at, amount)
+            if not in_flight:
+                break
+            response, request_id, message = self._receive(sock)
+            if response != OperationCode.CONFIRMACION:
+                raise RuntimeError(f"batch {request_id} rejected: {message}")
+            # the ack is cumulative
+            acked_at = time.monotonic()
+            for acked_id in [i for i in in_flight if i <= request_id]:
+                sent_at, amount = in_flight.pop(acked_id)
+                self._result.ack_latencies.append(acked_at - sent_at)
+                self._result.bets += amount
+
+    def _await_winners(self, sock):
+        agency_id = str(self._agency)
+        if self._args.winners == "subscribe":
+            self._result.ready_at = time.monotonic()
+            self._send(sock, OperationCode.SUBSCRIBE, agency_id)
+            op, _, message = self._receive(sock)
+        else:
+            self._result.ready_at = time.monotonic()
+            self._send(sock, OperationCode.READY, agency_id)
+            op, message = self._poll_winners(sock, agency_id)
+        if op != OperationCode.WINNERS:
+            raise RuntimeError(f"unexpected winners response: {op.name} {message}")
+        self._result.winners_at = time.monotonic()
+        self._result.winners = len(message.split(",")) if message else 0
+
+    def _poll_winners(self, sock, agency_id):
+        session = self._session
+        while True:
+            if session:
+                self._send(sock, OperationCode.WINNERS, agency_id)
+                op, _, message = self._receive(sock)
+                # the server ends the session if the draw is not done yet
+                session = False
+            else:
+                # outside a session READY and WINNERS close the connection
+                with socket.create_connection((self._args.host, self._args.port)) as winners_sock:
+                    SimpleProtocol.serialize_to_socket(winners_sock, OperationCode.WINNERS, agency_id)
+                    op, message = SimpleProtocol.deserialize_from_socket(winners_sock)
+            if op != OperationCode.NOT_READY:
+                return op, message
+            time.sleep(self._args.poll_interval)
+
+
+def prepare_batches(args, agency: int) -> list:
+    rng = random.Random(args.seed + agency)
+    bets = synthetic_bets(agency, args.bets, rng)
+    batches = []
+    for start in range(0, len(bets), args.batch_size):
+        chunk = bets[start:start + args.batch_size]
+        op, payload = encode_batch(chunk, args.text)
+        batches.append((op, payload, len(chunk)))
+    return batches
+
+
+def peak_rss_kb(pid: int):
+    """ Sum of the peak RSS (VmHWM) of the process and its children, None without /proc """
+    try:
+        pids = [pid] + _children(pid)
+        total = 0
+        for process in pids:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        return total
+    except OSError:
+        return None
+
+
+def _children(pid: int) -> list:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # the process name may contain spaces, ppid is the second field after it
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            children.append(int(entry))
+            children.extend(_children(int(entry)))
+    return children
+
+
+class LocalServer:
+    """ main.py running in a temporary directory, so its bets files do not mix with other runs """
+    def __init__(self, args):
+        self._args = args
+        self._directory = tempfile.mkdtemp(prefix="lottery-benchmark-")
+        self._process = None
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    def start(self):
+        server_dir = os.path.dirname(os.path.abspath(__file__))
+        shutil.copy(os.path.join(server_dir, "config.ini"), self._directory)
+        env = dict(os.environ, SERVER_PORT=str(self._args.port), NUMBER_OF_AGENCIES=str(self._args.agencies))
+        env.update(item.split("=", 1) for item in self._args.server_env)
+        env["PYTHONPATH"] = server_dir
+        self._log = open(os.path.join(self._directory, "server.log"), "w")
+        self._process = subprocess.Popen([sys.executable, os.path.join(server_dir, "main.py")],
+                                         cwd=self._directory, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        self._wait_until_listening()
+
+    def _wait_until_listening(self):
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"server exited with code {self._process.returncode}")
+            try:
+                with socket.create_connection((self._args.host, self._args.port), timeout=1) as sock:
+                    # agency 0 does not exist: the server answers NOT_READY without changing its state
+                    SimpleProtocol.serialize_to_socket(sock, OperationCode.WINNERS, "0")
+                    SimpleProtocol.deserialize_from_socket(sock)
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start listening")
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._process.send_signal(signal.SIGTERM)
+        try:
+            self._process.wait(SERVER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._log.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def run(args) -> dict:
+    batches = [prepare_batches(args, agency) for agency in range(1, args.agencies + 1)]
+    results = [AgencyResult(agency) for agency in range(1, args.agencies + 1)]
+    server = LocalServer(args) if args.start_server else None
+    server_pid = args.server_pid
+    try:
+        if server:
+            server.start()
+            server_pid = server.pid
+
+        agencies = [threading.Thread(target=Agency(args, result.agency, agency_batches, result).run)
+                    for result, agency_batches in zip(results, batches)]
+        started_at = time.monotonic()
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join()
+        elapsed = time.monotonic() - started_at
+        rss = peak_rss_kb(server_pid) if server_pid else None
+    finally:
+        if server:
+            server.stop()
+
+    return summarize(args, results, elapsed, rss)
+
+
+def summarize(args, results: list, elapsed: float, rss) -> dict:
+    latencies = [latency for result in results for latency in result.ack_latencies]
+    bets = sum(result.bets for result in results)
+    upload_end = max((result.ready_at for result in results if result.ready_at), default=None)
+    winners_end = max((result.winners_at for result in results if result.winners_at), default=None)
+    errors = {result.agency: result.error for result in results if result.error}
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "bets": bets,
+        "elapsed": elapsed,
+        "bets_per_sec": bets / elapsed if elapsed else 0.0,
+        "batches": len(latencies),
+        "ack_latency_p50": percentile(latencies, 0.50),
+        "ack_latency_p99": percentile(latencies, 0.99),
+        "ack_latency_max": max(latencies, default=0.0),
+        "last_ready_to_winners": (winners_end - upload_end) if upload_end and winners_end and not errors else None,
+        "winners": {result.agency: result.winners for result in results},
+        "server_peak_rss_kb": rss,
+        "errors": errors,
+    }
+
+
+def main():
+    args = parse_args()
+    summary = run(args)
+    print(f"bets: {summary['bets']} | elapsed: {summary['elapsed']:.3f}s | bets/sec: {summary['bets_per_sec']:.0f} | "
+          f"ack p50: {summary['ack_latency_p50'] * 1000:.2f}ms | ack p99: {summary['ack_latency_p99'] * 1000:.2f}ms | "
+          f"last ready to winners: {summary['last_ready_to_winners']} | peak rss: {summary['server_peak_rss_kb']} kB | "
+          f"errors: {len(summary['errors'])}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(summary, output, indent=2)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
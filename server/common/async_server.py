@@ -0,0 +1,334 @@
+import asyncio
+import logging
+import signal
+import socket
+import threading
+from typing import Optional, Union
+
+from common import metrics
+from common.checkpoint import CHECKPOINT_FILEPATH, Checkpointer
+from common.client_handler import (BATCH_OPERATIONS, SESSION_OPERATIONS, BatchWindow, ClientHandler,
+                                   accepted_capabilities, create_bets_writer, ends_session, log_stage_stats, stage_metrics, start_draw,
+                                   store_batch, try_make_draw)
+from common.lottery import Lottery
+from common.protocol_uitls import (BATCH_WINDOW_CAPABILITY, COMPRESSION_CAPABILITY, SESSION_CAPABILITY, ConnectionClosed,
+                                   OperationCode, SerializationError, SimpleProtocol)
+from common.winners_notifier import WinnersNotifier
+
+
+SHUTDOWN_WAIT_TIME = 30
+DEFAULT_GROUP_COMMIT_MAX_BETS = 10000
+DEFAULT_INGESTION_QUEUE_SIZE = 100
+
+class AsyncServer:
+    """
+    Servidor basado en asyncio streams.
+
+    Atiende todas las conexiones desde un unico event loop, por lo que no
+    tiene un limite de hilos por conexion. Las operaciones del ClientHandler
+    que pueden bloquear (escritura de apuestas, locks de la loteria) se
+    ejecutan en el executor por defecto del loop.
+    """
+    def __init__(self, port, listen_backlog, group_commit_window=None, group_commit_max_bets=DEFAULT_GROUP_COMMIT_MAX_BETS,
+                 ingestion_parsers=0, ingestion_queue_size=DEFAULT_INGESTION_QUEUE_SIZE, metrics_port=0,
+                 metrics_host=metrics.DEFAULT_METRICS_HOST, checkpoint_interval=0):
+        """
+        group_commit_window (segundos) habilita la escritura de apuestas con group
+        commit; None las escribe directamente desde el executor.
+        ingestion_parsers > 0 parsea los lotes en un pool de parsers separado de
+        la lectura y de la escritura (ver IngestionPipeline).
+        metrics_port > 0 sirve las metricas del proceso en ese puerto y en la interfaz
+        metrics_host (ver MetricsServer).
+        checkpoint_interval > 0 guarda el estado de la loteria cada esa cantidad de
+        segundos y lo retoma al iniciar (ver Checkpointer)
+        """
+        self._port = port
+        self._listen_backlog = listen_backlog
+
+        self._lottery = Lottery(checkpoint_path=CHECKPOINT_FILEPATH if checkpoint_interval > 0 else None)
+        # retoma el estado y los ganadores de las apuestas guardadas antes de un reinicio
+        self._lottery.recover_winners()
+        self._lottery.restore_checkpoint()
+        self._checkpointer = Checkpointer(self._lottery, checkpoint_interval) if checkpoint_interval > 0 else None
+
+        self._lottery_lock = threading.Lock()
+
+        self._bets_lock = threading.Lock()
+
+        self._bets_writer = create_bets_writer(self._bets_lock, self._lottery, group_commit_window, group_commit_max_bets,
+                                               ingestion_parsers, ingestion_queue_size)
+
+        # agencias que esperan los ganadores con la conexion abierta
+        self._winners_notifier = WinnersNotifier(self._lottery, self._lottery_lock)
+
+        self._metrics_server = metrics.MetricsServer(metrics_port, host=metrics_host) if metrics_port > 0 else None
+
+        self._server = None
+        self._loop = None
+        self._stop_event = None
+        self._started = threading.Event()
+        self._connection_tasks = set()
+        # conexiones que solo esperan los ganadores del sorteo (SUBSCRIBE)
+        self._subscribed_tasks = set()
+
+    def run(self, handle_signals: bool = True):
+        asyncio.run(self._serve(handle_signals))
+
+    def port(self) -> Optional[int]:
+        """ puerto en el que escucha el servidor, una vez iniciado (ver wait_started) """
+        if self._server is None or not self._server.sockets:
+            return None
+        # con el puerto 0 cada familia de direcciones escucha en un puerto distinto
+        sockets = sorted(self._server.sockets, key=lambda sock: sock.family != socket.AF_INET)
+        return sockets[0].getsockname()[1]
+
+    def wait_started(self, timeout: Optional[float] = None) -> bool:
+        return self._started.wait(timeout)
+
+    def stop(self):
+        """ inicia el apagado ordenado desde otro hilo, como SIGTERM """
+        self._loop.call_soon_threadsafe(self._shutdown)
+
+    async def _serve(self, handle_signals: bool = True):
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._stop_event = asyncio.Event()
+        if handle_signals:
+            self._setup_signal_handlers(loop)
+        if self._bets_writer:
+            self._bets_writer.start()
+        self._winners_notifier.start()
+        if self._checkpointer:
+            self._checkpointer.start()
+        if self._metrics_server:
+            if self._bets_writer:
+                metrics.REGISTRY.register_collector(self._collect_metrics)
+            self._metrics_server.start()
+
+        self._server = await asyncio.start_server(
+            self.__handle_client_connection,
+            host='',
+            port=self._port,
+            backlog=self._listen_backlog,
+        )
+        logging.info('action: accept_connections | result: in_progress')
+        self._started.set()
+
+        await self._stop_event.wait()
+        await self._cleanup()
+
+    def _setup_signal_handlers(self, loop):
+        loop.add_signal_handler(signal.SIGTERM, self._signal_handler, signal.SIGTERM)
+        loop.add_signal_handler(signal.SIGINT, self._signal_handler, signal.SIGINT)
+
+    def _signal_handler(self, signum):
+        signal_name = signal.Signals(signum).name
+        logging.info(f'action: shutdown_signal | result: in_progress | signal: {signal_name}')
+        self._shutdown()
+
+    def _shutdown(self):
+        logging.info('action: graceful_shutdown | result: in_progress')
+        if self._server:
+            self._server.close()
+            logging.info('action: close_server_socket | result: success')
+        self._stop_event.set()
+
+    async def _cleanup(self):
+        logging.info('action: server_cleanup | result: in_progress')
+
+        await self._server.wait_closed()
+
+        logging.info('action: waiting_for_connections | result: in_progress')
+        deadline = asyncio.get_running_loop().time() + SHUTDOWN_WAIT_TIME
+        # las conexiones que siguen activas pueden completar el sorteo (el ultimo
+        # READY): el notifier se detiene recien cuando solo quedan suscriptos
+        await self._wait_connections(lambda: self._connection_tasks - self._subscribed_tasks, deadline)
+        # el sorteo puede estar haciendose en otro hilo: se espera su lock y se
+        # notifica aca, por si ese hilo todavia no notifico a los suscriptos
+        await asyncio.to_thread(try_make_draw, self._lottery, logging, self._lottery_lock)
+        self._winners_notifier.notify()
+        # las suscripciones que siguen pendientes terminan sin respuesta
+        self._winners_notifier.stop()
+        pending = await self._wait_connections(lambda: self._connection_tasks, deadline)
+        if pending:
+            logging.warning(f'action: connection_cleanup | result: timeout | remaining_connections: {len(pending)}')
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if self._bets_writer:
+            await asyncio.to_thread(self._bets_writer.stop, SHUTDOWN_WAIT_TIME)
+            log_stage_stats(logging, self._bets_writer)
+
+        if self._checkpointer:
+            # con los lotes pendientes ya guardados
+            await asyncio.to_thread(self._checkpointer.stop)
+
+        if self._metrics_server:
+            self._metrics_server.stop()
+            metrics.REGISTRY.unregister_collector(self._collect_metrics)
+
+        logging.info('action: exit | result: success')
+
+    async def _wait_connections(self, active, deadline: float) -> set:
+        """
+        Espera hasta que active() no tenga tareas o hasta deadline. Retorna
+        las tareas que siguen activas
+        """
+        loop = asyncio.get_running_loop()
+        tasks = active()
+        while tasks and loop.time() < deadline:
+            await asyncio.wait(tasks, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+            tasks = active()
+        return tasks
+
+    def _collect_metrics(self) -> list:
+        return stage_metrics(self._bets_writer)
+
+    async def _read_message(self, reader: asyncio.StreamReader, session: bool = False, allow_compressed: bool = False):
+        """
+        Lee un mensaje completo con el mismo framing que SimpleProtocol.
+        En una sesion retorna tambien el request id (None fuera de una sesion).
+        Un mensaje comprimido solo se acepta si allow_compressed (se negocio COMPRESSION)
+        """
+        try:
+            header = await reader.readexactly(SimpleProtocol.HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                raise ConnectionClosed("Conexión cerrada por el peer")
+            raise
+        op_code, message_length, compressed = SimpleProtocol.decode_header(header)
+        if compressed and not allow_compressed:
+            raise SerializationError("Mensaje comprimido sin haber negociado COMPRESSION")
+        message_bytes = await reader.readexactly(message_length)
+        metrics.record_frame('in', op_code, SimpleProtocol.HEADER_SIZE + message_length)
+        if compressed:
+            message_bytes = SimpleProtocol.inflate(message_bytes)
+        if session:
+            return (op_code, *SimpleProtocol.decode_session_message(op_code, message_bytes))
+        return op_code, None, SimpleProtocol.decode_message(op_code, message_bytes)
+
+    async def _send_message(self, writer: asyncio.StreamWriter, op_code: OperationCode, message: Union[str, bytes], request_id: Optional[int] = None, compress: bool = False):
+        header, message_bytes = SimpleProtocol.encode_frame_parts(op_code, message, request_id, compress)
+        writer.writelines((header, message_bytes))
+        await writer.drain()
+        metrics.record_frame('out', op_code, len(header) + len(message_bytes))
+
+    async def __handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Atiende los mensajes de un cliente hasta que la sesion termina y
+        cierra la conexion. Tiene la misma semantica que ClientHandler.handle_client
+        """
+        task = asyncio.current_task()
+        self._connection_tasks.add(task)
+        metrics.ACTIVE_CONNECTIONS.inc()
+        try:
+            await self._handle_session(reader, writer)
+            start_draw(self._lottery, logging, self._lottery_lock, self._winners_notifier)
+        except Exception as e:
+            logging.error(f'action: handle_client | result: fail | error: {e}')
+        finally:
+            metrics.ACTIVE_CONNECTIONS.dec()
+            self._connection_tasks.discard(task)
+
+    async def _handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ip = writer.get_extra_info('peername')[0]
+        logging.info('action: accept_connections | result: success | ip: %s', ip)
+        session = False
+        compress = False
+        window = None
+        request_id = None
+        try:
+            while True:
+                try:
+                    op, request_id, message = await self._read_message(reader, session, compress)
+                except ConnectionClosed:
+                    if not session:
+                        raise
+                    # el cliente termino la sesion
+                    break
+
+                if window is not None:
+                    if op in BATCH_OPERATIONS:
+                        await self._handle_windowed_batch(writer, window, op, request_id, message, ip)
+                        continue
+                    ack = window.take_ack()
+                    if ack is not None:
+                        await self._send_message(writer, *ack)
+
+                response = await asyncio.to_thread(
+                    ClientHandler.handle_operation,
+                    op, message, ip, logging, self._lottery, self._lottery_lock, self._bets_lock, self._bets_writer,
+                )
+                if response is not None:
+                    await self._send_message(writer, *response, request_id, compress)
+
+                if ends_session(op, response):
+                    break
+
+                if op == OperationCode.SUBSCRIBE:
+                    await self._await_winners(writer, int(message), request_id, compress)
+                    break
+
+                if op == OperationCode.HANDSHAKE:
+                    accepted = accepted_capabilities(message)
+                    session = SESSION_CAPABILITY in accepted
+                    compress = COMPRESSION_CAPABILITY in accepted
+                    if BATCH_WINDOW_CAPABILITY in accepted:
+                        window = BatchWindow()
+                elif session and op == OperationCode.READY:
+                    # la sesion sigue abierta, el sorteo no puede esperar a que se cierre
+                    start_draw(self._lottery, logging, self._lottery_lock, self._winners_notifier)
+
+                # solo los lotes y el handshake mantienen la conexion abierta a la espera de mas mensajes
+                if not session and op not in SESSION_OPERATIONS:
+                    break
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            try:
+                await self._send_message(writer, OperationCode.ERROR, str(e), request_id)
+            except Exception as send_error:
+                logging.error(f'action: send_response | result: fail | error: {send_error}')
+            logging.error(f'action: receive_message | result: fail | error: {e}')
+        finally:
+            writer.close()
+
+    async def _handle_windowed_batch(self, writer: asyncio.StreamWriter, window: BatchWindow, op, request_id, message, ip):
+        """
+        Guarda un lote de una sesion con ventana (ver BatchWindow). Sin acceso
+        al buffer del StreamReader, cada lote guardado se confirma en el momento
+        """
+        if not window.accepts(request_id):
+            return
+        result = await asyncio.to_thread(
+            store_batch, op, message, ip, logging, self._bets_lock, self._lottery, self._bets_writer,
+        )
+        reply = window.record(request_id, *result) or window.take_ack()
+        await self._send_message(writer, *reply)
+
+    async def _await_winners(self, writer: asyncio.StreamWriter, agency_id: int, request_id: Optional[int] = None, compress: bool = False):
+        """
+        Espera el sorteo sin ocupar un hilo: el notifier resuelve el future
+        con los ganadores, o con None si el servidor se apaga antes
+        """
+        loop = asyncio.get_running_loop()
+        winners = loop.create_future()
+        task = asyncio.current_task()
+
+        def resolve(payload):
+            loop.call_soon_threadsafe(lambda: winners.done() or winners.set_result(payload))
+
+        self._winners_notifier.subscribe(agency_id, resolve, lambda: resolve(None))
+        # esta agencia puede ser la ultima en estar lista
+        start_draw(self._lottery, logging, self._lottery_lock, self._winners_notifier)
+
+        self._subscribed_tasks.add(task)
+        try:
+            payload = await winners
+        finally:
+            self._subscribed_tasks.discard(task)
+        if payload is not None:
+            await self._send_message(writer, OperationCode.WINNERS, payload, request_id, compress)
+            logging.info('action: enviar_ganadores | result: success | agency_id: %d', agency_id)
@@ -0,0 +1,87 @@
+import datetime
+import struct
+
+from common.utils import EPOCH_ORDINAL, Bet, BetBatch, days_from_date
+
+
+"""
+Formato binario de un lote de apuestas (OperationCode.BATCH_BINARY), big endian:
+- 4 bytes: cantidad de apuestas (N)
+- N registros de largo fijo: agencia (uint32), documento (uint32),
+  fecha de nacimiento en dias desde 1970-01-01 (int32), numero (uint32)
+- N pares de nombre y apellido, cada uno con 2 bytes de largo + UTF-8
+La agencia y el numero se guardan como int32 (ver BetBatch): un lote con
+valores mayores a MAX_STORED_VALUE se rechaza, igual que uno con una fecha de
+nacimiento que no es una fecha valida (fuera de MIN_BIRTHDATE..MAX_BIRTHDATE).
+"""
+BATCH_COUNT = struct.Struct('>I')
+FIXED_RECORD = struct.Struct('>IIiI')
+NAME_LENGTH = struct.Struct('>H')
+MAX_STORED_VALUE = 2 ** 31 - 1
+MIN_BIRTHDATE = 1 - EPOCH_ORDINAL
+MAX_BIRTHDATE = datetime.date.max.toordinal() - EPOCH_ORDINAL
+
+
+def encode_bets(bets: list[Bet]) -> bytes:
+    """
+    Codifica las apuestas en el formato binario.
+    Los documentos deben ser numeros decimales sin ceros a la izquierda.
+    """
+    fixed = bytearray(BATCH_COUNT.pack(len(bets)))
+    names = bytearray()
+    for bet in bets:
+        fixed += FIXED_RECORD.pack(bet.agency, int(bet.document),
+                                   days_from_date(bet.birthdate), bet.number)
+        for name in (bet.first_name, bet.last_name):
+            encoded = name.encode('utf-8')
+            names += NAME_LENGTH.pack(len(encoded))
+            names += encoded
+    return bytes(fixed + names)
+
+
+def decode_bets(payload) -> list[Bet]:
+    """
+    Decodifica un lote binario a una lista de Bet.
+    Lanza ValueError si el lote esta mal formado.
+    """
+    return list(decode_bet_batch(payload))
+
+
+def decode_bet_batch(payload) -> BetBatch:
+    """
+    Decodifica un lote binario directamente sobre el buffer recibido a un
+    BetBatch, sin pasar por la representacion en texto de los campos numericos
+    ni crear un Bet por apuesta.
+    Lanza ValueError si el lote esta mal formado.
+    """
+    view = memoryview(payload)
+    try:
+        (count,) = BATCH_COUNT.unpack_from(view, 0)
+        fixed_end = BATCH_COUNT.size + count * FIXED_RECORD.size
+        if len(view) < fixed_end:
+            raise ValueError(f"Lote binario truncado: se esperaban {count} apuestas")
+
+        bets = BetBatch()
+        offset = fixed_end
+        for agency, document, birthdate, number in FIXED_RECORD.iter_unpack(view[BATCH_COUNT.size:fixed_end]):
+            if agency > MAX_STORED_VALUE or number > MAX_STORED_VALUE:
+                raise ValueError(f"Lote binario invalido: agencia {agency} o numero {number} fuera de rango")
+            if not MIN_BIRTHDATE <= birthdate <= MAX_BIRTHDATE:
+                raise ValueError(f"Lote binario invalido: fecha de nacimiento {birthdate} fuera de rango")
+            first_name, offset = _read_name(view, offset)
+            last_name, offset = _read_name(view, offset)
+            bets.append(agency, first_name, last_name, str(document), birthdate, number)
+    except struct.error as e:
+        raise ValueError(f"Lote binario invalido: {e}")
+
+    if offset != len(view):
+        raise ValueError("Lote binario invalido: sobran bytes al final")
+    return bets
+
+
+def _read_name(view: memoryview, offset: int):
+    (length,) = NAME_LENGTH.unpack_from(view, offset)
+    offset += NAME_LENGTH.size
+    if offset + length > len(view):
+        raise ValueError("Lote binario truncado en los nombres")
+    return str(view[offset:offset + length], 'utf-8'), offset + length
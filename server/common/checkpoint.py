@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+from common import draw_engine, utils
+
+
+""" Checkpoint del estado de la loteria, junto al almacenamiento de apuestas """
+CHECKPOINT_FILEPATH = "./lottery.ckpt"
+CHECKPOINT_VERSION = 1
+""" Ganadores del sorteo que el proceso que lo hizo deja para los demas (modo processes) """
+SHARED_WINNERS_FILEPATH = "./lottery.winners"
+
+
+class LotteryCheckpoint:
+    """
+    Estado de la loteria hasta una posicion del almacenamiento: las agencias
+    listas, si el sorteo ya se hizo y los ganadores de todas las apuestas
+    guardadas antes de esa posicion (ver utils.storage_position)
+    """
+    def __init__(self, layout: str, position, rule: str, agencies: list, draw_done: bool, winners: dict):
+        self.layout = layout
+        self.position = position
+        self.rule = rule
+        self.agencies = agencies
+        self.draw_done = draw_done
+        self.winners = winners
+
+    def to_json(self) -> dict:
+        return {
+            "version": CHECKPOINT_VERSION,
+            "layout": self.layout,
+            "position": self.position,
+            "rule": self.rule,
+            "agencies": self.agencies,
+            "draw_done": self.draw_done,
+            "winners": winner_rows(self.winners),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'LotteryCheckpoint':
+        return cls(data["layout"], data["position"], data["rule"], data["agencies"], data["draw_done"],
+                   winners_from_rows(data["winners"]))
+
+
+def winner_rows(winners: dict) -> list:
+    # los Bet ganadores se guardan con sus campos ya parseados
+    return [[bet.agency, bet.first_name, bet.last_name, bet.document, utils.days_from_date(bet.birthdate), bet.number]
+            for bets in winners.values() for bet in bets]
+
+
+def winners_from_rows(rows: list) -> dict:
+    winners = {}
+    for agency, first_name, last_name, document, birthdate, number in rows:
+        bet = utils.Bet.from_values(agency, first_name, last_name, document, utils.date_from_days(birthdate), number)
+        winners.setdefault(agency, []).append(bet)
+    return winners
+
+
+def save_checkpoint(path: str, checkpoint: LotteryCheckpoint) -> None:
+    """
+    Reemplaza el checkpoint de forma atomica: se escribe en un archivo
+    temporal que se renombra una vez en disco, por lo que un crash deja el
+    checkpoint anterior o el nuevo, nunca uno a medias
+    """
+    _write_json(path, checkpoint.to_json())
+
+
+def save_winners(path: str, winners: dict) -> None:
+    """ Guarda de forma atomica los ganadores de un sorteo (ver save_checkpoint) """
+    _write_json(path, {"version": CHECKPOINT_VERSION, "winners": winner_rows(winners)})
+
+
+def load_winners(path: str) -> Optional[dict]:
+    """ Ganadores guardados con save_winners, o None si no hay o no son validos """
+    try:
+        with open(path) as file:
+            data = json.load(file)
+        if data.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"version de ganadores desconocida: {data.get('version')}")
+        return winners_from_rows(data["winners"])
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning(f'action: load_winners | result: fail | error: {e}')
+        return None
+
+
+def _write_json(path: str, data: dict) -> None:
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def load_checkpoint(path: str, rule: draw_engine.DrawRule, agencies: int) -> Optional[LotteryCheckpoint]:
+    """
+    Lee el checkpoint si existe y sigue valiendo para el almacenamiento y la
+    configuracion actuales; si no, retorna None y hay que recorrer todas las
+    apuestas
+    """
+    try:
+        with open(path) as file:
+            data = json.load(file)
+        if data.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"version de checkpoint desconocida: {data.get('version')}")
+        checkpoint = LotteryCheckpoint.from_json(data)
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning(f'action: load_checkpoint | result: fail | error: {e}')
+        return None
+
+    layout, position = utils.storage_position()
+    if checkpoint.layout != layout or checkpoint.rule != str(rule) or len(checkpoint.agencies) != agencies:
+        logging.warning('action: load_checkpoint | result: fail | error: el checkpoint es de otra configuracion')
+        return None
+    if not utils.position_precedes(checkpoint.position, position):
+        logging.warning('action: load_checkpoint | result: fail | error: el almacenamiento no llega al checkpoint')
+        return None
+    return checkpoint
+
+
+def replay_winners(checkpoint: Optional[LotteryCheckpoint], rule: draw_engine.DrawRule, workers: int = 1) -> dict:
+    """
+    Ganadores de todas las apuestas guardadas: los del checkpoint mas los de
+    las apuestas guardadas despues de su posicion. Sin checkpoint se recorren
+    todas las apuestas
+    """
+    if checkpoint is None:
+        return draw_engine.draw_from_storage(rule, workers)
+    winners = {agency: list(bets) for agency, bets in checkpoint.winners.items()}
+    _, position = utils.storage_position()
+    for batch in utils.load_bet_batches_between(checkpoint.position, position):
+        draw_engine.add_winners(winners, batch, rule)
+    return winners
+
+
+class Checkpointer:
+    """
+    Guarda cada interval segundos un checkpoint del estado de la loteria, y
+    uno ultimo al detenerse.
+
+    Los ganadores del checkpoint no se toman de la loteria sino que se
+    calculan desde el almacenamiento, recorriendo solo las apuestas guardadas
+    desde el checkpoint anterior: asi corresponden exactamente a la posicion
+    guardada aunque haya lotes escribiendose o registrandose mientras tanto.
+    Sin un checkpoint previo, el primero recorre todas las apuestas
+    """
+    def __init__(self, lottery, interval: float, path: str = CHECKPOINT_FILEPATH):
+        self._lottery = lottery
+        self._interval = interval
+        self._path = path
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._position = None
+        self._winners = {}
+        self._saved_state = None
+
+    def start(self):
+        checkpoint = load_checkpoint(self._path, self._lottery.rule(), len(self._lottery.agencies()))
+        if checkpoint is not None:
+            self._position = checkpoint.position
+            self._winners = checkpoint.winners
+            self._saved_state = (checkpoint.position, checkpoint.agencies, checkpoint.draw_done)
+        self._thread = threading.Thread(target=self._run, name="lottery-checkpoint", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.write()
+        except Exception as e:
+            logging.error(f'action: checkpoint | result: fail | error: {e}')
+
+    def write(self) -> bool:
+        """ Guarda un checkpoint si el estado cambio desde el ultimo; retorna si lo guardo """
+        # el estado del sorteo se toma antes que la posicion: si el sorteo ya
+        # se hizo, todas las apuestas quedan cubiertas por el checkpoint
+        agencies = [bool(ready) for ready in self._lottery.agencies()]
+        draw_done = self._lottery.draw_done()
+        layout, position = utils.storage_position()
+        state = (position, agencies, draw_done)
+        if state == self._saved_state:
+            return False
+
+        rule = self._lottery.rule()
+        for batch in utils.load_bet_batches_between(self._position, position):
+            draw_engine.add_winners(self._winners, batch, rule)
+        self._position = position
+
+        save_checkpoint(self._path, LotteryCheckpoint(layout, position, str(rule), agencies, draw_done, self._winners))
+        self._saved_state = state
+        logging.debug(f'action: checkpoint | result: success | position: {position}')
+        return True
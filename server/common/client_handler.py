@@ -1,10 +1,17 @@
+import datetime
 import socket
 import threading
+import time
+from typing import Optional, Tuple, Union
 
-from common import utils
-from common.protocol_uitls import OperationCode, SimpleProtocol
-from common.utils import Bet
+from common import binary_batch, metrics, utils
+from common.protocol_uitls import (BATCH_WINDOW_CAPABILITY, BINARY_BATCH_CAPABILITY, COMPRESSION_CAPABILITY, SESSION_CAPABILITY,
+                                   SUBSCRIBE_WINNERS_CAPABILITY, ConnectionClosed, OperationCode, SimpleProtocol)
+from common.utils import BetBatch, days_from_date
+from common.group_commit import GroupCommitWriter
+from common.ingestion_pipeline import IngestionPipeline
 from common.lottery import Lottery
+from common.winners_notifier import WinnersNotifier
 
 AGENCY = 0
 NAME = 1
@@ -15,61 +22,258 @@ NUMBER = 5
 
 FIELDS_NUM = 6
 
+""" Capacidades del protocolo que el servidor acepta en el HANDSHAKE """
+SUPPORTED_CAPABILITIES = frozenset({BINARY_BATCH_CAPABILITY, SUBSCRIBE_WINNERS_CAPABILITY, SESSION_CAPABILITY, BATCH_WINDOW_CAPABILITY,
+                                    COMPRESSION_CAPABILITY})
+
+"""
+Operaciones despues de las cuales la conexion sigue abierta. Si se negocio
+SESSION la conexion sigue abierta despues de cualquier operacion, hasta que el
+cliente la cierra (o hasta un SUBSCRIBE, cuya respuesta es lo ultimo que se envia,
+o una consulta de ganadores antes del sorteo, ver ends_session)
+"""
+SESSION_OPERATIONS = frozenset({OperationCode.BATCH, OperationCode.BATCH_BINARY, OperationCode.HANDSHAKE})
+
+"""
+Tiempo maximo sin recibir nada de una conexion (segundos) antes de cerrarla,
+para que una agencia inactiva no retenga un worker del pool
+"""
+DEFAULT_IDLE_TIMEOUT = 30
+
+""" Ventana de group commit del pipeline de ingesta si no se configura otra (segundos) """
+DEFAULT_GROUP_COMMIT_WINDOW = 0.002
+
+""" Operaciones de lotes de apuestas """
+BATCH_OPERATIONS = frozenset({OperationCode.BATCH, OperationCode.BATCH_BINARY})
+
+""" Mensaje de la CONFIRMACION de un lote """
+CONFIRMATION_MESSAGE = "Apuestas recibidas"
+""" Campo de la CONFIRMACION con las apuestas descartadas por duplicadas """
+DUPLICATES_FIELD = "duplicadas: "
+
+
+def ends_session(op: OperationCode, response: Optional[Tuple[OperationCode, str]]) -> bool:
+    """
+    una consulta de ganadores antes del sorteo termina la sesion: la agencia
+    vuelve a consultar con una conexion nueva en lugar de retener un worker
+    hasta que el resto de las agencias termine
+    """
+    return op == OperationCode.WINNERS and response is not None and response[0] == OperationCode.NOT_READY
+
+
+def confirmation_message(duplicates: Optional[int] = None) -> str:
+    """ con la deduplicacion habilitada la confirmacion informa las apuestas descartadas """
+    if duplicates is None:
+        return CONFIRMATION_MESSAGE
+    return f"{CONFIRMATION_MESSAGE}, {DUPLICATES_FIELD}{duplicates}"
+
+
+class BatchWindow:
+    """
+    Control de flujo de los lotes de una sesion (capacidad BATCH_WINDOW).
+
+    El cliente envia varios lotes sin esperar cada confirmacion, usando el
+    request id como numero de secuencia. La CONFIRMACION con request id k
+    es acumulativa: confirma k y todos los lotes anteriores. Si el lote k
+    falla se responde ERROR con request id k (los anteriores quedan
+    confirmados) y los lotes que ya estaban en vuelo detras de el se
+    descartan sin respuesta hasta que el cliente reenvia k (go-back-N).
+    Con deduplicacion, el ack informa las apuestas descartadas de todos los
+    lotes que confirma.
+    """
+    def __init__(self):
+        self._failed_id = None
+        self._unacked_id = None
+        self._duplicates = None
+
+    def accepts(self, request_id: int) -> bool:
+        if self._failed_id is not None:
+            if request_id != self._failed_id:
+                return False
+            self._failed_id = None
+        return True
+
+    def record(self, request_id: int, err: Optional[Exception], duplicates: Optional[int] = None) -> Optional[Tuple[OperationCode, str, int]]:
+        """
+        registra el resultado de un lote (ver store_batch). retorna el error a
+        enviar en el momento, o None si el lote queda confirmado por el proximo ack
+        """
+        if err is not None:
+            self._failed_id = request_id
+            self._unacked_id = None
+            return (*batch_response(err), request_id)
+        self._unacked_id = request_id
+        if duplicates is not None:
+            self._duplicates = (self._duplicates or 0) + duplicates
+        return None
+
+    def take_ack(self) -> Optional[Tuple[OperationCode, str, int]]:
+        """ ack acumulativo de los lotes guardados desde el ultimo ack, si hay """
+        if self._unacked_id is None:
+            return None
+        ack = OperationCode.CONFIRMACION, confirmation_message(self._duplicates), self._unacked_id
+        self._unacked_id = None
+        self._duplicates = None
+        return ack
+
 class ClientHandler:
     """
     handles a client connection
-    closes the connection when done
+    closes the connection when done, unless it is handed to the winners notifier
     """
     @staticmethod
-    def handle_client(sock: socket.socket, logging, lottery: Lottery, lottery_lock: threading.Lock, bets_lock: threading.Lock):
+    def handle_client(sock: socket.socket, logging, lottery: Lottery, lottery_lock: threading.Lock, bets_lock: threading.Lock, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None, winners_notifier: Optional[WinnersNotifier] = None,
+                      idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT) -> bool:
+        """
+        retorna True si la conexion quedo suscripta a los ganadores; en ese
+        caso la cierra el notifier y quien llama no debe cerrarla.
+        La conexion se cierra si pasan idle_timeout segundos sin recibir nada
+        (None la espera indefinidamente)
+        """
+        subscribed = False
+        session = False
+        compress = False
+        window = None
+        # respuestas que se envian juntas (errores de lotes de la ventana)
+        replies = []
+        request_id = None
+        ip = None
         try:
+            # el peer no cambia durante la conexion
+            ip = sock.getpeername()[0]
+            if idle_timeout:
+                sock.settimeout(idle_timeout)
             # lee el mensaje desde el socket
             while True: 
-                op, message = SimpleProtocol.deserialize_from_socket(sock)
-                addr = sock.getpeername()
-
-                # logging.info(f'action: receive_message | result: success | ip: {addr[0]} | op: {op}')
-
-                # opera de acuerdo al tipo de operacion
-                if op == OperationCode.APUESTA: #codigo de operacion deprecado, utilizado en la parte 5
-                    handle_bets(op, message, logging, sock, bets_lock)
-
-                elif op == OperationCode.BATCH:
-                    handle_bets(op, message, logging, sock, bets_lock)
-                    continue
-
-                elif op == OperationCode.ERROR:
-                    logging.error(f'action: receive_message | result: error | ip: {addr[0]} | op: {op} | message: {message}')
-                
-                elif op == OperationCode.READY:
-                    agency_id = int(message)
-                    with lottery_lock:
-                        lottery.mark_agency_ready(agency_id)
-                        logging.info(f'action: agencia_lista | result: success | ip: {addr[0]} | agency_id: {agency_id}')
-                
-                elif op == OperationCode.WINNERS:
-                    agency_id = int(message)
-                    with lottery_lock:
-                        if lottery.draw_done():
-                            winners = lottery.get_winners_for_agency(agency_id)
-                            SimpleProtocol.serialize_to_socket(sock, OperationCode.WINNERS, winners)
-                            logging.info(f'action: enviar_ganadores | result: success | agency_id: {agency_id}')
-                        else:
-                            lottery.mark_agency_ready(agency_id) #se vuelve a marcar como lista por si no lo estaba
-                            SimpleProtocol.serialize_to_socket(sock, OperationCode.NOT_READY, "Sorteo no realizado")
-
+                if session:
+                    try:
+                        op, request_id, message = SimpleProtocol.deserialize_session_from_socket(sock, compress)
+                    except ConnectionClosed:
+                        # el cliente termino la sesion
+                        break
                 else:
-                    raise ValueError("Unexpected Operation Code")
-                break
+                    op, message = SimpleProtocol.deserialize_from_socket(sock, compress)
+
+                # logging.info(f'action: receive_message | result: success | ip: {ip} | op: {op}')
+
+                if window is not None:
+                    if op in BATCH_OPERATIONS:
+                        if window.accepts(request_id):
+                            error = window.record(request_id, *store_batch(op, message, ip, logging, bets_lock, lottery, bets_writer))
+                            if error is not None:
+                                replies.append(error)
+                        # un solo envio (y un solo ack) para todos los lotes que ya estaban recibidos
+                        if not SimpleProtocol.has_buffered_frame(sock):
+                            append_ack(replies, window)
+                            flush_replies(sock, replies)
+                        continue
+                    append_ack(replies, window)
+
+                response = ClientHandler.handle_operation(op, message, ip, logging, lottery, lottery_lock, bets_lock, bets_writer)
+                if response is not None:
+                    replies.append((*response, request_id))
+                flush_replies(sock, replies, compress)
+
+                if ends_session(op, response):
+                    break
+
+                if op == OperationCode.SUBSCRIBE and winners_notifier is not None:
+                    subscribe_socket(sock, int(message), logging, winners_notifier, request_id, compress)
+                    subscribed = True
+                    break
+
+                if op == OperationCode.HANDSHAKE:
+                    accepted = accepted_capabilities(message)
+                    session = SESSION_CAPABILITY in accepted
+                    compress = COMPRESSION_CAPABILITY in accepted
+                    if BATCH_WINDOW_CAPABILITY in accepted:
+                        window = BatchWindow()
+                elif session and op == OperationCode.READY:
+                    # la sesion sigue abierta, el sorteo no puede esperar a que se cierre
+                    start_draw(lottery, logging, lottery_lock, winners_notifier)
+
+                # solo los lotes y el handshake mantienen la conexion abierta a la espera de mas mensajes
+                if not session and op not in SESSION_OPERATIONS:
+                    break
             
+        except socket.timeout:
+            logging.info('action: idle_timeout | result: success | ip: %s', ip)
         except Exception as e:
             try:
-                SimpleProtocol.serialize_to_socket(sock, OperationCode.ERROR, str(e))
+                # con las respuestas pendientes, en orden
+                replies.append((OperationCode.ERROR, str(e), request_id))
+                flush_replies(sock, replies)
             except Exception as e:
                 logging.error(f'action: send_response | result: fail | error: {e}')
             logging.error(f'action: receive_message | result: fail | error: {e}')
         finally:
-            sock.close()
+            if not subscribed:
+                sock.close()
+        return subscribed
+
+    @staticmethod
+    def handle_operation(op: OperationCode, message: str, ip: str, logging, lottery: Lottery, lottery_lock: threading.Lock, bets_lock: threading.Lock, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None) -> Optional[Tuple[OperationCode, Union[str, bytes]]]:
+        """
+        opera de acuerdo al tipo de operacion, sin depender del tipo de conexion.
+        retorna la respuesta (codigo de operacion, mensaje) a enviar al cliente,
+        o None si la operacion no tiene respuesta.
+        si se pasa bets_writer, las apuestas se guardan con group commit; si es un
+        IngestionPipeline, ademas se parsean en su pool de parsers
+        """
+        if op == OperationCode.APUESTA: #codigo de operacion deprecado, utilizado en la parte 5
+            return handle_bets(op, message, ip, logging, bets_lock, lottery, bets_writer)
+
+        elif op == OperationCode.BATCH or op == OperationCode.BATCH_BINARY:
+            return handle_bets(op, message, ip, logging, bets_lock, lottery, bets_writer)
+
+        elif op == OperationCode.HANDSHAKE:
+            accepted = accepted_capabilities(message)
+            logging.info('action: handshake | result: success | ip: %s | capabilities: %s', ip, ",".join(accepted))
+            return OperationCode.HANDSHAKE, ",".join(accepted)
+
+        elif op == OperationCode.ERROR:
+            logging.error(f'action: receive_message | result: error | ip: {ip} | op: {op} | message: {message}')
+            return None
+
+        elif op == OperationCode.READY:
+            agency_id = int(message)
+            with metrics.timed_lock(lottery_lock, 'lottery'):
+                lottery.mark_agency_ready(agency_id)
+                logging.info('action: agencia_lista | result: success | ip: %s | agency_id: %d', ip, agency_id)
+            return None
+
+        elif op == OperationCode.SUBSCRIBE:
+            # como READY, pero la conexion queda abierta hasta que se envien los ganadores
+            agency_id = int(message)
+            with metrics.timed_lock(lottery_lock, 'lottery'):
+                lottery.mark_agency_ready(agency_id)
+                logging.info('action: agencia_lista | result: success | ip: %s | agency_id: %d', ip, agency_id)
+            return None
+
+        elif op == OperationCode.WINNERS:
+            agency_id = int(message)
+            # una vez hecho el sorteo la respuesta se sirve del cache, sin tomar el lock
+            payload = lottery.winners_payload(agency_id)
+            if payload is not None:
+                logging.info('action: enviar_ganadores | result: success | agency_id: %d', agency_id)
+                return OperationCode.WINNERS, payload
+            with metrics.timed_lock(lottery_lock, 'lottery'):
+                if lottery.draw_done():
+                    winners = lottery.get_winners_for_agency(agency_id)
+                    logging.info('action: enviar_ganadores | result: success | agency_id: %d', agency_id)
+                    return OperationCode.WINNERS, winners
+                else:
+                    lottery.mark_agency_ready(agency_id) #se vuelve a marcar como lista por si no lo estaba
+                    return OperationCode.NOT_READY, "Sorteo no realizado"
+
+        elif op == OperationCode.LOOKUP:
+            # se responde desde el indice de documentos, sin tomar el lock de las apuestas
+            document, agency_id = parse_lookup(message)
+            bets = utils.load_bets_by_document(document, agency_id)
+            logging.info('action: consulta_documento | result: success | ip: %s | document: %s | cantidad: %d', ip, document, len(bets))
+            return OperationCode.LOOKUP, format_bets(bets)
+
+        raise ValueError("Unexpected Operation Code")
 
     @staticmethod
     def format_message(op: OperationCode, message: str) -> str:
@@ -85,38 +289,234 @@ class ClientHandler:
         return raw_bets
 
 
-def store_bets_from_list(bets: list[list[str]], logging, bets_lock: threading.Lock):
+def accepted_capabilities(message: str) -> list[str]:
+    """ capacidades pedidas en un HANDSHAKE que el servidor acepta """
+    requested = message.split(',') if message else []
+    accepted = [capability for capability in requested if capability in SUPPORTED_CAPABILITIES]
+    if SESSION_CAPABILITY not in accepted and BATCH_WINDOW_CAPABILITY in accepted:
+        # la ventana usa los request ids de la sesion como numeros de secuencia
+        accepted.remove(BATCH_WINDOW_CAPABILITY)
+    return accepted
+
+
+def parse_lookup(message: str) -> Tuple[str, Optional[int]]:
+    """ el mensaje de LOOKUP es 'documento' o 'documento,agencia' """
+    document, _, agency_id = message.partition(',')
+    if not document:
+        raise ValueError("Consulta sin documento")
+    return document, int(agency_id) if agency_id else None
+
+
+def format_bets(bets) -> str:
+    """ apuestas con el mismo formato de texto que los lotes (BATCH) """
+    return ";".join(
+        f"{bet.agency},{bet.first_name},{bet.last_name},{bet.document},{bet.birthdate.isoformat()},{bet.number}"
+        for bet in bets
+    )
+
+
+def append_ack(replies: list, window: BatchWindow):
+    """ agrega a las respuestas pendientes el ack acumulativo de la ventana, si hay """
+    ack = window.take_ack()
+    if ack is not None:
+        replies.append(ack)
+
+
+def flush_replies(sock: socket.socket, replies: list, compress: bool = False):
+    """ envia en una sola llamada las respuestas pendientes (ver send_frames) y vacia la lista """
+    if replies:
+        try:
+            SimpleProtocol.send_frames(sock, replies, compress)
+        finally:
+            replies.clear()
+
+
+def store_bets_from_list(bets: list[list[str]], logging, bets_lock: threading.Lock, lottery: Optional[Lottery] = None, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None):
+    return store_parsed_bets(parse_bets(bets), logging, bets_lock, lottery, bets_writer)
+
 
-    bets_to_load = []
+def parse_bets(bets: list[list[str]]) -> BetBatch:
+    # las apuestas se cargan en columnas, sin crear un Bet por apuesta
+    bets_to_load = BetBatch()
     for bet in bets:
-        new_bet = Bet(
-            bet[AGENCY],
+        bets_to_load.append(
+            int(bet[AGENCY]),
             bet[NAME],
             bet[LAST_NAME],
             bet[DOCUMENT],
-            bet[BIRTHDATE],
-            bet[NUMBER]
+            days_from_date(datetime.date.fromisoformat(bet[BIRTHDATE])),
+            int(bet[NUMBER])
         )
-        bets_to_load.append(new_bet)
+    return bets_to_load
+
+
+def store_parsed_bets(bets_to_load: BetBatch, logging, bets_lock: threading.Lock, lottery: Optional[Lottery] = None, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None) -> Tuple[Optional[Exception], int]:
+    """ retorna el error, si lo hubo, y las apuestas descartadas por ya estar guardadas """
     try:
-        with bets_lock:
-            utils.store_bets(bets_to_load)
-        logging.info(f'action: apuesta_recibida | result: success | cantidad: {len(bets_to_load)}')
-        return None
+        if bets_writer is not None:
+            # espera a que el lote quede persistido junto con los de otras conexiones
+            duplicates = bets_writer.write(bets_to_load)
+        else:
+            # con almacenamiento particionado cada agencia se guarda con el lock de su particion
+            with metrics.timed_lock(utils.storage_lock(bets_lock), 'bets'):
+                with metrics.STORE_LATENCY.time():
+                    stored = utils.store_bets(bets_to_load)
+                # los ganadores se registran a medida que llegan, el sorteo no vuelve a leer todo
+                if lottery is not None:
+                    lottery.record_bets(stored)
+            duplicates = len(bets_to_load) - len(stored)
+        report_stored_bets(logging, len(bets_to_load), duplicates)
+        return None, duplicates
     except Exception as e:
         logging.error(f'action: apuesta_recibida | result: fail | cantidad: {len(bets_to_load)}')
-        return e
+        return e, 0
 
 
-def handle_bets(op: OperationCode, message: str, logging, sock: socket.socket, bets_lock: threading.Lock):
-    raw_bets = ClientHandler.format_message(op, message)
-    err = store_bets_from_list(raw_bets, logging, bets_lock)
+def report_stored_bets(logging, amount: int, duplicates: int):
+    if duplicates:
+        metrics.DUPLICATE_BETS.inc(amount=duplicates)
+        logging.info('action: apuesta_recibida | result: success | cantidad: %d | duplicadas: %d', amount, duplicates)
+    else:
+        logging.info('action: apuesta_recibida | result: success | cantidad: %d', amount)
 
-    addr = sock.getpeername()
 
-    logging.info(f'action: receive_message | result: success | ip: {addr[0]} | op: {op}')
-    # envia la respuesta
-    if err is None:
-        SimpleProtocol.serialize_to_socket(sock, OperationCode.CONFIRMACION, "Apuestas recibidas")
+def decode_batch(op: OperationCode, message) -> BetBatch:
+    """ convierte el mensaje de un lote (texto o binario) en un BetBatch """
+    if op == OperationCode.BATCH_BINARY:
+        return binary_batch.decode_bet_batch(message)
+    return parse_bets(ClientHandler.format_message(op, message))
+
+
+def ingest_bets(op: OperationCode, message, logging, pipeline: IngestionPipeline) -> Tuple[Optional[Exception], int]:
+    try:
+        amount, duplicates = pipeline.ingest_counting_duplicates(op, message)
+        metrics.BATCH_SIZE.observe(amount)
+        report_stored_bets(logging, amount, duplicates)
+        return None, duplicates
+    except Exception as e:
+        logging.error(f'action: apuesta_recibida | result: fail | error: {e}')
+        return e, 0
+
+
+def handle_bets(op: OperationCode, message: str, ip: str, logging, bets_lock: threading.Lock, lottery: Optional[Lottery] = None, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None) -> Tuple[OperationCode, str]:
+    return batch_response(*store_batch(op, message, ip, logging, bets_lock, lottery, bets_writer))
+
+
+def store_batch(op: OperationCode, message: str, ip: str, logging, bets_lock: threading.Lock, lottery: Optional[Lottery] = None, bets_writer: Union[GroupCommitWriter, IngestionPipeline, None] = None) -> Tuple[Optional[Exception], Optional[int]]:
+    """
+    guarda un lote. retorna el error (None si se guardo) y las apuestas
+    descartadas por duplicadas (None sin deduplicacion)
+    """
+    duplicates = 0
+    if isinstance(bets_writer, IngestionPipeline):
+        err, duplicates = ingest_bets(op, message, logging, bets_writer)
     else:
-        SimpleProtocol.serialize_to_socket(sock, OperationCode.ERROR, str(err))
\ No newline at end of file
+        try:
+            bets_to_load = decode_batch(op, message)
+        except (ValueError, IndexError) as e:
+            # un lote mal formado se rechaza con un ERROR, sin cerrar la conexion
+            logging.error(f'action: apuesta_recibida | result: fail | error: {e}')
+            err = e
+        else:
+            metrics.BATCH_SIZE.observe(len(bets_to_load))
+            err, duplicates = store_parsed_bets(bets_to_load, logging, bets_lock, lottery, bets_writer)
+
+    logging.info('action: receive_message | result: success | ip: %s | op: %d', ip, op)
+    return err, duplicates if utils.deduplicating() else None
+
+
+def batch_response(err: Optional[Exception], duplicates: Optional[int] = None) -> Tuple[OperationCode, str]:
+    """ respuesta a un lote segun el resultado de store_batch """
+    if err is None:
+        return OperationCode.CONFIRMACION, confirmation_message(duplicates)
+    return OperationCode.ERROR, str(err)
+
+
+def create_bets_writer(bets_lock: threading.Lock, lottery: Optional[Lottery] = None, group_commit_window: Optional[float] = None,
+                       group_commit_max_bets: int = 10000, ingestion_parsers: int = 0,
+                       ingestion_queue_size: int = 100) -> Union[GroupCommitWriter, IngestionPipeline, None]:
+    """
+    etapa de escritura de apuestas del servidor: un IngestionPipeline si hay
+    parsers, un GroupCommitWriter si hay ventana de group commit, o None si
+    cada conexion escribe sus lotes
+    """
+    if ingestion_parsers > 0:
+        window = group_commit_window if group_commit_window is not None else DEFAULT_GROUP_COMMIT_WINDOW
+        return IngestionPipeline(decode_batch, bets_lock, lottery, ingestion_parsers, ingestion_queue_size,
+                                 window, group_commit_max_bets)
+    if group_commit_window is not None:
+        return GroupCommitWriter(bets_lock, lottery, group_commit_window, group_commit_max_bets)
+    return None
+
+
+def log_stage_stats(logging, bets_writer: Union[GroupCommitWriter, IngestionPipeline]):
+    for stage, stats in bets_writer.stage_stats().items():
+        logging.info(f'action: ingestion_stats | result: success | stage: {stage} | processed: {stats["processed"]} | '
+                     f'max_queue_depth: {stats["max_queue_depth"]} | avg_latency: {stats["avg_latency"]:.3f} | '
+                     f'max_latency: {stats["max_latency"]:.3f}')
+
+
+def stage_metrics(bets_writer: Union[GroupCommitWriter, IngestionPipeline]) -> list:
+    """ estadisticas de las etapas de escritura como gauges para el MetricsRegistry """
+    samples = []
+    for stage, stats in bets_writer.stage_stats().items():
+        labels = {"stage": stage}
+        samples.append(("lottery_stage_queue_depth", "Items en la cola de la etapa", labels, stats["queue_depth"]))
+        samples.append(("lottery_stage_processed", "Items procesados por la etapa", labels, stats["processed"]))
+        samples.append(("lottery_stage_max_latency_seconds", "Maxima latencia de la etapa", labels, stats["max_latency"]))
+    return samples
+
+
+def subscribe_socket(sock: socket.socket, agency_id: int, logging, winners_notifier: WinnersNotifier, request_id: Optional[int] = None, compress: bool = False):
+    """
+    deja la conexion esperando el sorteo sin ocupar un hilo; el notifier
+    envia los ganadores y la cierra
+    """
+    def send(payload: bytes):
+        try:
+            SimpleProtocol.serialize_to_socket(sock, OperationCode.WINNERS, payload, request_id, compress)
+            logging.info('action: enviar_ganadores | result: success | agency_id: %d', agency_id)
+        except Exception as e:
+            logging.error(f'action: enviar_ganadores | result: fail | agency_id: {agency_id} | error: {e}')
+        finally:
+            sock.close()
+
+    winners_notifier.subscribe(agency_id, send, sock.close)
+
+
+def try_make_draw(lottery: Lottery, logging, lottery_lock: threading.Lock, winners_notifier: Optional[WinnersNotifier] = None):
+    """
+    realiza el sorteo si todas las agencias estan listas y todavia no se hizo,
+    y envia los ganadores a las agencias suscriptas
+    """
+    with metrics.timed_lock(lottery_lock, 'lottery'):
+        if not lottery.all_agencies_ready() or lottery.draw_done():
+            return
+        draw_start = time.monotonic()
+        lottery.make_draw()
+        metrics.DRAW_DURATION.set(time.monotonic() - draw_start)
+        logging.info('action: sorteo | result: success')
+    if winners_notifier is not None:
+        winners_notifier.notify()
+
+
+def start_draw(lottery: Lottery, logging, lottery_lock: threading.Lock, winners_notifier: Optional[WinnersNotifier] = None) -> Optional[threading.Thread]:
+    """
+    lanza el sorteo en un hilo propio si todas las agencias estan listas, para
+    no ocupar el hilo de la conexion que recibio el ultimo READY. La revision
+    se hace sin el lock y solo evita hilos de mas: try_make_draw vuelve a
+    revisar con el lock de la loteria
+    """
+    if not lottery.all_agencies_ready() or lottery.draw_done():
+        return None
+    drawer = threading.Thread(target=_draw_in_background, args=(lottery, logging, lottery_lock, winners_notifier),
+                              name="lottery-draw", daemon=True)
+    drawer.start()
+    return drawer
+
+
+def _draw_in_background(lottery: Lottery, logging, lottery_lock: threading.Lock, winners_notifier: Optional[WinnersNotifier]):
+    try:
+        try_make_draw(lottery, logging, lottery_lock, winners_notifier)
+    except Exception as e:
+        logging.error(f'action: sorteo | result: fail | error: {e}')
@@ -0,0 +1,154 @@
+import bisect
+import heapq
+import threading
+from array import array
+
+from common import utils
+
+
+""" Huellas recientes que se juntan en un set antes de pasarlas a una corrida ordenada """
+DEFAULT_BUFFER_SIZE = 65536
+FINGERPRINT_MASK = (1 << 64) - 1
+
+
+def fingerprint(agency: int, document: str, number: int) -> int:
+    """ Huella de 64 bits de la clave (agencia, documento, numero) de una apuesta """
+    return hash((agency, document, number)) & FINGERPRINT_MASK
+
+
+class FingerprintSet:
+    """
+    Conjunto compacto de huellas de 64 bits: corridas ordenadas en arrays, a
+    8 bytes por huella, mas un set acotado con las ultimas agregadas. Cuando
+    el set se llena pasa a ser una corrida nueva, y las corridas de tamaño
+    parecido se mezclan, por lo que hay O(log n) corridas donde buscar
+    """
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self._buffer_size = buffer_size
+        self._recent = set()
+        self._runs = []
+
+    def __len__(self) -> int:
+        return len(self._recent) + sum(len(run) for run in self._runs)
+
+    def __contains__(self, value: int) -> bool:
+        if value in self._recent:
+            return True
+        for run in self._runs:
+            i = bisect.bisect_left(run, value)
+            if i < len(run) and run[i] == value:
+                return True
+        return False
+
+    def add(self, value: int) -> None:
+        self._recent.add(value)
+        if len(self._recent) >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        self._runs.append(array('Q', sorted(self._recent)))
+        self._recent = set()
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            newest = self._runs.pop()
+            self._runs[-1] = array('Q', heapq.merge(self._runs[-1], newest))
+
+
+class DuplicateFilter:
+    """
+    Descarta al guardar las apuestas que ya estan guardadas, identificadas
+    por (agencia, documento, numero): por ejemplo las de un lote que el
+    cliente reenvia porque no le llego la CONFIRMACION.
+
+    Solo se guarda una huella por apuesta (ver FingerprintSet). Una huella
+    repetida se confirma buscando el documento en el almacenamiento, por lo
+    que una colision nunca descarta una apuesta nueva; esa busqueda solo se
+    hace ante un duplicado.
+
+    Las huellas se cargan desde el almacenamiento a partir de la posicion
+    hasta la que ya estan indexadas (ver utils.storage_position). Si el
+    almacenamiento lo escriben otros procesos (shared), las apuestas propias
+    se indexan al releerlas junto con las ajenas antes del proximo lote; si
+    no, se indexan al guardarlas.
+
+    La verificacion y la escritura se hacen bajo el lock del filtro, por lo
+    que los lotes de un proceso se guardan de a uno aun con almacenamiento
+    particionado. Entre procesos, la atomicidad es la del lock de las apuestas,
+    que con un filtro shared se toma aun con almacenamiento particionado (ver
+    utils.storage_lock).
+    """
+    def __init__(self, shared: bool = False):
+        self._shared = shared
+        self._fingerprints = FingerprintSet()
+        self._position = None
+        self._lock = threading.Lock()
+
+    def shared(self) -> bool:
+        """ si otros procesos guardan apuestas en el mismo almacenamiento """
+        return self._shared
+
+    def load(self) -> int:
+        """ Indexa las apuestas guardadas y retorna cuantas hay indexadas """
+        with self._lock:
+            self._refresh()
+            return len(self._fingerprints)
+
+    def store(self, batches: list, store) -> list:
+        """
+        Guarda con store, en una sola escritura, las apuestas nuevas de los
+        lotes. Retorna por cada lote las apuestas que se guardaron; las
+        repetidas dentro de un mismo lote o entre lotes tambien se descartan
+        """
+        with self._lock:
+            self._refresh()
+            pending = {}
+            kept = [self._new_bets(batch, pending) for batch in batches]
+            stored = [batch if len(positions) == len(batch) else batch.take(positions)
+                      for batch, positions in zip(batches, kept)]
+
+            bets = stored[0] if len(stored) == 1 else utils.BetBatch()
+            if len(stored) > 1:
+                for batch in stored:
+                    bets.extend(batch)
+            if len(bets) > 0:
+                store(bets)
+
+            if not self._shared:
+                for value in pending.values():
+                    self._fingerprints.add(value)
+                _, self._position = utils.storage_position()
+        return stored
+
+    def _refresh(self):
+        _, position = utils.storage_position()
+        for batch in utils.load_bet_batches_between(self._position, position):
+            for i in range(len(batch)):
+                self._fingerprints.add(fingerprint(batch.agencies[i], batch.strings(i)[0], batch.numbers[i]))
+        self._position = position
+
+    def _new_bets(self, batch, pending: dict) -> list:
+        """
+        Posiciones de las apuestas nuevas del lote. pending acumula las
+        claves (y sus huellas) de las apuestas nuevas de los lotes ya revisados
+        """
+        positions = []
+        suspects = []
+        for i in range(len(batch)):
+            key = (batch.agencies[i], batch.strings(i)[0], batch.numbers[i])
+            if key in pending:
+                continue
+            value = fingerprint(*key)
+            if value in self._fingerprints:
+                suspects.append((i, value, key))
+                continue
+            pending[key] = value
+            positions.append(i)
+
+        # las huellas ya indexadas se confirman contra el indice de documentos
+        for i, value, key in suspects:
+            agency, document, number = key
+            if key in pending or any(bet.number == number for bet in utils.load_bets_by_document(document, agency)):
+                continue
+            pending[key] = value
+            positions.append(i)
+        positions.sort()
+        return positions
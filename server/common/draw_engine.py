@@ -0,0 +1,142 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+from common import utils
+
+try:
+    import numpy as np
+except ImportError:
+    # sin NumPy se usa el mismo recorrido por columnas en Python puro
+    np = None
+
+
+class DrawRule:
+    """
+    Regla de sorteo: una apuesta gana si su numero es uno de numbers o cae en
+    alguno de los rangos (inclusivos) de ranges.
+
+    Se evalua sobre columnas enteras de numeros: con NumPy como una mascara
+    booleana por chunk, y sin NumPy recorriendo el array de la columna.
+    """
+    def __init__(self, numbers: Iterable[int] = (), ranges: Iterable = ()):
+        self.numbers = sorted(set(numbers))
+        self.ranges = [(low, high) for low, high in ranges]
+
+    @classmethod
+    def parse(cls, text: str) -> 'DrawRule':
+        """
+        Parsea una regla con el formato '7574,100-200': numeros y rangos
+        separados por coma
+        """
+        numbers, ranges = [], []
+        for part in text.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            low, separator, high = part.partition('-')
+            if separator:
+                ranges.append((int(low), int(high)))
+            else:
+                numbers.append(int(part))
+        return cls(numbers, ranges)
+
+    def __str__(self) -> str:
+        """ La regla con el formato que acepta parse """
+        parts = [str(number) for number in self.numbers]
+        parts.extend(f'{low}-{high}' for low, high in self.ranges)
+        return ','.join(parts)
+
+    def exact_numbers(self) -> Optional[list]:
+        """ Los numeros ganadores si la regla no tiene rangos, None si no """
+        return None if self.ranges else self.numbers
+
+    def matches(self, number: int) -> bool:
+        if number in self.numbers:
+            return True
+        return any(low <= number <= high for low, high in self.ranges)
+
+    def mask(self, numbers):
+        """ Mascara booleana de NumPy con las posiciones ganadoras de la columna """
+        mask = np.isin(numbers, self.numbers)
+        for low, high in self.ranges:
+            mask |= (numbers >= low) & (numbers <= high)
+        return mask
+
+
+def winning_positions(batch, rule: DrawRule):
+    """ Posiciones de las apuestas ganadoras de un BetBatch """
+    if np is not None:
+        numbers = np.frombuffer(batch.numbers, dtype=np.intc)
+        return np.flatnonzero(rule.mask(numbers)).tolist()
+    return [i for i, number in enumerate(batch.numbers) if rule.matches(number)]
+
+
+def add_winners(winners: dict, batch, rule: DrawRule) -> None:
+    """
+    Agrega los ganadores del batch al mapa agencia -> lista de Bet, en el
+    orden en que fueron guardados. Solo se construyen los Bet ganadores
+    """
+    positions = winning_positions(batch, rule)
+    if not positions:
+        return
+    if np is not None:
+        # group-by por agencia: orden estable por agencia y un corte por grupo
+        positions = np.asarray(positions)
+        agencies = np.frombuffer(batch.agencies, dtype=np.intc)[positions]
+        order = np.argsort(agencies, kind='stable')
+        groups, starts = np.unique(agencies[order], return_index=True)
+        for agency, group in zip(groups.tolist(), np.split(positions[order], starts[1:])):
+            winners.setdefault(agency, []).extend(batch.bet(i) for i in group.tolist())
+        return
+    for i in positions:
+        winners.setdefault(batch.agencies[i], []).append(batch.bet(i))
+
+
+def draw(batches: Iterable, rule: DrawRule) -> dict:
+    """ Calcula los ganadores de todas las agencias recorriendo los batches """
+    winners = {}
+    for batch in batches:
+        add_winners(winners, batch, rule)
+    return winners
+
+
+def draw_parallel(chunks: list, rule: DrawRule, workers: int) -> dict:
+    """
+    Calcula los ganadores repartiendo los chunks del almacenamiento entre un
+    pool de procesos. Cada proceso devuelve solo sus ganadores, que se juntan
+    en el orden de los chunks para mantener el orden en que se guardaron
+    """
+    winners = {}
+    # spawn: el sorteo puede pedirse desde un servidor con varios hilos
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context) as executor:
+        for chunk_winners in executor.map(_draw_chunk, chunks, itertools.repeat(rule)):
+            for agency, bets in chunk_winners.items():
+                winners.setdefault(agency, []).extend(bets)
+    return winners
+
+
+def _draw_chunk(chunk, rule: DrawRule) -> dict:
+    return draw(chunk.load_batches(), rule)
+
+
+def draw_from_storage(rule: DrawRule, workers: int = 1) -> dict:
+    """
+    Calcula los ganadores de todas las apuestas guardadas. Con un unico numero
+    ganador y un almacenamiento indexado se usa la busqueda por numero; para
+    el resto se recorren las columnas del almacenamiento, en paralelo en
+    workers procesos si hay datos suficientes para mas de un chunk
+    """
+    numbers = rule.exact_numbers()
+    if numbers is not None and len(numbers) == 1 and utils.bets_indexed_by_number():
+        winners = {}
+        for bet in utils.load_bets_with_number(numbers[0]):
+            winners.setdefault(bet.agency, []).append(bet)
+        return winners
+    if workers > 1:
+        chunks = utils.split_bet_chunks(workers)
+        if len(chunks) > 1:
+            return draw_parallel(chunks, rule, workers)
+    return draw(utils.load_bet_batches(), rule)
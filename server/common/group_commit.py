@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+from common import metrics, utils
+from common.stage_stats import StageStats
+
+
+class _CommitRequest:
+    def __init__(self, bets):
+        self.bets = bets
+        self.error = None
+        self.duplicates = 0
+        self.done = threading.Event()
+        self.enqueued_at = time.monotonic()
+
+    def wait(self) -> int:
+        """
+        Bloquea hasta que las apuestas fueron guardadas y retorna cuantas se
+        descartaron por ya estar guardadas. Si el commit falla lanza la
+        excepcion del almacenamiento
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.duplicates
+
+
+class GroupCommitWriter:
+    """
+    Etapa de escritura unica para las apuestas de todas las conexiones.
+
+    Cada conexion entrega su lote con write() y queda bloqueada hasta que el
+    lote esta persistido. El hilo escritor junta los lotes pendientes durante
+    una ventana de commit (window segundos o max_bets apuestas, lo que ocurra
+    primero) y los guarda con una sola escritura. La durabilidad depende del
+    almacenamiento configurado (ver utils.configure_storage y su fsync).
+
+    queue_size acota los lotes que esperan ser escritos (0 sin limite): con la
+    cola llena, quien entrega un lote espera a que el escritor avance.
+    """
+    def __init__(self, bets_lock, lottery=None, window=0.002, max_bets=10000, queue_size=0):
+        self._bets_lock = bets_lock
+        self._lottery = lottery
+        self._window = window
+        self._max_bets = max_bets
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats = StageStats()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def write(self, bets) -> int:
+        """
+        Bloquea hasta que las apuestas fueron guardadas y retorna cuantas se
+        descartaron por duplicadas (ver utils.configure_dedup). Si el commit
+        falla lanza la excepcion del almacenamiento
+        """
+        return self.submit(bets).wait()
+
+    def submit(self, bets) -> _CommitRequest:
+        """
+        Entrega las apuestas sin esperar a que se guarden; el commit se
+        espera con wait() sobre el pedido retornado
+        """
+        request = _CommitRequest(bets)
+        self._queue.put(request)
+        self._stats.record_enqueue(self._queue.qsize())
+        return request
+
+    def stats(self) -> dict:
+        return self._stats.snapshot(self._queue.qsize())
+
+    def stage_stats(self) -> dict:
+        """ Metricas por etapa, con el mismo formato que IngestionPipeline """
+        return {"store": self.stats()}
+
+    def _run(self):
+        running = True
+        while running:
+            first = self._queue.get()
+            if first is None:
+                break
+            pending = [first]
+            pending_bets = len(first.bets)
+
+            deadline = time.monotonic() + self._window
+            while pending_bets < self._max_bets:
+                try:
+                    request = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                pending.append(request)
+                pending_bets += len(request.bets)
+
+            self._commit(pending)
+
+    def _commit(self, pending):
+        try:
+            with metrics.timed_lock(utils.storage_lock(self._bets_lock), 'bets'):
+                for request, bets in zip(pending, self._store(pending)):
+                    if request.error is None:
+                        self._record(request, bets)
+        except Exception as e:
+            for request in pending:
+                if request.error is None:
+                    request.error = e
+        committed_at = time.monotonic()
+        for request in pending:
+            self._stats.record_done(committed_at - request.enqueued_at)
+            request.done.set()
+
+    def _store(self, pending) -> list:
+        """
+        Guarda los lotes con una sola escritura. Si esa escritura falla sin
+        haber escrito nada, guarda cada lote por separado para que el error
+        sea solo de quien entrego el lote invalido; si llego a escribir una
+        parte, el error es de todos (reintentar duplicaria apuestas)
+        """
+        start = utils.storage_position()
+        try:
+            with metrics.STORE_LATENCY.time():
+                return utils.store_bet_batches([request.bets for request in pending])
+        except Exception as e:
+            if len(pending) == 1 or utils.storage_position() != start:
+                for request in pending:
+                    request.error = e
+                return [None] * len(pending)
+
+        stored = []
+        for request in pending:
+            try:
+                with metrics.STORE_LATENCY.time():
+                    stored.append(utils.store_bets(request.bets))
+            except Exception as e:
+                request.error = e
+                stored.append(None)
+        return stored
+
+    def _record(self, request, bets):
+        request.duplicates = len(request.bets) - len(bets)
+        if self._lottery is None:
+            return
+        try:
+            self._lottery.record_bets(bets)
+        except Exception as e:
+            request.error = e
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+
+from common.group_commit import GroupCommitWriter
+from common.stage_stats import StageStats
+
+
+DEFAULT_PARSERS = 4
+DEFAULT_QUEUE_SIZE = 100
+
+
+class _IngestRequest:
+    def __init__(self, op, message):
+        self.op = op
+        self.message = message
+        self.enqueued_at = time.monotonic()
+        self.bets = None
+        self.error = None
+        self.commit = None
+        self.parsed = threading.Event()
+
+
+class IngestionPipeline:
+    """
+    Ingesta de lotes en etapas conectadas por colas acotadas:
+
+    - lectura: el hilo de cada conexion lee el frame del socket y lo encola
+    - parseo y validacion: un pool de parsers convierte cada lote en un BetBatch
+    - escritura: un unico GroupCommitWriter guarda los lotes de todas las conexiones
+
+    Los parsers entregan el lote al escritor sin esperar el commit, por lo que
+    un flush lento solo demora a los lotes que esperan ser escritos y no al
+    parseo de las demas agencias. La conexion espera a que su lote quede
+    guardado para confirmarlo, como con el GroupCommitWriter solo.
+    """
+    def __init__(self, decoder, bets_lock, lottery=None, parsers=DEFAULT_PARSERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 window=0.002, max_bets=10000):
+        """
+        decoder(op, message) convierte el mensaje de un lote en un BetBatch y
+        lanza una excepcion si el lote es invalido. queue_size acota tanto la
+        cola de parseo como la de escritura
+        """
+        self._decoder = decoder
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats = StageStats()
+        self._writer = GroupCommitWriter(bets_lock, lottery, window, max_bets, queue_size)
+        self._parsers = [
+            threading.Thread(target=self._parse_loop, name=f"parser-{i}", daemon=True)
+            for i in range(parsers)
+        ]
+
+    def start(self):
+        self._writer.start()
+        for parser in self._parsers:
+            parser.start()
+
+    def stop(self, timeout=None):
+        """ Termina los lotes encolados y espera a lo sumo timeout segundos por etapa """
+        for _ in self._parsers:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for parser in self._parsers:
+            parser.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        self._writer.stop(timeout)
+
+    def ingest(self, op, message) -> int:
+        """
+        Bloquea hasta que el lote fue guardado y retorna la cantidad de
+        apuestas. Lanza el error de parseo o del almacenamiento
+        """
+        return self.ingest_counting_duplicates(op, message)[0]
+
+    def ingest_counting_duplicates(self, op, message) -> tuple:
+        """
+        Como ingest, pero retorna (apuestas del lote, apuestas descartadas por
+        ya estar guardadas)
+        """
+        request = _IngestRequest(op, message)
+        self._queue.put(request)
+        self._stats.record_enqueue(self._queue.qsize())
+        request.parsed.wait()
+        if request.error is not None:
+            raise request.error
+        duplicates = request.commit.wait()
+        return len(request.bets), duplicates
+
+    def write(self, bets) -> int:
+        """ Guarda un lote ya parseado, como GroupCommitWriter.write """
+        return self._writer.write(bets)
+
+    def stage_stats(self) -> dict:
+        """ Metricas por etapa: profundidad de cola y latencia """
+        return {
+            "parse": self._stats.snapshot(self._queue.qsize()),
+            "store": self._writer.stats(),
+        }
+
+    def _parse_loop(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            try:
+                request.bets = self._decoder(request.op, request.message)
+                request.commit = self._writer.submit(request.bets)
+            except Exception as e:
+                request.error = e
+            self._stats.record_done(time.monotonic() - request.enqueued_at)
+            request.parsed.set()
@@ -0,0 +1,99 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional
+
+""" Acciones que se loguean una o mas veces por conexion o por lote, y que se pueden muestrear """
+HIGH_FREQUENCY_ACTIONS = frozenset({'accept_connections', 'receive_message', 'apuesta_recibida'})
+ACTION_PREFIX = 'action: '
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+_target: Optional[logging.Handler] = None
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Encola los registros sin formatearlos: el mensaje (con sus argumentos)
+    se arma en el hilo del listener. La cola es del mismo proceso, por lo
+    que no hace falta que el registro se pueda serializar
+    """
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar uno de cada `every` registros de INFO o menor de cada linea
+    de las HIGH_FREQUENCY_ACTIONS; los errores y el resto de las acciones
+    pasan siempre. Las lineas se identifican por su formato (el mensaje sin
+    los argumentos), por lo que se cuentan por separado p. ej. el in_progress
+    y el success de una misma accion
+    """
+    def __init__(self, every: int):
+        super().__init__()
+        self._every = every
+        self._counters = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or action_of(record.msg) not in HIGH_FREQUENCY_ACTIONS:
+            return True
+        counter = self._counters.get(record.msg)
+        if counter is None:
+            counter = self._counters.setdefault(record.msg, itertools.count())
+        return next(counter) % self._every == 0
+
+
+def action_of(message) -> Optional[str]:
+    """ accion de una linea 'action: X | result: Y | ...' """
+    if not isinstance(message, str) or not message.startswith(ACTION_PREFIX):
+        return None
+    return message[len(ACTION_PREFIX):].partition(' |')[0]
+
+
+def queue_handler(handler: logging.Handler) -> logging.Handler:
+    """
+    Retorna un handler que encola los registros para que `handler` los
+    escriba desde un hilo aparte, sin bloquear a quien loguea. Hay un solo
+    hilo escritor por proceso: una nueva llamada detiene el anterior.
+
+    Los registros pendientes se escriben al terminar el proceso (o al llamar
+    a stop). Un proceso hijo creado con fork arranca su propio hilo
+    escritor con una cola nueva; como multiprocessing termina los hijos sin
+    correr atexit, el hijo debe llamar a stop antes de terminar
+    """
+    global _queue_handler, _target
+    stop()
+    _target = handler
+    _queue_handler = _LazyQueueHandler(queue.SimpleQueue())
+    _start_listener()
+    return _queue_handler
+
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, _target, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_in_child():
+    # el hilo escritor no sobrevive al fork, y la cola heredada puede quedar a medio usar
+    if _listener is None:
+        return
+    _queue_handler.queue = queue.SimpleQueue()
+    _start_listener()
+
+
+def stop():
+    """ Escribe los registros encolados y detiene el hilo escritor, si hay uno """
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+atexit.register(stop)
+os.register_at_fork(after_in_child=_restart_in_child)
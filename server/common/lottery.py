@@ -1,34 +1,156 @@
 import os
-from common.utils import has_won, load_bets
+import threading
+from typing import Optional
+from common import checkpoint, draw_engine
+from common.utils import LOTTERY_WINNER_NUMBER, BetBatch
+
+def number_of_agencies() -> int:
+    #get number of agencies from env variable
+    return int(os.getenv('NUMBER_OF_AGENCIES', 5))
+
+def draw_rule() -> draw_engine.DrawRule:
+    #get draw rule from env variable, e.g. "7574" or "7574,100-200"
+    return draw_engine.DrawRule.parse(os.getenv('DRAW_RULE', str(LOTTERY_WINNER_NUMBER)))
+
+def draw_workers() -> int:
+    #get amount of processes that scan the bets in the draw, 0 means one per core
+    workers = int(os.getenv('DRAW_WORKERS', 0))
+    return workers if workers > 0 else (os.cpu_count() or 1)
 
 class Lottery:
-    def __init__(self):
-        #get number of agencies from env variable
-        self._number_of_agencies = int(os.getenv('NUMBER_OF_AGENCIES', 5))
-        self._agencies = [False] * self._number_of_agencies
+    def __init__(self, agencies=None, draw_flag=None, checkpoint_path=None, shared_winners_path=None):
+        """
+        agencies y draw_flag permiten compartir el estado del sorteo entre procesos
+        (por ejemplo un multiprocessing.Array y un multiprocessing.Value). Si no se
+        pasan, el estado es local al proceso.
+        Con checkpoint_path el estado se recupera del checkpoint que guarda el
+        Checkpointer, recorriendo solo las apuestas guardadas despues de el.
+        Con estado compartido y shared_winners_path, el proceso que hace el sorteo
+        guarda ahi los ganadores y los demas los leen en lugar de recorrer todas
+        las apuestas
+        """
+        self._number_of_agencies = number_of_agencies()
+        self._rule = draw_rule()
+        self._draw_workers = draw_workers()
+        self._agencies = agencies if agencies is not None else [False] * self._number_of_agencies
+        self._draw_flag = draw_flag
         self._winners = {}
+        # con almacenamiento particionado los lotes se registran sin el lock de las apuestas
+        self._record_lock = threading.Lock()
+        # respuestas de WINNERS ya codificadas por agencia, armadas al hacer el sorteo
+        self._winners_payloads = None
         self._draw_done = False
+        # con estado compartido entre procesos cada proceso solo ve sus propios
+        # lotes, por lo que los ganadores se reconstruyen desde el almacenamiento
+        self._tracking_winners = draw_flag is None
+        self._winners_loaded = False
+        self._checkpoint_path = checkpoint_path
+        self._shared_winners_path = shared_winners_path if draw_flag is not None else None
+
+    def rule(self) -> draw_engine.DrawRule:
+        return self._rule
+
+    def restore_checkpoint(self):
+        """
+        Retoma del checkpoint las agencias que ya estaban listas y si el sorteo
+        ya se habia hecho, por ejemplo al reiniciar el servidor a mitad de una
+        ronda. Va despues de recover_winners, para responder con esos ganadores
+        """
+        state = self._load_checkpoint()
+        if state is None:
+            return
+        for agency, ready in enumerate(state.agencies):
+            if ready:
+                self._agencies[agency] = True
+        if state.draw_done:
+            if self._draw_flag is not None:
+                self._draw_flag.value = True
+            else:
+                self._winners_payloads = self._encode_winners()
+                self._draw_done = True
+
+    def _load_checkpoint(self):
+        if self._checkpoint_path is None:
+            return None
+        return checkpoint.load_checkpoint(self._checkpoint_path, self._rule, self._number_of_agencies)
+
+    def recover_winners(self):
+        """
+        Reconstruye los ganadores registrados a partir del almacenamiento, por
+        ejemplo al reiniciar el servidor con apuestas ya guardadas. A partir de
+        aca los ganadores se siguen de forma incremental con record_bets
+        """
+        self._winners_payloads = None
+        try:
+            self._winners = checkpoint.replay_winners(self._load_checkpoint(), self._rule, self._draw_workers)
+        except FileNotFoundError:
+            # todavia no hay apuestas guardadas
+            self._winners = {}
+        self._winners_loaded = True
+
+    def record_bets(self, bets):
+        """
+        Registra los ganadores de un lote recien guardado, despues de guardarlo
+        """
+        if self._tracking_winners and not self._draw_done:
+            with self._record_lock:
+                self._add_winners(bets)
+
+    def _add_winners(self, bets):
+        if not isinstance(bets, BetBatch):
+            bets = BetBatch.from_bets(bets)
+        # solo se construyen los Bet de las apuestas ganadoras
+        draw_engine.add_winners(self._winners, bets, self._rule)
 
     def make_draw(self):
         if self._draw_done:
             return
         if False in self._agencies:
             raise RuntimeError("Not all agencies are ready")
-        bets = load_bets()
-        for bet in bets:
-            if has_won(bet):
-                if bet.agency not in self._winners:
-                    self._winners[bet.agency] = []
-                self._winners[bet.agency].append(bet)
+        # los ganadores ya se conocen si se siguieron durante la ingesta
+        if not (self._tracking_winners and self._winners_loaded):
+            self._load_winners()
+        self._winners_payloads = self._encode_winners()
         self._draw_done = True
+        if self._draw_flag is not None:
+            self._draw_flag.value = True
+
+    def _load_winners(self):
+        """
+        Ganadores de todas las apuestas guardadas. Si otro proceso ya hizo el
+        sorteo se leen los que dejo; si no (o no los dejo), se recorren las
+        apuestas y se dejan para los demas
+        """
+        if self._shared_winners_path is not None and self.draw_done():
+            winners = checkpoint.load_winners(self._shared_winners_path)
+            if winners is not None:
+                self._winners = winners
+                self._winners_loaded = True
+                return
+        self.recover_winners()
+        if self._shared_winners_path is not None:
+            checkpoint.save_winners(self._shared_winners_path, self._winners)
 
     def get_winners_for_agency(self, agency_id) -> str:
-        winners = self._winners.get(agency_id, [])
-        formatted_winners = ""
-        for bet in winners:
-            formatted_winners += bet.document + ","
-        formatted_winners = formatted_winners.rstrip(",")
-        return formatted_winners
+        # si el sorteo lo hizo otro proceso, se calculan los ganadores localmente
+        if not self._draw_done:
+            self.make_draw()
+        return ",".join(bet.document for bet in self._winners.get(agency_id, []))
+
+    def winners_payload(self, agency_id) -> Optional[bytes]:
+        """
+        Respuesta de WINNERS ya codificada para la agencia, o None si el sorteo
+        todavia no se hizo en este proceso. No necesita el lock de la loteria:
+        el cache se arma completo antes de publicarse y no se modifica despues
+        """
+        payloads = self._winners_payloads
+        if payloads is None:
+            return None
+        return payloads.get(agency_id, b"")
+
+    def _encode_winners(self) -> dict:
+        return {agency: ",".join(bet.document for bet in winners).encode('utf-8')
+                for agency, winners in self._winners.items()}
 
     def mark_agency_ready(self, agency_id):
         agency_id -= 1
@@ -38,7 +160,13 @@ class Lottery:
     def all_agencies_ready(self):
         return all(self._agencies)
 
+    def is_shared(self):
+        """ Si el estado del sorteo se comparte con otros procesos """
+        return self._draw_flag is not None
+
     def draw_done(self):
+        if self._draw_flag is not None:
+            return bool(self._draw_flag.value)
         return self._draw_done
 
     def agencies(self):
@@ -0,0 +1,244 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+""" Buckets de los histogramas de tiempos (segundos) """
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+""" Buckets del histograma de apuestas por lote """
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000, 10000)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, label_values) -> tuple:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name} espera los labels {self.labels}")
+        return tuple(str(value) for value in label_values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        with self._lock:
+            samples = sorted(self._values.items())
+        for key, value in samples:
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    """ Cuenta las observaciones por bucket; el render las acumula como espera Prometheus """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # un contador por bucket, mas +Inf, la suma y la cantidad
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        with self._lock:
+            samples = sorted((key, list(counts)) for key, counts in self._values.items())
+        names = self.labels + ('le',)
+        for key, counts in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {counts[-2]}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metricas del servidor, en memoria del proceso. Ademas de las metricas
+    propias se pueden registrar collectors: funciones que se llaman en cada
+    scrape y retornan gauges ya calculados (por ejemplo las estadisticas del
+    pool de workers) como tuplas (nombre, ayuda, labels, valor)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets, labels=()) -> Histogram:
+        return self._register(Histogram(name, help, buckets, labels))
+
+    def register_collector(self, collector) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector) -> None:
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self) -> str:
+        """ Todas las metricas en el formato de texto de Prometheus """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        described = set()
+        for collector in collectors:
+            for name, help, labels, value in collector():
+                if name not in described:
+                    described.add(name)
+                    lines.append(f'# HELP {name} {help}')
+                    lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+""" Interfaz en la que se sirven las metricas si no se configura otra: solo la local """
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+
+class MetricsServer:
+    """
+    Sirve las metricas de un registry como texto por HTTP (GET de cualquier
+    path), en un puerto separado del protocolo y desde un hilo propio.
+    Por defecto escucha solo en la interfaz local; para que las lea otro
+    host hay que pasar su interfaz (o '' para todas)
+    """
+    def __init__(self, port, registry=None, host=DEFAULT_METRICS_HOST):
+        self._address = (host, port)
+        self._registry = registry if registry is not None else REGISTRY
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # los scrapes no se loguean
+                pass
+
+        self._httpd = ThreadingHTTPServer(self._address, Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logging.info(f'action: metrics_server | result: success | port: {self.port()}')
+
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def stop(self):
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd = None
+
+
+REGISTRY = MetricsRegistry()
+
+FRAMES = REGISTRY.counter('lottery_frames_total', 'Mensajes del protocolo por direccion y codigo de operacion', ('direction', 'op'))
+BYTES = REGISTRY.counter('lottery_bytes_total', 'Bytes del protocolo por direccion, headers incluidos', ('direction',))
+BATCH_SIZE = REGISTRY.histogram('lottery_batch_bets', 'Apuestas por lote recibido', BATCH_SIZE_BUCKETS)
+STORE_LATENCY = REGISTRY.histogram('lottery_store_bets_seconds', 'Duracion de cada escritura de apuestas', LATENCY_BUCKETS)
+LOCK_WAIT = REGISTRY.histogram('lottery_lock_wait_seconds', 'Espera para tomar los locks del servidor', LATENCY_BUCKETS, ('lock',))
+ACTIVE_CONNECTIONS = REGISTRY.gauge('lottery_active_connections', 'Conexiones que se estan atendiendo')
+REJECTED_CONNECTIONS = REGISTRY.counter('lottery_rejected_connections_total', 'Conexiones rechazadas por la cola de admision')
+DUPLICATE_BETS = REGISTRY.counter('lottery_duplicate_bets_total', 'Apuestas descartadas por ya estar guardadas')
+DRAW_DURATION = REGISTRY.gauge('lottery_draw_duration_seconds', 'Duracion del ultimo sorteo')
+
+
+def record_frame(direction: str, op_code, size: int) -> None:
+    """ direction es 'in' o 'out'; size es el tamaño del mensaje con el header """
+    FRAMES.inc(direction, getattr(op_code, 'name', op_code))
+    BYTES.inc(direction, amount=size)
+
+
+@contextlib.contextmanager
+def timed_lock(lock, name: str):
+    """ Toma el lock registrando en LOCK_WAIT cuanto se espero por el """
+    start = time.monotonic()
+    with lock:
+        LOCK_WAIT.observe(time.monotonic() - start, name)
+        yield
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+
+from common import log_queue
+from common.checkpoint import CHECKPOINT_FILEPATH, SHARED_WINNERS_FILEPATH, Checkpointer
+from common.lottery import Lottery, number_of_agencies
+from common.server import Server
+
+
+class MultiprocessServer:
+    """
+    Levanta N procesos worker que aceptan en el mismo puerto con SO_REUSEPORT,
+    de forma que la ingesta de apuestas corre en paralelo en varios cores.
+
+    El estado del sorteo (agencias listas y si el sorteo ya se hizo) vive en
+    memoria compartida y se protege con locks entre procesos, por lo que
+    READY y WINNERS dan la misma respuesta en cualquier worker. El worker que
+    hace el sorteo recorre el almacenamiento y deja los ganadores en
+    SHARED_WINNERS_FILEPATH, de donde los leen los demas.
+
+    Si un worker termina con error (por ejemplo si no puede escuchar en el
+    puerto) se detienen los demas y el proceso principal termina con error.
+
+    Las metricas son de cada proceso: con metrics_port en server_kwargs, el
+    worker i las sirve en metrics_port + i.
+
+    Con checkpoint_interval > 0 el proceso principal guarda el checkpoint del
+    estado compartido (ver Checkpointer) y lo retoma antes de levantar los
+    workers, que recuperan sus ganadores desde el.
+    """
+    def __init__(self, port, listen_backlog, processes, server_kwargs=None, checkpoint_interval=0,
+                 shared_winners_path=SHARED_WINNERS_FILEPATH):
+        self._port = port
+        self._listen_backlog = listen_backlog
+        self._processes_amount = processes if processes > 0 else os.cpu_count()
+        self._server_kwargs = server_kwargs or {}
+
+        self._agencies = multiprocessing.Array('b', number_of_agencies())
+        self._draw_flag = multiprocessing.Value('b', False)
+        self._lottery_lock = multiprocessing.Lock()
+        self._bets_lock = multiprocessing.Lock()
+
+        # los ganadores de una ronda anterior no valen para esta
+        self._shared_winners_path = shared_winners_path
+        if os.path.exists(shared_winners_path):
+            os.remove(shared_winners_path)
+
+        self._checkpoint_path = CHECKPOINT_FILEPATH if checkpoint_interval > 0 else None
+        lottery = Lottery(self._agencies, self._draw_flag, self._checkpoint_path)
+        lottery.restore_checkpoint()
+        self._checkpointer = Checkpointer(lottery, checkpoint_interval) if checkpoint_interval > 0 else None
+
+        self._processes = []
+        self._running = True
+
+    def run(self):
+        for i in range(self._processes_amount):
+            process = multiprocessing.Process(target=self._worker_main, args=(i,), name=f"server-{i}")
+            process.start()
+            self._processes.append(process)
+        logging.info(f'action: start_workers | result: success | processes: {self._processes_amount}')
+
+        self._setup_signal_handlers()
+        if self._checkpointer:
+            self._checkpointer.start()
+
+        failed = self._wait_workers()
+        if self._checkpointer:
+            self._checkpointer.stop()
+        if failed:
+            logging.error(f'action: exit | result: fail | failed_workers: {failed}')
+            sys.exit(1)
+        logging.info('action: exit | result: success')
+
+    def _wait_workers(self) -> int:
+        """
+        Espera a que terminen todos los workers. Si uno termina con error
+        detiene a los demas. Retorna cuantos terminaron con error
+        """
+        failed = 0
+        pending = {process.sentinel: process for process in self._processes}
+        while pending:
+            for sentinel in multiprocessing.connection.wait(list(pending)):
+                process = pending.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    failed += 1
+                    logging.error(f'action: worker_exit | result: fail | worker: {process.name} | exitcode: {process.exitcode}')
+                    self._shutdown()
+        return failed
+
+    def _worker_main(self, index):
+        lottery = Lottery(self._agencies, self._draw_flag, self._checkpoint_path, self._shared_winners_path)
+        server_kwargs = dict(self._server_kwargs)
+        if server_kwargs.get("metrics_port", 0) > 0:
+            server_kwargs["metrics_port"] += index
+        server = Server(self._port, self._listen_backlog, reuse_port=True, lottery=lottery,
+                        lottery_lock=self._lottery_lock, bets_lock=self._bets_lock,
+                        **server_kwargs)
+        try:
+            server.run()
+        finally:
+            # el proceso termina sin correr atexit: se escriben los logs encolados
+            log_queue.stop()
+
+    def _setup_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        signal.signal(signal.SIGINT, self._signal_handler)
+
+    def _signal_handler(self, signum, frame):
+        signal_name = signal.Signals(signum).name
+        logging.info(f'action: shutdown_signal | result: in_progress | signal: {signal_name}')
+        self._shutdown()
+
+    def _shutdown(self):
+        if not self._running:
+            return
+        self._running = False
+        logging.info('action: graceful_shutdown | result: in_progress')
+        # cada worker hace su propio cierre ordenado al recibir SIGTERM
+        for process in self._processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
@@ -1,7 +1,18 @@
+import os
 import struct
 import socket
+import threading
+import weakref
+import zlib
 from enum import IntEnum
-from typing import Tuple
+from typing import List, Optional, Tuple, Union
+
+from common import metrics
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 class OperationCode(IntEnum):
     """Enum para códigos de operación"""
@@ -12,21 +23,63 @@ class OperationCode(IntEnum):
     WINNERS = 5
     NOT_READY = 6
     READY = 7
+    BATCH_BINARY = 8
+    HANDSHAKE = 9
+    SUBSCRIBE = 10
+    LOOKUP = 11
+
+""" Operaciones cuyo mensaje es binario y no se decodifica como UTF-8 """
+BINARY_OPERATIONS = frozenset({OperationCode.BATCH_BINARY})
+
+""" Capacidades que se pueden negociar con HANDSHAKE (separadas por coma) """
+BINARY_BATCH_CAPABILITY = "BINARY_BATCH"
+SUBSCRIBE_WINNERS_CAPABILITY = "SUBSCRIBE_WINNERS"
+SESSION_CAPABILITY = "SESSION"
+BATCH_WINDOW_CAPABILITY = "BATCH_WINDOW"
+COMPRESSION_CAPABILITY = "COMPRESSION"
+
+""" Operaciones cuyo mensaje se comprime si se negocio COMPRESSION """
+COMPRESSIBLE_OPERATIONS = frozenset({OperationCode.BATCH, OperationCode.BATCH_BINARY, OperationCode.WINNERS, OperationCode.LOOKUP})
+""" Tamaño minimo (bytes) del mensaje a partir del cual se comprime """
+COMPRESSION_THRESHOLD = 1024
 
 class SerializationError(Exception):
     """Excepción para errores de serialización"""
     pass
 
+class ConnectionClosed(SerializationError):
+    """El peer cerró la conexión entre dos mensajes"""
+    pass
+
 class SimpleProtocol:
     """
     Protocolo simple de serialización:
     - 1 byte: código de operación (enum)
     - 4 bytes: longitud del mensaje (int, big endian)
-    - N bytes: mensaje (string en UTF-8)
+    - N bytes: mensaje (string en UTF-8, o binario para BINARY_OPERATIONS)
+
+    En una sesión (capacidad SESSION) cada mensaje empieza con un request id
+    (4 bytes, big endian) que se incluye en la longitud. La respuesta lleva el
+    request id del pedido, lo que permite enviar varios pedidos sin esperar
+    cada respuesta.
+
+    Si se negocio COMPRESSION, los mensajes de COMPRESSIBLE_OPERATIONS de al
+    menos COMPRESSION_THRESHOLD bytes se envian comprimidos con zlib y con
+    COMPRESSED_FLAG en el byte del código de operación. Se comprime el cuerpo
+    completo, request id incluido, y la longitud es la del cuerpo comprimido.
+    Un mensaje comprimido en una conexión que no negoció COMPRESSION es un error.
     """
     
     HEADER_SIZE = 5
+    REQUEST_ID = struct.Struct('>I')
     MAX_MESSAGE_SIZE = 2**32 - 1
+    COMPRESSED_FLAG = 0x80
+    COMPRESSION_LEVEL = 1
+    """
+    Tamaño maximo de un mensaje descomprimido: un lote ocupa unos pocos KB, y
+    el limite evita que un mensaje chico se expanda a cientos de MB
+    """
+    MAX_INFLATED_SIZE = 16 * 1024 * 1024
     
 
     @staticmethod
@@ -41,121 +94,376 @@ class SimpleProtocol:
         Raises:
             SerializationError: Si hay error en el envío
         """
+        view = memoryview(data)
         total_sent = 0
-        data_length = len(data)
+        data_length = len(view)
         
         while total_sent < data_length:
             try:
-                sent = sock.send(data[total_sent:])
+                sent = sock.send(view[total_sent:])
                 if sent == 0:
                     raise SerializationError("Conexión cerrada por el peer durante envío")
                 total_sent += sent
             except socket.error as e:
                 raise SerializationError(f"Error al enviar datos al socket: {e}")
 
+    @staticmethod
+    def _send_buffers(sock: socket.socket, buffers: List[bytes]) -> None:
+        """
+        Envía varios buffers con una única llamada a sendmsg (scatter/gather),
+        retomando los envíos parciales con offsets de memoryview en lugar de
+        volver a copiar lo que falta enviar.
+        
+        Args:
+            sock: Socket para enviar los datos
+            buffers: Buffers a enviar, en orden
+            
+        Raises:
+            SerializationError: Si hay error en el envío
+        """
+        if not hasattr(sock, 'sendmsg'):
+            for data in buffers:
+                SimpleProtocol._send_all(sock, data)
+            return
+
+        views = [memoryview(data) for data in buffers if len(data) > 0]
+        first = 0
+        while first < len(views):
+            try:
+                sent = sock.sendmsg(views[first:first + IOV_MAX])
+            except socket.error as e:
+                raise SerializationError(f"Error al enviar datos al socket: {e}")
+            if sent == 0:
+                raise SerializationError("Conexión cerrada por el peer durante envío")
+
+            # avanza sobre los buffers enviados completos y recorta el parcial
+            while sent > 0:
+                pending = len(views[first])
+                if sent >= pending:
+                    sent -= pending
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
 
     @staticmethod
-    def serialize_to_socket(sock: socket.socket, op_code: OperationCode, message: str) -> None:
+    def encode_frame_parts(op_code: OperationCode, message: Union[str, bytes], request_id: Optional[int] = None, compress: bool = False) -> Tuple[bytes, bytes]:
         """
-        Serializa los datos según el protocolo.
+        Codifica un mensaje según el protocolo, sin unir header y payload.
         
         Args:
             op_code: Código de operación del enum
-            message: Mensaje string a serializar
+            message: Mensaje string a serializar, o bytes ya codificados
+            request_id: Request id del mensaje dentro de una sesión (va al final del header)
+            compress: Si se negocio COMPRESSION con el peer
             
         Returns:
-            bytes: Datos serializados
+            Tuple[bytes, bytes]: Header y payload serializados
             
         Raises:
             SerializationError: Si hay error en la serialización
         """
         try:
-            message_bytes = message.encode('utf-8')
+            if isinstance(message, (bytes, bytearray, memoryview)):
+                message_bytes = message
+            else:
+                message_bytes = message.encode('utf-8')
+
+            if compress and op_code in COMPRESSIBLE_OPERATIONS and len(message_bytes) >= COMPRESSION_THRESHOLD:
+                if request_id is not None:
+                    message_bytes = SimpleProtocol.REQUEST_ID.pack(request_id) + message_bytes
+                compressed = zlib.compress(message_bytes, SimpleProtocol.COMPRESSION_LEVEL)
+                if len(compressed) < len(message_bytes):
+                    header = struct.pack('>BI', int(op_code) | SimpleProtocol.COMPRESSED_FLAG, len(compressed))
+                    return header, compressed
+                # no se achica: se envia sin comprimir
+                if request_id is not None:
+                    message_bytes = memoryview(message_bytes)[SimpleProtocol.REQUEST_ID.size:]
+
             message_length = len(message_bytes)
+            if request_id is not None:
+                message_length += SimpleProtocol.REQUEST_ID.size
             
             if message_length > SimpleProtocol.MAX_MESSAGE_SIZE:
                 raise SerializationError(f"Mensaje demasiado largo: {message_length} bytes")
             
             header = struct.pack('>BI', int(op_code), message_length)
+            if request_id is not None:
+                header += SimpleProtocol.REQUEST_ID.pack(request_id)
             
-            complete_message = header + message_bytes
-            SimpleProtocol._send_all(sock, complete_message)
+            return header, message_bytes
             
-        except (UnicodeEncodeError, struct.error) as e:
+        except (UnicodeEncodeError, struct.error, zlib.error) as e:
             raise SerializationError(f"Error al serializar: {e}")
-    
+
     @staticmethod
-    def _read_exact(fd: socket.socket, num_bytes: int) -> bytes:
+    def decode_header(header: bytes) -> Tuple[OperationCode, int, bool]:
         """
-        Lee exactamente num_bytes del file descriptor, manejando short reads.
+        Decodifica el header de un mensaje.
         
         Args:
-            fd: Socket o file descriptor para leer
-            num_bytes: Número exacto de bytes a leer
+            header: HEADER_SIZE bytes leídos del peer
             
         Returns:
-            bytes: Datos leídos
+            Tuple[OperationCode, int, bool]: Código de operación, longitud del
+            mensaje y si el mensaje está comprimido
             
         Raises:
-            SerializationError: Si no se pueden leer todos los bytes
+            SerializationError: Si el header es inválido
         """
-        data = b''
-        while len(data) < num_bytes:
-            try:
-                chunk = fd.recv(num_bytes - len(data))
-                
-                if not chunk:
-                    raise SerializationError(f"Conexión cerrada o EOF: solo se leyeron {len(data)}/{num_bytes} bytes")
-                
-                data += chunk
-                
-            except socket.error as e:
-                raise SerializationError(f"Error al leer desde socket: {e}")
-            except IOError as e:
-                raise SerializationError(f"Error al leer desde file descriptor: {e}")
+        try:
+            op_code_raw, message_length = struct.unpack('>BI', header)
+        except struct.error as e:
+            raise SerializationError(f"Error al deserializar: {e}")
+
+        compressed = bool(op_code_raw & SimpleProtocol.COMPRESSED_FLAG)
+        op_code_raw &= ~SimpleProtocol.COMPRESSED_FLAG
+
+        # Convertir código de operación a enum
+        try:
+            op_code = OperationCode(op_code_raw)
+        except ValueError:
+            raise SerializationError(f"Código de operación inválido: {op_code_raw}")
+
+        # Verificar tamaño razonable
+        if message_length > SimpleProtocol.MAX_MESSAGE_SIZE:
+            raise SerializationError(f"Mensaje demasiado largo: {message_length} bytes")
+
+        return op_code, message_length, compressed
+
+    @staticmethod
+    def inflate(body) -> bytes:
+        """
+        Descomprime el cuerpo de un mensaje marcado con COMPRESSED_FLAG.
+
+        Raises:
+            SerializationError: Si el cuerpo no es zlib válido o descomprimido
+            supera MAX_INFLATED_SIZE
+        """
+        decompressor = zlib.decompressobj()
+        try:
+            inflated = decompressor.decompress(body, SimpleProtocol.MAX_INFLATED_SIZE)
+        except zlib.error as e:
+            raise SerializationError(f"Error al descomprimir: {e}")
+        if decompressor.unconsumed_tail:
+            raise SerializationError(f"Mensaje descomprimido demasiado largo: más de {SimpleProtocol.MAX_INFLATED_SIZE} bytes")
+        if not decompressor.eof:
+            raise SerializationError("Mensaje comprimido incompleto")
+        return inflated
+
+    @staticmethod
+    def serialize_to_socket(sock: socket.socket, op_code: OperationCode, message: Union[str, bytes], request_id: Optional[int] = None, compress: bool = False) -> None:
+        """
+        Serializa los datos según el protocolo y los envía al socket.
+        
+        Args:
+            sock: Socket para enviar los datos
+            op_code: Código de operación del enum
+            message: Mensaje string a serializar, o bytes ya codificados
+            request_id: Request id de la respuesta dentro de una sesión
+            compress: Si se negocio COMPRESSION con el peer
+            
+        Raises:
+            SerializationError: Si hay error en la serialización o el envío
+        """
+        header, message_bytes = SimpleProtocol.encode_frame_parts(op_code, message, request_id, compress)
+        SimpleProtocol._send_buffers(sock, [header, message_bytes])
+        metrics.record_frame('out', op_code, len(header) + len(message_bytes))
+
+    @staticmethod
+    def send_frames(sock: socket.socket, frames: List[Tuple[OperationCode, Union[str, bytes], Optional[int]]], compress: bool = False) -> None:
+        """
+        Serializa varios mensajes (código de operación, mensaje, request id)
+        y los envía en orden con una sola llamada al sistema.
         
-        return data
+        Raises:
+            SerializationError: Si hay error en la serialización o el envío
+        """
+        buffers = []
+        for op_code, message, request_id in frames:
+            buffers.extend(SimpleProtocol.encode_frame_parts(op_code, message, request_id, compress))
+        SimpleProtocol._send_buffers(sock, buffers)
+        for (op_code, _, _), header, message_bytes in zip(frames, buffers[::2], buffers[1::2]):
+            metrics.record_frame('out', op_code, len(header) + len(message_bytes))
     
     @staticmethod
-    def deserialize_from_socket(fd: socket.socket) -> Tuple[OperationCode, str]:
+    def deserialize_from_socket(fd: socket.socket, allow_compressed: bool = False) -> Tuple[OperationCode, str]:
         """
         Deserializa datos leyendo directamente desde un socket.
         Args:
             fd: Socket para leer
+            allow_compressed: Si la conexión negoció COMPRESSION
 
         Returns:
-            Tuple[OperationCode, str]: Código de operación y mensaje
+            Tuple[OperationCode, str]: Código de operación y mensaje. Para las
+            BINARY_OPERATIONS el mensaje es un memoryview válido hasta la
+            siguiente lectura del socket
             
         Raises:
             SerializationError: Si hay error en la lectura o deserialización
         """
+        op_code, body = _frame_reader_for(fd).read_frame(fd, allow_compressed)
+        return op_code, SimpleProtocol.decode_message(op_code, body)
+
+    @staticmethod
+    def deserialize_session_from_socket(fd: socket.socket, allow_compressed: bool = False) -> Tuple[OperationCode, int, str]:
+        """
+        Como deserialize_from_socket, para mensajes de una sesión.
+
+        Returns:
+            Tuple[OperationCode, int, str]: Código de operación, request id y mensaje
+
+        Raises:
+            ConnectionClosed: Si el peer cerró la conexión entre dos mensajes
+            SerializationError: Si hay error en la lectura o deserialización
+        """
+        op_code, body = _frame_reader_for(fd).read_frame(fd, allow_compressed)
+        return (op_code, *SimpleProtocol.decode_session_message(op_code, body))
+
+    @staticmethod
+    def has_buffered_frame(fd: socket.socket) -> bool:
+        """
+        Indica si ya hay un mensaje completo leído del socket, que se puede
+        deserializar sin bloquear
+        """
+        return _frame_reader_for(fd).has_frame()
+
+    @staticmethod
+    def decode_session_message(op_code: OperationCode, body) -> Tuple[int, Union[str, memoryview]]:
+        """
+        Separa el request id del cuerpo de un mensaje de sesión y decodifica el resto.
+
+        Raises:
+            SerializationError: Si el mensaje no tiene request id o no es válido
+        """
+        if len(body) < SimpleProtocol.REQUEST_ID.size:
+            raise SerializationError("Mensaje de sesión sin request id")
+        request_id, = SimpleProtocol.REQUEST_ID.unpack_from(body)
+        return request_id, SimpleProtocol.decode_message(op_code, memoryview(body)[SimpleProtocol.REQUEST_ID.size:])
+
+    @staticmethod
+    def decode_message(op_code: OperationCode, body) -> Union[str, memoryview]:
+        """
+        Decodifica el cuerpo de un mensaje: UTF-8 para las operaciones de texto,
+        sin modificar para las BINARY_OPERATIONS.
+        
+        Raises:
+            SerializationError: Si el mensaje no es UTF-8 válido
+        """
+        if op_code in BINARY_OPERATIONS:
+            return memoryview(body)
         try:
-            # Leer header (5 bytes)
-            header = SimpleProtocol._read_exact(fd, SimpleProtocol.HEADER_SIZE)
-            
-            # Extraer información del header
-            op_code_raw, message_length = struct.unpack('>BI', header)
-            
-            # Convertir código de operación a enum
-            try:
-                op_code = OperationCode(op_code_raw)
-            except ValueError:
-                raise SerializationError(f"Código de operación inválido: {op_code_raw}")
-            
-            # Leer el mensaje si tiene contenido
-            if message_length == 0:
-                return op_code, ""
-            
-            # Verificar tamaño razonable
-            if message_length > SimpleProtocol.MAX_MESSAGE_SIZE:
-                raise SerializationError(f"Mensaje demasiado largo: {message_length} bytes")
-            
-            # Leer mensaje completo
-            message_bytes = SimpleProtocol._read_exact(fd, message_length)
-            message = message_bytes.decode('utf-8')
-            
-            return op_code, message
-            
-        except (struct.error, UnicodeDecodeError) as e:
+            return str(body, 'utf-8')
+        except UnicodeDecodeError as e:
             raise SerializationError(f"Error al deserializar: {e}")
-    
\ No newline at end of file
+
+
+class FrameReader:
+    """
+    Lector de mensajes con buffer propio por conexión.
+
+    Lee del socket en bloques grandes con recv_into sobre un bytearray y
+    parsea todos los mensajes completos que haya en el buffer, sin volver a
+    leer del socket mientras queden mensajes pendientes. El cuerpo de cada
+    mensaje se entrega como un memoryview sobre el buffer (sin copias), que
+    es válido hasta la siguiente llamada a read_frame.
+    """
+
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def buffered_bytes(self) -> int:
+        return self._end - self._start
+
+    def read_frame(self, sock: socket.socket, allow_compressed: bool = False) -> Tuple[OperationCode, memoryview]:
+        """
+        Retorna el próximo mensaje, leyendo del socket solo si el buffer no
+        contiene un mensaje completo. Si allow_compressed (la conexión negoció
+        COMPRESSION), un mensaje comprimido se entrega ya descomprimido, en
+        bytes propios.
+
+        Raises:
+            SerializationError: Si hay error en la lectura, el peer cierra la
+            conexión o el mensaje está comprimido sin allow_compressed
+        """
+        self._fill(sock, SimpleProtocol.HEADER_SIZE)
+        op_code, message_length, compressed = SimpleProtocol.decode_header(
+            self._view[self._start:self._start + SimpleProtocol.HEADER_SIZE])
+        if compressed and not allow_compressed:
+            raise SerializationError("Mensaje comprimido sin haber negociado COMPRESSION")
+
+        frame_size = SimpleProtocol.HEADER_SIZE + message_length
+        self._fill(sock, frame_size)
+        body_start = self._start + SimpleProtocol.HEADER_SIZE
+        self._start += frame_size
+        metrics.record_frame('in', op_code, frame_size)
+        body = self._view[body_start:self._start]
+        return op_code, SimpleProtocol.inflate(body) if compressed else body
+
+    def has_frame(self) -> bool:
+        """ Indica si el buffer contiene un mensaje completo """
+        if self.buffered_bytes() < SimpleProtocol.HEADER_SIZE:
+            return False
+        _, message_length, _ = SimpleProtocol.decode_header(
+            self._view[self._start:self._start + SimpleProtocol.HEADER_SIZE])
+        return self.buffered_bytes() >= SimpleProtocol.HEADER_SIZE + message_length
+
+    def _fill(self, sock: socket.socket, num_bytes: int) -> None:
+        """
+        Garantiza que haya al menos num_bytes en el buffer a partir de _start
+        """
+        if self.buffered_bytes() >= num_bytes:
+            return
+        self._make_room(num_bytes)
+        while self.buffered_bytes() < num_bytes:
+            try:
+                read = sock.recv_into(self._view[self._end:])
+            except socket.timeout:
+                # la conexion sin actividad la cierra quien lee
+                raise
+            except socket.error as e:
+                raise SerializationError(f"Error al leer desde socket: {e}")
+            if read == 0:
+                if self.buffered_bytes() == 0:
+                    raise ConnectionClosed("Conexión cerrada por el peer")
+                raise SerializationError(f"Conexión cerrada o EOF: solo se leyeron {self.buffered_bytes()}/{num_bytes} bytes")
+            self._end += read
+
+    def _make_room(self, num_bytes: int) -> None:
+        """
+        Compacta el buffer (o lo agranda) para que entren num_bytes desde _start
+        """
+        pending = self.buffered_bytes()
+        if num_bytes > len(self._buffer):
+            # los memoryview entregados siguen apuntando al buffer anterior
+            new_buffer = bytearray(max(num_bytes, 2 * len(self._buffer)))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = new_buffer
+            self._view = memoryview(new_buffer)
+        elif self._start + num_bytes > len(self._buffer) or pending == 0:
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            return
+        self._start = 0
+        self._end = pending
+
+
+_frame_readers = weakref.WeakKeyDictionary()
+_frame_readers_lock = threading.Lock()
+
+def _frame_reader_for(sock: socket.socket) -> FrameReader:
+    """
+    Retorna el FrameReader asociado al socket, creándolo si no existe.
+    Se libera junto con el socket.
+    """
+    with _frame_readers_lock:
+        reader = _frame_readers.get(sock)
+        if reader is None:
+            reader = FrameReader()
+            _frame_readers[sock] = reader
+        return reader
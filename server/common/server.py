@@ -2,33 +2,81 @@ import socket
 import logging
 import signal
 import threading
-from time import time
 
-from common.client_handler import ClientHandler
+from common import metrics
+from common.checkpoint import CHECKPOINT_FILEPATH, Checkpointer
+from common.client_handler import DEFAULT_IDLE_TIMEOUT, ClientHandler, create_bets_writer, log_stage_stats, stage_metrics, start_draw
 from common.lottery import Lottery
 from common.protocol_uitls import OperationCode, SimpleProtocol
+from common.winners_notifier import WinnersNotifier
+from common.worker_pool import WorkerPool
 
 
-MAX_THREADS = 10
+DEFAULT_WORKERS = 10
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_QUEUE_TIMEOUT = 10
+DEFAULT_GROUP_COMMIT_MAX_BETS = 10000
+DEFAULT_INGESTION_QUEUE_SIZE = 100
 SHUTDOWN_WAIT_TIME = 30  
+ACCEPT_POLL_INTERVAL = 0.5
 
 class Server:
-    def __init__(self, port, listen_backlog):
+    def __init__(self, port, listen_backlog, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 reuse_port=False, lottery=None, lottery_lock=None, bets_lock=None,
+                 group_commit_window=None, group_commit_max_bets=DEFAULT_GROUP_COMMIT_MAX_BETS,
+                 ingestion_parsers=0, ingestion_queue_size=DEFAULT_INGESTION_QUEUE_SIZE, metrics_port=0,
+                 metrics_host=metrics.DEFAULT_METRICS_HOST, checkpoint_interval=0, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        reuse_port permite que varios procesos acepten en el mismo puerto (SO_REUSEPORT).
+        lottery, lottery_lock y bets_lock pueden inyectarse para compartir el estado
+        del sorteo entre procesos; por defecto son locales al proceso.
+        group_commit_window (segundos) habilita la escritura de apuestas con group
+        commit; None las escribe directamente desde cada conexion.
+        ingestion_parsers > 0 parsea los lotes en un pool de parsers separado de
+        la lectura y de la escritura (ver IngestionPipeline).
+        metrics_port > 0 sirve las metricas del proceso en ese puerto y en la interfaz
+        metrics_host (ver MetricsServer).
+        checkpoint_interval > 0 guarda el estado de la loteria cada esa cantidad de
+        segundos y lo retoma al iniciar (ver Checkpointer); no aplica si se inyecta la loteria.
+        idle_timeout (segundos) cierra las conexiones que no envian nada en ese
+        tiempo, liberando su worker; 0 las espera indefinidamente
+        """
         # Initialize server socket
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._server_socket.bind(('', port))
         self._server_socket.listen(listen_backlog)
+        # una señal puede llegarle a otro hilo del proceso, y eso no interrumpe el accept:
+        # el hilo principal deja de esperar cada tanto para atender las señales pendientes
+        self._server_socket.settimeout(ACCEPT_POLL_INTERVAL)
+
+        self._checkpointer = None
+        if lottery is None:
+            lottery = Lottery(checkpoint_path=CHECKPOINT_FILEPATH if checkpoint_interval > 0 else None)
+            # retoma el estado y los ganadores de las apuestas guardadas antes de un reinicio
+            lottery.recover_winners()
+            lottery.restore_checkpoint()
+            if checkpoint_interval > 0:
+                self._checkpointer = Checkpointer(lottery, checkpoint_interval)
+        self._lottery = lottery
+
+        self._idle_timeout = idle_timeout
+        self._running = True
+        self._pool = WorkerPool(workers, queue_size, queue_timeout,
+                                self.__handle_client_connection, self._send_server_busy)
 
-        self._lottery = Lottery()
+        self._lottery_lock = lottery_lock if lottery_lock is not None else threading.Lock()
 
-        self._running = True
-        self._active_threads = []
-        self._thread_lock = threading.Lock()
+        self._bets_lock = bets_lock if bets_lock is not None else threading.Lock()
 
-        self._lottery_lock = threading.Lock()
+        self._bets_writer = create_bets_writer(self._bets_lock, self._lottery, group_commit_window, group_commit_max_bets,
+                                               ingestion_parsers, ingestion_queue_size)
 
-        self._bets_lock = threading.Lock()
+        # agencias que esperan los ganadores con la conexion abierta
+        self._winners_notifier = WinnersNotifier(self._lottery, self._lottery_lock)
 
+        self._metrics_server = metrics.MetricsServer(metrics_port, host=metrics_host) if metrics_port > 0 else None
 
         self._setup_signal_handlers()
 
@@ -54,49 +102,45 @@ class Server:
             except Exception as e:
                 logging.error(f'action: close_server_socket | result: fail | error: {e}')
 
-    def _cleanup_finished_threads(self):
-        """Limpia los hilos que ya terminaron"""
-        with self._thread_lock:
-            self._active_threads = [t for t in self._active_threads if t.is_alive()]
+    def pool_stats(self) -> dict:
+        """Retorna las metricas de la cola de admision y del pool de workers"""
+        return self._pool.stats()
 
-    def _get_active_thread_count(self):
-        """Retorna el número de hilos activos"""
-        with self._thread_lock:
-            return len([t for t in self._active_threads if t.is_alive()])
-        
+    def _collect_metrics(self) -> list:
+        stats = self._pool.stats()
+        samples = [
+            ("lottery_admission_queue_depth", "Conexiones en la cola de admision", {}, stats["queue_depth"]),
+            ("lottery_busy_workers", "Workers atendiendo una conexion", {}, stats["busy_workers"]),
+        ]
+        if self._bets_writer:
+            samples.extend(stage_metrics(self._bets_writer))
+        return samples
 
     def run(self):
         """
-        Dummy Server loop
+        Server loop
 
-        Server that accept a new connections and establishes a
-        communication with a client. After client with communucation
-        finishes, servers starts to accept new connections again
+        Accepts new connections and hands them to the worker pool. Connections
+        wait in the admission queue until a worker is free, and are only
+        rejected if their queue deadline expires
         """
-
-        # TODO: Modify this program to handle signal to graceful shutdown
-        # the server
+        if self._bets_writer:
+            self._bets_writer.start()
+        self._winners_notifier.start()
+        if self._checkpointer:
+            self._checkpointer.start()
+        self._pool.start()
+        if self._metrics_server:
+            metrics.REGISTRY.register_collector(self._collect_metrics)
+            self._metrics_server.start()
         while self._running:
             try:
-                self._cleanup_finished_threads()
-                
                 client_sock = self.__accept_new_connection()
                 if not self._running:
                     client_sock.close()
                     break
 
-                current_thread_count = self._get_active_thread_count()
-                if current_thread_count >= MAX_THREADS:
-                    self._send_max_threads_reached(client_sock)
-                    logging.warning('action: rechazo_conexion | result: success | reason: max_threads_reached')
-                    continue
-
-                client_thread = threading.Thread(target=self.__handle_client_connection, args=(client_sock,), daemon=True)
-
-                with self._thread_lock:
-                    self._active_threads.append(client_thread)
-                
-                client_thread.start()
+                self._pool.submit(client_sock)
 
             except OSError as e:
                 if not self._running:
@@ -107,13 +151,14 @@ class Server:
         self._cleanup()
 
     """
-    send a message to client indicating that max threads has been reached
+    send a message to client indicating that the server is busy
     closes the client socket after sending the message
     """
-    def _send_max_threads_reached(self, client_sock):
+    def _send_server_busy(self, client_sock):
+        metrics.REJECTED_CONNECTIONS.inc()
         try:
-            SimpleProtocol.serialize_to_socket(client_sock, OperationCode.ERROR, "Max threads reached. Try again later.")
-            logging.warning('action: rechazo_conexion | result: success | reason: max_threads_reached')
+            SimpleProtocol.serialize_to_socket(client_sock, OperationCode.ERROR, "Server busy. Try again later.")
+            logging.warning('action: rechazo_conexion | result: success | reason: queue_timeout')
         except Exception as e:
             logging.error(f'action: rechazo_conexion | result: fail | error: {e}')
         finally:
@@ -125,21 +170,30 @@ class Server:
 
         logging.info('action: waiting_for_threads | result: in_progress')
 
-        with self._thread_lock:
-            active_threads = [t for t in self._active_threads if t.is_alive()]
+        remaining_workers = self._pool.shutdown(SHUTDOWN_WAIT_TIME)
+        if remaining_workers:
+            logging.warning(f'action: thread_cleanup | result: timeout | remaining_threads: {remaining_workers}')
+        else:
+            logging.info('action: thread_cleanup | result: success')
 
-        start_time = time.time()
+        if self._bets_writer:
+            self._bets_writer.stop(SHUTDOWN_WAIT_TIME)
+            log_stage_stats(logging, self._bets_writer)
 
-        while active_threads and (time.time() - start_time) < SHUTDOWN_WAIT_TIME:
-            for t in active_threads:
-                t.join(timeout=1)
-            if not t.is_alive():
-                active_threads.remove(t)
-                logging.info(f'action: thread_cleanup | result: success | thread_id: {t.ident}')
+        if self._checkpointer:
+            # con los lotes pendientes ya guardados
+            self._checkpointer.stop()
 
-        if active_threads:
-            logging.warning(f'action: thread_cleanup | result: timeout | remaining_threads: {len(active_threads)}')
-        
+        self._winners_notifier.stop()
+
+        stats = self._pool.stats()
+        logging.info(f'action: worker_pool_stats | result: success | dispatched: {stats["dispatched"]} | '
+                     f'rejected: {stats["rejected"]} | max_queue_depth: {stats["max_queue_depth"]} | '
+                     f'avg_wait_time: {stats["avg_wait_time"]:.3f} | max_wait_time: {stats["max_wait_time"]:.3f}')
+
+        if self._metrics_server:
+            self._metrics_server.stop()
+            metrics.REGISTRY.unregister_collector(self._collect_metrics)
 
         if self._server_socket:
             try:
@@ -151,22 +205,26 @@ class Server:
 
     def __handle_client_connection(self, client_sock):
         """
-        Read message from a specific client socket and closes the socket
+        Read message from a specific client socket and closes the socket,
+        unless the client subscribed to the winners
 
         If a problem arises in the communication with the client, the
         client socket will also be closed
         """
+        subscribed = False
+        metrics.ACTIVE_CONNECTIONS.inc()
         try:
-            ClientHandler.handle_client(client_sock, logging, self._lottery, self._lottery_lock, self._bets_lock)
-            with self._lottery_lock:
-                if self._lottery.all_agencies_ready() and not self._lottery.draw_done(): 
-                    self._lottery.make_draw()
-                    logging.info('action: sorteo | result: success')
+            subscribed = ClientHandler.handle_client(client_sock, logging, self._lottery, self._lottery_lock,
+                                                     self._bets_lock, self._bets_writer, self._winners_notifier,
+                                                     self._idle_timeout)
+            start_draw(self._lottery, logging, self._lottery_lock, self._winners_notifier)
         
         except Exception as e:
             logging.error(f'action: handle_client | result: fail | error: {e}')
         finally:
-            client_sock.close()
+            metrics.ACTIVE_CONNECTIONS.dec()
+            if not subscribed:
+                client_sock.close()
 
     def __accept_new_connection(self):
         """
@@ -178,6 +236,11 @@ class Server:
 
         # Connection arrived
         logging.info('action: accept_connections | result: in_progress')
-        c, addr = self._server_socket.accept()
-        logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
+        while True:
+            try:
+                c, addr = self._server_socket.accept()
+                break
+            except socket.timeout:
+                continue
+        logging.info('action: accept_connections | result: success | ip: %s', addr[0])
         return c
@@ -0,0 +1,35 @@
+import threading
+
+
+class StageStats:
+    """
+    Metricas de una etapa del pipeline de ingesta.
+    La latencia de cada item se mide desde que entra a la cola de la etapa
+    hasta que la etapa lo termina de procesar.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record_enqueue(self, queue_depth):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_done(self, latency):
+        with self._lock:
+            self.processed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def snapshot(self, queue_depth) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "processed": self.processed,
+                "avg_latency": self.total_latency / self.processed if self.processed else 0.0,
+                "max_latency": self.max_latency,
+            }
@@ -0,0 +1,665 @@
+import csv
+import datetime
+import io
+import mmap
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from common import utils
+
+
+""" Available storage backends, selected with STORAGE_BACKEND. """
+CSV_BACKEND = "csv"
+BINARY_BACKEND = "binary"
+
+""" Amount of bets per BetBatch returned by load_batches. """
+DEFAULT_CHUNK_SIZE = 65536
+
+""" Minimum size of the chunks returned by split_chunks, in bytes. """
+MIN_SPLIT_BYTES = 1 << 20
+
+""" Prefix of the layout of the sharded storage (see layout). """
+SHARDED_LAYOUT = "sharded"
+
+""" Directory of the sharded storage, next to STORAGE_FILEPATH. """
+SHARDS_DIRECTORY = "shards"
+""" Threads reading shards at the same time in the sharded storage. """
+DEFAULT_SHARD_READERS = 4
+
+
+"""
+Stores bets as CSV rows in a single file (the original format), plus an
+append-only <path without extension>.document.idx with (hash of the
+document, row offset) postings, so load_by_document only reads the rows it
+needs. The index is built from the file if it is missing.
+Every backend stores and loads BetBatch objects; Bet objects are only built
+by load, load_by_agency, load_by_number and load_by_document.
+
+position() returns how far the storage goes (here, the offset after the last
+complete row) as a JSON-serializable value. layout() identifies the format
+of those positions, and load_batches_between reads the bets stored between
+two positions, None being the beginning of the storage.
+"""
+class CsvBetStorage:
+    LOCKS_SHARDS = False
+    INDEXED = False
+
+    DOCUMENT_POSTING = struct.Struct('<IQ')
+
+    def __init__(self, path: str, fsync: bool = False):
+        self._path = path
+        self._fsync = fsync
+        self._document_index = _PostingsIndex(os.path.splitext(path)[0] + '.document.idx', self.DOCUMENT_POSTING, 'Q')
+        if _file_size(path) == 0:
+            # the index of a removed file
+            _remove(self._document_index.path)
+        elif _file_size(self._document_index.path) == 0:
+            self._build_document_index()
+
+    def store(self, batch) -> None:
+        birthdates = _DateCache()
+        rows = io.StringIO()
+        writer = csv.writer(rows, quoting=csv.QUOTE_MINIMAL)
+        # writerow returns the characters of each row, used for the row offsets
+        lengths = []
+        for i in range(len(batch)):
+            document, first_name, last_name = batch.strings(i)
+            lengths.append(writer.writerow([batch.agencies[i], first_name, last_name, document,
+                                            birthdates.isoformat(batch.birthdates[i]), batch.numbers[i]]))
+        text = rows.getvalue()
+        data = text.encode('utf-8')
+        if len(data) != len(text):
+            start = 0
+            for i, length in enumerate(lengths):
+                lengths[i] = len(text[start:start + length].encode('utf-8'))
+                start += length
+
+        with open(self._path, 'ab') as file:
+            offset = file.seek(0, os.SEEK_END)
+            file.write(data)
+            if self._fsync:
+                _sync(file)
+        # the index is written last so it never points to missing rows
+        postings = bytearray()
+        for i, length in enumerate(lengths):
+            postings += self.DOCUMENT_POSTING.pack(_document_key(batch.strings(i)[0]), offset)
+            offset += length
+        _append(self._document_index.path, postings, self._fsync)
+
+    def load(self) -> Iterator:
+        with open(self._path, 'r') as file:
+            reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
+            for row in reader:
+                yield utils.Bet(row[0], row[1], row[2], row[3], row[4], row[5])
+
+    def load_batches(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        with open(self._path, 'r') as file:
+            yield from _csv_batches(file, chunk_size)
+
+    def load_by_agency(self, agency: int) -> Iterator:
+        for batch in self.load_batches():
+            yield from batch.bets_for_agency(agency)
+
+    def load_by_number(self, number: int) -> Iterator:
+        for batch in self.load_batches():
+            yield from batch.bets_with_number(number)
+
+    def load_by_document(self, document: str, agency: int = None) -> Iterator:
+        offsets = self._document_index.lookup(_document_key(document))
+        if not offsets:
+            return
+        with open(self._path, 'r', newline='') as file:
+            for offset in offsets:
+                file.seek(offset)
+                row = next(csv.reader(file, quoting=csv.QUOTE_MINIMAL))
+                bet = utils.Bet(row[0], row[1], row[2], row[3], row[4], row[5])
+                if bet.document == document and (agency is None or bet.agency == agency):
+                    yield bet
+
+    def stored_bytes(self) -> int:
+        return _file_size(self._path)
+
+    def layout(self) -> str:
+        return CSV_BACKEND
+
+    def position(self) -> int:
+        """ A row still being appended is left out. """
+        return _last_row_end(self._path)
+
+    def load_batches_between(self, start, end: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        start = start or 0
+        if start >= end:
+            return iter(())
+        return _CsvChunk(self._path, start, end).load_batches(chunk_size)
+
+    def chunks(self, chunk_bytes: int) -> list:
+        """ Splits the file in byte ranges of about chunk_bytes, each one starting at a row. """
+        size = _file_size(self._path)
+        if size == 0:
+            return []
+        bounds = [0]
+        with open(self._path, 'rb') as file:
+            while bounds[-1] + chunk_bytes < size:
+                file.seek(bounds[-1] + chunk_bytes)
+                # the row cut by the seek stays in the previous range
+                file.readline()
+                bounds.append(file.tell())
+        bounds.append(size)
+        return [_CsvChunk(self._path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    def _build_document_index(self) -> None:
+        """ Indexes a file written before the document index existed. """
+        postings = bytearray()
+        offset = 0
+        with open(self._path, 'rb') as file:
+            for line in file:
+                row = next(csv.reader([line.decode('utf-8')]), None)
+                if row:
+                    postings += self.DOCUMENT_POSTING.pack(_document_key(row[3]), offset)
+                offset += len(line)
+        _append(self._document_index.path, postings, self._fsync)
+
+
+"""
+Append-only binary bet log.
+
+- <base>.rec: fixed-size records (agency, number, birthdate as days since
+  epoch, offset and length of the record strings), read through mmap.
+- <base>.str: strings heap with document, first name and last name of each
+  record, separated by NUL.
+- <base>.agency.idx / <base>.number.idx / <base>.document.idx: append-only
+  (key, record number) postings, the key of the documents being a hash. They
+  are loaded in memory and refreshed incrementally, so queries by agency,
+  number or document only read the records they need. A missing document
+  index is built from the records.
+
+Appends must be serialized by the caller (bets lock), as with the CSV file.
+"""
+class BinaryBetStorage:
+    LOCKS_SHARDS = False
+    INDEXED = True
+    RECORD = struct.Struct('<iiiQI')
+    POSTING = struct.Struct('<iI')
+    DOCUMENT_POSTING = struct.Struct('<II')
+    STRINGS_SEPARATOR = '\0'
+
+    def __init__(self, base_path: str, fsync: bool = False):
+        self._fsync = fsync
+        self._records_path = base_path + '.rec'
+        self._strings_path = base_path + '.str'
+        self._indexes = {
+            'agency': _PostingsIndex(base_path + '.agency.idx', self.POSTING, 'I'),
+            'number': _PostingsIndex(base_path + '.number.idx', self.POSTING, 'I'),
+            'document': _PostingsIndex(base_path + '.document.idx', self.DOCUMENT_POSTING, 'I'),
+        }
+        if _file_size(self._records_path) > 0 and _file_size(self._indexes['document'].path) == 0:
+            self._build_document_index()
+
+    def store(self, batch) -> None:
+        first_record = _file_size(self._records_path) // self.RECORD.size
+        strings_offset = _file_size(self._strings_path)
+
+        records = bytearray()
+        strings = bytearray()
+        postings = {name: bytearray() for name in self._indexes}
+        for i in range(len(batch)):
+            values = batch.strings(i)
+            encoded = self.STRINGS_SEPARATOR.join(values).encode('utf-8')
+            records += self.RECORD.pack(batch.agencies[i], batch.numbers[i], batch.birthdates[i],
+                                        strings_offset + len(strings), len(encoded))
+            strings += encoded
+            postings['agency'] += self.POSTING.pack(batch.agencies[i], first_record + i)
+            postings['number'] += self.POSTING.pack(batch.numbers[i], first_record + i)
+            postings['document'] += self.DOCUMENT_POSTING.pack(_document_key(values[0]), first_record + i)
+
+        # the indexes are written last so they never point to missing records
+        _append(self._strings_path, strings, self._fsync)
+        _append(self._records_path, records, self._fsync)
+        for name, index in self._indexes.items():
+            _append(index.path, postings[name], self._fsync)
+
+    def load(self) -> Iterator:
+        with _MappedFile(self._records_path) as records, _MappedFile(self._strings_path) as strings:
+            for offset in range(0, len(records) - self.RECORD.size + 1, self.RECORD.size):
+                yield self._build_bet(self.RECORD.unpack_from(records, offset), strings)
+
+    def load_batches(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        records = _file_size(self._records_path) // self.RECORD.size
+        return _BinaryChunk(self._records_path, self._strings_path, 0, records).load_batches(chunk_size)
+
+    def load_by_agency(self, agency: int) -> Iterator:
+        return self._load_records(self._lookup('agency', agency))
+
+    def load_by_number(self, number: int) -> Iterator:
+        return self._load_records(self._lookup('number', number))
+
+    def load_by_document(self, document: str, agency: int = None) -> Iterator:
+        for bet in self._load_records(self._lookup('document', _document_key(document))):
+            if bet.document == document and (agency is None or bet.agency == agency):
+                yield bet
+
+    def stored_bytes(self) -> int:
+        return _file_size(self._records_path) + _file_size(self._strings_path)
+
+    def layout(self) -> str:
+        return BINARY_BACKEND
+
+    def position(self) -> int:
+        """ Amount of complete records; their strings are always written before them. """
+        return _file_size(self._records_path) // self.RECORD.size
+
+    def load_batches_between(self, start, end: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        start = start or 0
+        if start >= end:
+            return iter(())
+        return _BinaryChunk(self._records_path, self._strings_path, start, end).load_batches(chunk_size)
+
+    def chunks(self, chunk_bytes: int) -> list:
+        """ Splits the log in ranges of whole records of about chunk_bytes (strings included). """
+        records = _file_size(self._records_path) // self.RECORD.size
+        if records == 0:
+            return []
+        amount = -(-self.stored_bytes() // chunk_bytes)
+        per_chunk = -(-records // amount)
+        return [_BinaryChunk(self._records_path, self._strings_path, first, min(first + per_chunk, records))
+                for first in range(0, records, per_chunk)]
+
+    def _lookup(self, index_name: str, key: int) -> array:
+        return self._indexes[index_name].lookup(key)
+
+    def _build_document_index(self) -> None:
+        """ Indexes a log written before the document index existed. """
+        postings = bytearray()
+        with _MappedFile(self._records_path) as records, _MappedFile(self._strings_path) as strings:
+            for record_number in range(len(records) // self.RECORD.size):
+                strings_offset, strings_length = self.RECORD.unpack_from(records, record_number * self.RECORD.size)[3:]
+                document = str(strings[strings_offset:strings_offset + strings_length], 'utf-8').split(self.STRINGS_SEPARATOR)[0]
+                postings += self.DOCUMENT_POSTING.pack(_document_key(document), record_number)
+        _append(self._indexes['document'].path, postings, self._fsync)
+
+    def _load_records(self, record_numbers: array) -> Iterator:
+        if not record_numbers:
+            return
+        with _MappedFile(self._records_path) as records, _MappedFile(self._strings_path) as strings:
+            for record_number in record_numbers:
+                fields = self.RECORD.unpack_from(records, record_number * self.RECORD.size)
+                yield self._build_bet(fields, strings)
+
+    def _build_bet(self, fields, strings):
+        agency, number, birthdate, strings_offset, strings_length = fields
+        document, first_name, last_name = str(
+            strings[strings_offset:strings_offset + strings_length], 'utf-8').split(self.STRINGS_SEPARATOR)
+        return utils.Bet.from_values(agency, first_name, last_name, document,
+                                     utils.date_from_days(birthdate), number)
+
+
+"""
+Splits the bets by agency into shards of another backend: one CSV file or
+binary log per agency under <directory>/agency-<n>, each one with its own
+lock, so batches of different agencies are stored concurrently. Agencies
+beyond the configured amount share the shards by modulo (lock striping).
+
+The locks are multiprocessing locks created with the layout, so they are
+shared by the threads and by the server processes forked afterwards. Unlike
+the other backends, store is safe to call concurrently. Loads read up to
+readers shards at the same time; bets keep their order within each agency.
+"""
+class ShardedBetStorage:
+    LOCKS_SHARDS = True
+    INDEXED = False
+
+    def __init__(self, backend: str, directory: str, shards: int, fsync: bool = False,
+                 readers: int = DEFAULT_SHARD_READERS):
+        if shards < 1:
+            raise ValueError(f"Invalid amount of shards: {shards}")
+        os.makedirs(directory, exist_ok=True)
+        self._shards = [_create_backend(backend, os.path.join(directory, f'agency-{shard + 1}'), fsync)
+                        for shard in range(shards)]
+        self._layout = f'{SHARDED_LAYOUT}-{backend}-{shards}'
+        self._locks = [multiprocessing.Lock() for _ in range(shards)]
+        # answers queries by number from the indexes of its shards, if they have them
+        self.INDEXED = self._shards[0].INDEXED
+        self._readers = max(1, min(readers, shards))
+
+    def shard_for(self, agency: int) -> int:
+        return (agency - 1) % len(self._shards)
+
+    def store(self, batch) -> None:
+        for shard, bets in self._split(batch):
+            with self._locks[shard]:
+                self._shards[shard].store(bets)
+
+    def load(self) -> Iterator:
+        for batch in self.load_batches():
+            yield from batch
+
+    def load_batches(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        return _read_in_parallel([shard.load_batches(chunk_size) for shard in self._shards], self._readers)
+
+    def load_by_agency(self, agency: int) -> Iterator:
+        return _skip_missing(self._shards[self.shard_for(agency)].load_by_agency(agency))
+
+    def load_by_number(self, number: int) -> Iterator:
+        return _read_in_parallel([shard.load_by_number(number) for shard in self._shards], self._readers)
+
+    def load_by_document(self, document: str, agency: int = None) -> Iterator:
+        """ With the agency, only its shard is looked up. """
+        if agency is not None:
+            return _skip_missing(self._shards[self.shard_for(agency)].load_by_document(document, agency))
+        return (bet for shard in self._shards for bet in _skip_missing(shard.load_by_document(document)))
+
+    def stored_bytes(self) -> int:
+        return sum(shard.stored_bytes() for shard in self._shards)
+
+    def layout(self) -> str:
+        return self._layout
+
+    def position(self) -> list:
+        """ The position of every shard. """
+        return [shard.position() for shard in self._shards]
+
+    def load_batches_between(self, start, end: list, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        starts = start or [None] * len(self._shards)
+        return _read_in_parallel([shard.load_batches_between(shard_start, shard_end, chunk_size)
+                                  for shard, shard_start, shard_end in zip(self._shards, starts, end)],
+                                 self._readers)
+
+    def chunks(self, chunk_bytes: int) -> list:
+        return [chunk for shard in self._shards for chunk in shard.chunks(chunk_bytes)]
+
+    def _split(self, batch):
+        positions = {}
+        for i, agency in enumerate(batch.agencies):
+            positions.setdefault(self.shard_for(agency), []).append(i)
+        if len(positions) == 1:
+            # a batch usually comes from a single agency
+            return [(shard, batch) for shard in positions]
+        return [(shard, batch.take(shard_positions)) for shard, shard_positions in positions.items()]
+
+
+"""
+Chunks describe a part of a storage that another process can load on its
+own (they only hold paths and offsets, so they can be pickled). They are
+used to scan the bets in parallel, for example in the draw.
+"""
+class _CsvChunk:
+    def __init__(self, path: str, start: int, end: int):
+        self._path = path
+        self._start = start
+        self._end = end
+
+    def load_batches(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        with open(self._path, 'rb') as file:
+            file.seek(self._start)
+            data = file.read(self._end - self._start)
+        return _csv_batches(io.StringIO(data.decode('utf-8'), newline=''), chunk_size)
+
+
+class _BinaryChunk:
+    def __init__(self, records_path: str, strings_path: str, first_record: int, end_record: int):
+        self._records_path = records_path
+        self._strings_path = strings_path
+        self._first_record = first_record
+        self._end_record = end_record
+
+    def load_batches(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator:
+        record_size = BinaryBetStorage.RECORD.size
+        separator = BinaryBetStorage.STRINGS_SEPARATOR
+        with _MappedFile(self._records_path) as records, _MappedFile(self._strings_path) as strings:
+            batch = utils.BetBatch()
+            for offset in range(self._first_record * record_size, self._end_record * record_size, record_size):
+                agency, number, birthdate, strings_offset, strings_length = BinaryBetStorage.RECORD.unpack_from(records, offset)
+                document, first_name, last_name = str(
+                    strings[strings_offset:strings_offset + strings_length], 'utf-8').split(separator)
+                batch.append(agency, first_name, last_name, document, birthdate, number)
+                if len(batch) >= chunk_size:
+                    yield batch
+                    batch = utils.BetBatch()
+            if len(batch) > 0:
+                yield batch
+
+
+def _csv_batches(lines: Iterator, chunk_size: int) -> Iterator:
+    birthdates = _DateCache()
+    reader = csv.reader(lines, quoting=csv.QUOTE_MINIMAL)
+    batch = utils.BetBatch()
+    for row in reader:
+        batch.append(int(row[0]), row[1], row[2], row[3], birthdates.days(row[4]), int(row[5]))
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = utils.BetBatch()
+    if len(batch) > 0:
+        yield batch
+
+
+class _ReadError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_READ_DONE = object()
+
+def _read_in_parallel(sources: list, readers: int) -> Iterator:
+    """
+    Iterates the sources from a pool of reader threads and yields their items
+    as they arrive: interleaved across sources, in order within each one. The
+    bounded queue keeps the readers from getting too far ahead.
+    """
+    items = queue.Queue(maxsize=readers * 2)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(source) -> None:
+        try:
+            for item in _skip_missing(source):
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_ReadError(e))
+        put(_READ_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='shard-reader')
+    try:
+        for source in sources:
+            executor.submit(read, source)
+        remaining = len(sources)
+        while remaining:
+            item = items.get()
+            if item is _READ_DONE:
+                remaining -= 1
+            elif isinstance(item, _ReadError):
+                raise item.error
+            else:
+                yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _skip_missing(items: Iterator) -> Iterator:
+    """ Shards of agencies without bets have no files yet. """
+    try:
+        yield from items
+    except FileNotFoundError:
+        return
+
+
+class _DateCache:
+    """ Birthdates repeat a lot; converts each distinct value only once. """
+    def __init__(self):
+        self._days = {}
+        self._isoformats = {}
+
+    def days(self, isoformat: str) -> int:
+        days = self._days.get(isoformat)
+        if days is None:
+            days = self._days[isoformat] = utils.days_from_date(datetime.date.fromisoformat(isoformat))
+        return days
+
+    def isoformat(self, days: int) -> str:
+        isoformat = self._isoformats.get(days)
+        if isoformat is None:
+            isoformat = self._isoformats[days] = utils.date_from_days(days).isoformat()
+        return isoformat
+
+
+class _MappedFile:
+    """ Read-only mmap of a whole file; empty or missing files map to b''. """
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        if _file_size(self._path) == 0:
+            return b''
+        self._file = open(self._path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __exit__(self, *exc):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+
+
+class _PostingsIndex:
+    """
+    Append-only file of (key, position) postings, loaded in memory and
+    refreshed incrementally: a lookup only reads the postings appended since
+    the previous one. Lookups take the lock of the index, never the bets lock.
+    """
+    def __init__(self, path: str, posting: struct.Struct, typecode: str):
+        self.path = path
+        self._posting = posting
+        self._typecode = typecode
+        self._postings = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key: int) -> array:
+        with self._lock:
+            self._refresh()
+            return array(self._typecode, self._postings.get(key, ()))
+
+    def _refresh(self) -> None:
+        """ Loads the postings appended since the last refresh. """
+        if _file_size(self.path) <= self._offset:
+            return
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            data = file.read()
+        data = data[:len(data) - len(data) % self._posting.size]
+        for key, position in self._posting.iter_unpack(data):
+            positions = self._postings.get(key)
+            if positions is None:
+                positions = self._postings[key] = array(self._typecode)
+            positions.append(position)
+        self._offset += len(data)
+
+
+def _document_key(document: str) -> int:
+    """ Key of a document in the indexes, stable across processes and restarts. """
+    return zlib.crc32(document.encode('utf-8'))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _last_row_end(path: str, block_size: int = 4096) -> int:
+    """ Offset right after the last newline of the file. """
+    end = _file_size(path)
+    if end == 0:
+        return 0
+    with open(path, 'rb') as file:
+        while end > 0:
+            start = max(0, end - block_size)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _append(path: str, data: bytes, fsync: bool = False) -> None:
+    with open(path, 'ab') as file:
+        file.write(data)
+        if fsync:
+            _sync(file)
+
+
+def _sync(file) -> None:
+    file.flush()
+    os.fsync(file.fileno())
+
+
+_storage = None
+
+def _create_backend(backend: str, base_path: str, fsync: bool):
+    if backend == CSV_BACKEND:
+        return CsvBetStorage(base_path + '.csv', fsync)
+    if backend == BINARY_BACKEND:
+        return BinaryBetStorage(base_path, fsync)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def create_storage(backend: str, fsync: bool = False, shards: int = 0):
+    """
+    fsync makes every store durable before returning. shards > 0 splits the
+    bets by agency (see ShardedBetStorage).
+    """
+    base_path = os.path.splitext(utils.STORAGE_FILEPATH)[0]
+    if shards > 0:
+        directory = os.path.join(os.path.dirname(utils.STORAGE_FILEPATH), SHARDS_DIRECTORY)
+        return ShardedBetStorage(backend, directory, shards, fsync)
+    return _create_backend(backend, base_path, fsync)
+
+def split_chunks(storage, parts: int) -> list:
+    """
+    Splits the storage in about parts chunks (see _CsvChunk), none of them
+    smaller than MIN_SPLIT_BYTES.
+    """
+    chunk_bytes = max(MIN_SPLIT_BYTES, -(-storage.stored_bytes() // max(1, parts)))
+    return storage.chunks(chunk_bytes)
+
+def precedes(start, end) -> bool:
+    """ Whether the position start is not past end, both of the same layout. """
+    if isinstance(start, list):
+        return isinstance(end, list) and len(start) == len(end) and all(map(precedes, start, end))
+    return isinstance(start, int) and isinstance(end, int) and 0 <= start <= end
+
+def set_storage(storage) -> None:
+    global _storage
+    _storage = storage
+
+def get_storage():
+    """ Returns the configured storage, CSV by default. """
+    if _storage is None:
+        return CsvBetStorage(utils.STORAGE_FILEPATH)
+    return _storage
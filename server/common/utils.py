@@ -1,16 +1,26 @@
-import csv
+import contextlib
 import datetime
 import time
 
+from array import array
+from typing import Iterable, Iterator
+
+from common import dedup, storage
+
 
 """ Bets storage location. """
 STORAGE_FILEPATH = "./bets.csv"
 """ Simulated winner number in the lottery contest. """
 LOTTERY_WINNER_NUMBER = 7574
 
+""" Filter of already stored bets, None unless configure_dedup is called. """
+_duplicate_filter = None
+
 
 """ A lottery bet registry. """
 class Bet:
+    __slots__ = ('agency', 'first_name', 'last_name', 'document', 'birthdate', 'number')
+
     def __init__(self, agency: str, first_name: str, last_name: str, document: str, birthdate: str, number: str):
         """
         agency must be passed with integer format.
@@ -24,28 +34,278 @@ class Bet:
         self.birthdate = datetime.date.fromisoformat(birthdate)
         self.number = int(number)
 
+    @classmethod
+    def from_values(cls, agency: int, first_name: str, last_name: str, document: str, birthdate: datetime.date, number: int) -> 'Bet':
+        """
+        Builds a bet from already parsed values, skipping the string parsing.
+        """
+        bet = cls.__new__(cls)
+        bet.agency = agency
+        bet.first_name = first_name
+        bet.last_name = last_name
+        bet.document = document
+        bet.birthdate = birthdate
+        bet.number = number
+        return bet
+
+""" Birthdates are kept as days since 1970-01-01. """
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def days_from_date(date: datetime.date) -> int:
+    return date.toordinal() - EPOCH_ORDINAL
+
+def date_from_days(days: int) -> datetime.date:
+    return datetime.date.fromordinal(EPOCH_ORDINAL + days)
+
+
+"""
+Struct-of-arrays representation of many bets.
+
+Agency, number and birthdate live in typed array columns and the strings
+(document, first name and last name of each bet) are UTF-8 encoded one after
+the other in a single buffer, delimited by an array of end offsets. A batch
+of N bets costs a handful of Python objects instead of N Bet instances, and
+Bet objects are only built on demand (for example for the winners).
+"""
+class BetBatch:
+    __slots__ = ('agencies', 'numbers', 'birthdates', '_strings', '_string_ends')
+
+    STRINGS_PER_BET = 3
+
+    def __init__(self):
+        self.agencies = array('i')
+        self.numbers = array('i')
+        self.birthdates = array('i')
+        self._strings = bytearray()
+        self._string_ends = array('Q')
+
+    @classmethod
+    def from_bets(cls, bets: Iterable) -> 'BetBatch':
+        batch = cls()
+        batch.extend(bets)
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __iter__(self) -> Iterator:
+        for i in range(len(self)):
+            yield self.bet(i)
+
+    def append(self, agency: int, first_name: str, last_name: str, document: str, birthdate: int, number: int) -> None:
+        """
+        birthdate must be passed as days since epoch.
+        Raises ValueError if agency, number or birthdate do not fit in an int32.
+        """
+        count = len(self.numbers)
+        try:
+            self.agencies.append(agency)
+            self.numbers.append(number)
+            self.birthdates.append(birthdate)
+        except OverflowError:
+            # keeps the columns aligned, the bet is not added
+            for column in (self.agencies, self.numbers, self.birthdates):
+                del column[count:]
+            raise ValueError(f"Bet out of range: agency {agency}, number {number}, birthdate {birthdate}")
+        for value in (document, first_name, last_name):
+            self._strings += value.encode('utf-8')
+            self._string_ends.append(len(self._strings))
+
+    def append_bet(self, bet) -> None:
+        self.append(bet.agency, bet.first_name, bet.last_name, bet.document,
+                    days_from_date(bet.birthdate), bet.number)
+
+    def extend(self, bets: Iterable) -> None:
+        """ Appends another BetBatch (copying its columns) or any iterable of Bet. """
+        if isinstance(bets, BetBatch):
+            base = len(self._strings)
+            self.agencies.extend(bets.agencies)
+            self.numbers.extend(bets.numbers)
+            self.birthdates.extend(bets.birthdates)
+            self._strings += bets._strings
+            self._string_ends.extend(end + base for end in bets._string_ends)
+        else:
+            for bet in bets:
+                self.append_bet(bet)
+
+    def take(self, positions: Iterable[int]) -> 'BetBatch':
+        """ Returns a new batch with the bets at the given positions, in that order. """
+        batch = BetBatch()
+        for i in positions:
+            first = i * self.STRINGS_PER_BET
+            start = self._string_ends[first - 1] if first else 0
+            batch.agencies.append(self.agencies[i])
+            batch.numbers.append(self.numbers[i])
+            batch.birthdates.append(self.birthdates[i])
+            base = len(batch._strings) - start
+            batch._strings += self._strings[start:self._string_ends[first + self.STRINGS_PER_BET - 1]]
+            batch._string_ends.extend(end + base for end in self._string_ends[first:first + self.STRINGS_PER_BET])
+        return batch
+
+    def strings(self, i: int):
+        """ Returns (document, first_name, last_name) of the i-th bet. """
+        first = i * self.STRINGS_PER_BET
+        start = self._string_ends[first - 1] if first else 0
+        values = []
+        for end in self._string_ends[first:first + self.STRINGS_PER_BET]:
+            values.append(self._strings[start:end].decode('utf-8'))
+            start = end
+        return values
+
+    def bet(self, i: int):
+        document, first_name, last_name = self.strings(i)
+        return Bet.from_values(self.agencies[i], first_name, last_name, document,
+                               date_from_days(self.birthdates[i]), self.numbers[i])
+
+    def bets_with_number(self, number: int) -> Iterator:
+        """ Builds Bet objects only for the bets made to number. """
+        for i, bet_number in enumerate(self.numbers):
+            if bet_number == number:
+                yield self.bet(i)
+
+    def bets_for_agency(self, agency: int) -> Iterator:
+        for i, bet_agency in enumerate(self.agencies):
+            if bet_agency == agency:
+                yield self.bet(i)
+
+
 """ Checks whether a bet won the prize or not. """
 def has_won(bet: Bet) -> bool:
     return bet.number == LOTTERY_WINNER_NUMBER
 
 """
-Persist the information of each bet in the STORAGE_FILEPATH file.
-Not thread-safe/process-safe.
+Selects the storage backend used by store_bets/load_bets: 'csv' (default)
+or 'binary'. With fsync, store_bets only returns once the bets are on disk.
+With shards > 0 the bets are split by agency into that many shards of the
+backend, each one with its own lock.
+"""
+def configure_storage(backend: str, fsync: bool = False, shards: int = 0) -> None:
+    storage.set_storage(storage.create_storage(backend, fsync, shards))
+
+"""
+Returns the lock to hold around store_bets. Sharded storages lock each shard
+themselves, so bets of different agencies are not serialized by bets_lock,
+unless the bets are deduplicated against other processes: the duplicate check
+and the write must then be atomic across processes too.
+"""
+def storage_lock(bets_lock):
+    if storage.get_storage().LOCKS_SHARDS and not (_duplicate_filter is not None and _duplicate_filter.shared()):
+        return contextlib.nullcontext()
+    return bets_lock
+
+"""
+Makes store_bets skip the bets already stored (see dedup.DuplicateFilter),
+or store every bet again if not enabled. shared must be set when other
+processes store bets too. Indexes the stored bets and returns how many
+there are.
+"""
+def configure_dedup(enabled: bool = True, shared: bool = False) -> int:
+    global _duplicate_filter
+    if not enabled:
+        _duplicate_filter = None
+        return 0
+    _duplicate_filter = dedup.DuplicateFilter(shared)
+    return _duplicate_filter.load()
+
+""" Whether store_bets skips the bets already stored. """
+def deduplicating() -> bool:
+    return _duplicate_filter is not None
+
+"""
+Persist the information of each bet in the configured storage. Accepts a
+list of Bet or a BetBatch. Returns the bets actually stored: all of them,
+unless configure_dedup was called.
+Not thread-safe/process-safe unless the storage is sharded (see storage_lock).
+"""
+def store_bets(bets: list[Bet]) -> BetBatch:
+    return store_bet_batches([bets])[0]
+
+"""
+Persists several batches with a single write, as store_bets. Returns the
+bets actually stored of each batch.
 """
-def store_bets(bets: list[Bet]) -> None:
-    with open(STORAGE_FILEPATH, 'a+') as file:
-        writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
-        for bet in bets:
-            writer.writerow([bet.agency, bet.first_name, bet.last_name,
-                             bet.document, bet.birthdate, bet.number])
+def store_bet_batches(batches: list) -> list[BetBatch]:
+    batches = [bets if isinstance(bets, BetBatch) else BetBatch.from_bets(bets) for bets in batches]
+    if _duplicate_filter is not None:
+        return _duplicate_filter.store(batches, storage.get_storage().store)
+    if len(batches) == 1:
+        storage.get_storage().store(batches[0])
+        return batches
+    bets = BetBatch()
+    for batch in batches:
+        bets.extend(batch)
+    storage.get_storage().store(bets)
+    return batches
 
 """
-Loads the information all the bets in the STORAGE_FILEPATH file.
+Loads the information all the bets in the configured storage.
 Not thread-safe/process-safe.
 """
 def load_bets() -> list[Bet]:
-    with open(STORAGE_FILEPATH, 'r') as file:
-        reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
-        for row in reader:
-            yield Bet(row[0], row[1], row[2], row[3], row[4], row[5])
+    return storage.get_storage().load()
+
+"""
+Loads all the bets in the configured storage as BetBatch chunks, without
+building a Bet per record.
+Not thread-safe/process-safe.
+"""
+def load_bet_batches() -> Iterator[BetBatch]:
+    return storage.get_storage().load_batches()
+
+"""
+Splits the configured storage in about parts chunks that other processes
+can load on their own, to scan the bets in parallel.
+"""
+def split_bet_chunks(parts: int) -> list:
+    return storage.split_chunks(storage.get_storage(), parts)
+
+"""
+Returns (layout, position) of the configured storage: how far the stored
+bets go, as a JSON-serializable value whose format depends on the layout.
+"""
+def storage_position() -> tuple:
+    current = storage.get_storage()
+    return current.layout(), current.position()
+
+"""
+Whether the storage position start is not past end (see storage_position).
+"""
+def position_precedes(start, end) -> bool:
+    return storage.precedes(start, end)
+
+"""
+Loads the bets stored between two positions of the configured storage as
+BetBatch chunks; a start of None means from the first bet. Positions only
+cover complete bets, so it can be called while other bets are being stored.
+"""
+def load_bet_batches_between(start, end) -> Iterator[BetBatch]:
+    return storage.get_storage().load_batches_between(start, end)
+
+"""
+Whether load_bets_with_number is answered from an index instead of reading
+every bet.
+"""
+def bets_indexed_by_number() -> bool:
+    return storage.get_storage().INDEXED
 
+"""
+Loads the bets of a single agency. The binary storage answers it from its
+index and the sharded storage reads only the shard of the agency.
+"""
+def load_bets_for_agency(agency: int) -> list[Bet]:
+    return storage.get_storage().load_by_agency(agency)
+
+"""
+Loads the bets of a document, optionally only those of an agency. Every
+storage answers it from an index, without reading the other bets or taking
+the bets lock.
+"""
+def load_bets_by_document(document: str, agency: int = None) -> list[Bet]:
+    return list(storage.get_storage().load_by_document(document, agency))
+
+"""
+Loads the bets made to a given number. The binary storage answers it from
+its index without reading the other records.
+"""
+def load_bets_with_number(number: int) -> list[Bet]:
+    return storage.get_storage().load_by_number(number)
@@ -0,0 +1,86 @@
+import logging
+import threading
+
+from common import metrics
+
+""" Cada cuanto se revisa el flag compartido del sorteo (segundos) """
+SHARED_DRAW_POLL_INTERVAL = 0.1
+
+
+class _Subscriber:
+    def __init__(self, agency_id, send, close):
+        self.agency_id = agency_id
+        self.send = send
+        self.close = close
+
+
+class WinnersNotifier:
+    """
+    Agencias suscriptas a los ganadores (operacion SUBSCRIBE).
+
+    La conexion de cada agencia queda abierta sin ocupar un hilo: se guarda
+    solo como un par de callbacks. send(payload) envia el frame WINNERS y
+    cierra la conexion; close() la cierra sin respuesta (al apagar el
+    servidor). Los callbacks permiten usar el mismo notifier con sockets
+    bloqueantes y con streams de asyncio.
+
+    notify() debe llamarse despues de Lottery.make_draw. Con estado del sorteo
+    compartido entre procesos, el sorteo puede hacerlo otro proceso, por lo
+    que start() levanta un unico hilo que espera el flag compartido.
+    """
+    def __init__(self, lottery, lottery_lock):
+        self._lottery = lottery
+        self._lottery_lock = lottery_lock
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._watcher = None
+
+    def start(self):
+        if self._lottery.is_shared():
+            self._watcher = threading.Thread(target=self._watch_shared_draw, name="winners-watcher", daemon=True)
+            self._watcher.start()
+
+    def stop(self):
+        """ Cierra las conexiones que siguen esperando el sorteo """
+        self._stopped.set()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def subscribe(self, agency_id, send, close) -> None:
+        """
+        Registra la conexion de la agencia. Si el sorteo ya se hizo, la
+        respuesta se envia en el momento
+        """
+        with self._lock:
+            payload = self._lottery.winners_payload(agency_id)
+            if payload is None:
+                self._subscribers.append(_Subscriber(agency_id, send, close))
+                return
+        send(payload)
+
+    def notify(self) -> None:
+        """ Envia los ganadores a todas las agencias suscriptas """
+        with self._lock:
+            payloads = [self._lottery.winners_payload(s.agency_id) for s in self._subscribers]
+            # los payloads se arman todos juntos al hacer el sorteo en este proceso
+            if not payloads or payloads[0] is None:
+                return
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber, payload in zip(subscribers, payloads):
+            subscriber.send(payload)
+
+    def _watch_shared_draw(self):
+        while not self._stopped.wait(SHARED_DRAW_POLL_INTERVAL):
+            if self._lottery.draw_done():
+                try:
+                    with metrics.timed_lock(self._lottery_lock, 'lottery'):
+                        # arma los ganadores locales del sorteo que hizo otro proceso
+                        self._lottery.make_draw()
+                except Exception as e:
+                    logging.error(f'action: notificar_ganadores | result: fail | error: {e}')
+                    return
+                self.notify()
+                return
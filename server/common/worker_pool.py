@@ -0,0 +1,166 @@
+import logging
+import queue
+import threading
+import time
+
+
+""" Cada cuanto un worker sin conexiones revisa si el pool se esta deteniendo (segundos) """
+STOP_POLL_INTERVAL = 0.1
+
+
+class WorkerPoolStats:
+    """
+    Metricas de la cola de admision del pool.
+    Los tiempos de espera se miden desde que la conexion se encola hasta
+    que un worker la toma (o se rechaza).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.busy_workers = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def record_enqueue(self, queue_depth):
+        with self._lock:
+            self.enqueued += 1
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_dispatch(self, wait_time):
+        with self._lock:
+            self.dispatched += 1
+            self.busy_workers += 1
+            self._record_wait(wait_time)
+
+    def record_done(self):
+        with self._lock:
+            self.busy_workers -= 1
+
+    def record_reject(self, wait_time):
+        with self._lock:
+            self.rejected += 1
+            self._record_wait(wait_time)
+
+    def _record_wait(self, wait_time):
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def snapshot(self, queue_depth) -> dict:
+        with self._lock:
+            waited = self.dispatched + self.rejected
+            return {
+                "queue_depth": queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "busy_workers": self.busy_workers,
+                "enqueued": self.enqueued,
+                "dispatched": self.dispatched,
+                "rejected": self.rejected,
+                "avg_wait_time": self.total_wait_time / waited if waited else 0.0,
+                "max_wait_time": self.max_wait_time,
+            }
+
+
+class WorkerPool:
+    """
+    Pool fijo de workers con una cola de admision acotada.
+
+    Las conexiones aceptadas esperan en la cola hasta que un worker se libera.
+    Si la cola esta llena, submit bloquea al hilo que acepta (backpressure
+    hacia el backlog de TCP) hasta que haya lugar o venza el deadline de la
+    conexion. Una conexion solo se rechaza si su deadline vence antes de ser
+    atendida.
+    """
+    def __init__(self, workers, queue_size, queue_timeout, handler, rejecter):
+        """
+        handler(item) atiende una conexion y rejecter(item) la rechaza.
+        queue_timeout es el tiempo maximo (en segundos) que una conexion
+        puede esperar antes de ser rechazada.
+        """
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._queue_timeout = queue_timeout
+        self._handler = handler
+        self._rejecter = rejecter
+        self._stats = WorkerPoolStats()
+        self._closed = threading.Event()
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item) -> bool:
+        """
+        Encola una conexion. Retorna False si fue rechazada porque la cola
+        siguio llena hasta vencer su deadline, o porque el pool se esta
+        deteniendo.
+        """
+        enqueued_at = time.monotonic()
+        try:
+            if self._closed.is_set():
+                raise queue.Full
+            self._queue.put((item, enqueued_at), timeout=self._queue_timeout)
+        except queue.Full:
+            self._stats.record_reject(time.monotonic() - enqueued_at)
+            self._rejecter(item)
+            return False
+        self._stats.record_enqueue(self._queue.qsize())
+        return True
+
+    def stats(self) -> dict:
+        return self._stats.snapshot(self._queue.qsize())
+
+    def _worker_loop(self):
+        while True:
+            try:
+                entry = self._queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                # al detenerse, el worker termina cuando ya no quedan conexiones encoladas
+                if self._closed.is_set():
+                    break
+                continue
+            item, enqueued_at = entry
+            wait_time = time.monotonic() - enqueued_at
+            if wait_time > self._queue_timeout:
+                self._stats.record_reject(wait_time)
+                self._rejecter(item)
+                continue
+
+            self._stats.record_dispatch(wait_time)
+            try:
+                self._handler(item)
+            except Exception as e:
+                logging.error(f'action: worker_handle | result: fail | error: {e}')
+            finally:
+                self._stats.record_done()
+
+    def shutdown(self, timeout):
+        """
+        Deja que los workers terminen las conexiones encoladas y espera
+        a lo sumo timeout segundos. Las conexiones que siguen en la cola al
+        vencer el plazo se rechazan. Retorna la cantidad de workers que no
+        terminaron a tiempo.
+        """
+        # los workers se detienen al ver la cola vacia, sin marcas en la cola
+        # que podrian no entrar si esta llena
+        self._closed.set()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(timeout=max(0, deadline - time.monotonic()))
+        self._reject_queued()
+        return len([w for w in self._workers if w.is_alive()])
+
+    def _reject_queued(self):
+        """ Rechaza las conexiones que siguen en la cola """
+        while True:
+            try:
+                item, enqueued_at = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._stats.record_reject(time.monotonic() - enqueued_at)
+            self._rejecter(item)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 from configparser import ConfigParser
+from common.async_server import AsyncServer
+from common.multiprocess_server import MultiprocessServer
 from common.server import Server
+from common.lottery import number_of_agencies
+from common import log_queue, utils
 import logging
 import os
 
@@ -25,7 +29,27 @@ def initialize_config():
     try:
         config_params["port"] = int(os.getenv('SERVER_PORT', config["DEFAULT"]["SERVER_PORT"]))
         config_params["listen_backlog"] = int(os.getenv('SERVER_LISTEN_BACKLOG', config["DEFAULT"]["SERVER_LISTEN_BACKLOG"]))
+        config_params["server_mode"] = os.getenv('SERVER_MODE', config["DEFAULT"]["SERVER_MODE"])
+        config_params["workers"] = int(os.getenv('SERVER_WORKERS', config["DEFAULT"]["SERVER_WORKERS"]))
+        config_params["queue_size"] = int(os.getenv('SERVER_QUEUE_SIZE', config["DEFAULT"]["SERVER_QUEUE_SIZE"]))
+        config_params["queue_timeout"] = float(os.getenv('SERVER_QUEUE_TIMEOUT', config["DEFAULT"]["SERVER_QUEUE_TIMEOUT"]))
+        config_params["idle_timeout"] = float(os.getenv('SERVER_IDLE_TIMEOUT', config["DEFAULT"]["SERVER_IDLE_TIMEOUT"]))
+        config_params["processes"] = int(os.getenv('SERVER_PROCESSES', config["DEFAULT"]["SERVER_PROCESSES"]))
+        config_params["storage_backend"] = os.getenv('STORAGE_BACKEND', config["DEFAULT"]["STORAGE_BACKEND"])
+        config_params["storage_fsync"] = parse_bool(os.getenv('STORAGE_FSYNC', config["DEFAULT"]["STORAGE_FSYNC"]))
+        config_params["storage_sharded"] = parse_bool(os.getenv('STORAGE_SHARDED', config["DEFAULT"]["STORAGE_SHARDED"]))
+        config_params["dedup_bets"] = parse_bool(os.getenv('DEDUP_BETS', config["DEFAULT"]["DEDUP_BETS"]))
+        config_params["group_commit"] = parse_bool(os.getenv('GROUP_COMMIT', config["DEFAULT"]["GROUP_COMMIT"]))
+        config_params["group_commit_window"] = float(os.getenv('GROUP_COMMIT_WINDOW', config["DEFAULT"]["GROUP_COMMIT_WINDOW"]))
+        config_params["group_commit_max_bets"] = int(os.getenv('GROUP_COMMIT_MAX_BETS', config["DEFAULT"]["GROUP_COMMIT_MAX_BETS"]))
+        config_params["ingestion_parsers"] = int(os.getenv('INGESTION_PARSERS', config["DEFAULT"]["INGESTION_PARSERS"]))
+        config_params["ingestion_queue_size"] = int(os.getenv('INGESTION_QUEUE_SIZE', config["DEFAULT"]["INGESTION_QUEUE_SIZE"]))
+        config_params["metrics_port"] = int(os.getenv('METRICS_PORT', config["DEFAULT"]["METRICS_PORT"]))
+        config_params["metrics_host"] = os.getenv('METRICS_HOST', config["DEFAULT"]["METRICS_HOST"])
+        config_params["checkpoint_interval"] = float(os.getenv('CHECKPOINT_INTERVAL', config["DEFAULT"]["CHECKPOINT_INTERVAL"]))
         config_params["logging_level"] = os.getenv('LOGGING_LEVEL', config["DEFAULT"]["LOGGING_LEVEL"])
+        config_params["logging_queue"] = parse_bool(os.getenv('LOGGING_QUEUE', config["DEFAULT"]["LOGGING_QUEUE"]))
+        config_params["logging_sample_every"] = int(os.getenv('LOGGING_SAMPLE_EVERY', config["DEFAULT"]["LOGGING_SAMPLE_EVERY"]))
     except KeyError as e:
         raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
     except ValueError as e:
@@ -34,35 +58,99 @@ def initialize_config():
     return config_params
 
 
+def parse_bool(value):
+    """ Parses 'true'/'false' (case insensitive) config values """
+    if value.lower() == "true":
+        return True
+    if value.lower() == "false":
+        return False
+    raise ValueError(f"invalid boolean value: {value}")
+
+
 def main():
     config_params = initialize_config()
     logging_level = config_params["logging_level"]
-    port = config_params["port"]
-    listen_backlog = config_params["listen_backlog"]
 
-    initialize_log(logging_level)
+    initialize_log(logging_level, config_params["logging_queue"], config_params["logging_sample_every"])
 
     # Log config parameters at the beginning of the program to verify the configuration
     # of the component
-    logging.debug(f"action: config | result: success | port: {port} | "
-                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level}")
+    logging.debug("action: config | result: success | " +
+                  " | ".join(f"{key}: {value}" for key, value in config_params.items()))
+
+    # One shard per agency, created before the server processes are forked
+    shards = number_of_agencies() if config_params["storage_sharded"] else 0
+    utils.configure_storage(config_params["storage_backend"], config_params["storage_fsync"], shards)
+    if config_params["dedup_bets"]:
+        # Indexed before forking, so the server processes inherit the index
+        indexed = utils.configure_dedup(shared=config_params["server_mode"] == "processes")
+        logging.info(f'action: dedup_index | result: success | bets: {indexed}')
 
     # Initialize server and start server loop
-    server = Server(port, listen_backlog)
+    server = initialize_server(config_params)
     server.run()
 
-def initialize_log(logging_level):
+def initialize_server(config_params):
+    """
+    Builds the server engine selected by SERVER_MODE
+
+    'threads' uses a fixed worker pool fed by an admission queue, 'asyncio' serves every
+    connection from a single event loop and 'processes' runs SERVER_PROCESSES threaded
+    servers sharing the port through SO_REUSEPORT (0 means one per core)
+
+    With CHECKPOINT_INTERVAL > 0 the lottery state is checkpointed every that many seconds
+    and restored on startup
+
+    In 'threads' and 'processes' a connection that sends nothing for SERVER_IDLE_TIMEOUT
+    seconds is closed, so an idle agency does not keep a pool worker (0 disables it)
+    """
+    server_mode = config_params["server_mode"]
+    port = config_params["port"]
+    listen_backlog = config_params["listen_backlog"]
+    writer_params = {
+        "group_commit_window": config_params["group_commit_window"] if config_params["group_commit"] else None,
+        "group_commit_max_bets": config_params["group_commit_max_bets"],
+        "ingestion_parsers": config_params["ingestion_parsers"],
+        "ingestion_queue_size": config_params["ingestion_queue_size"],
+    }
+    server_params = {
+        "workers": config_params["workers"],
+        "queue_size": config_params["queue_size"],
+        "queue_timeout": config_params["queue_timeout"],
+        "idle_timeout": config_params["idle_timeout"],
+        "metrics_port": config_params["metrics_port"],
+        "metrics_host": config_params["metrics_host"],
+        **writer_params,
+    }
+    checkpoint_interval = config_params["checkpoint_interval"]
+    if server_mode == "threads":
+        return Server(port, listen_backlog, checkpoint_interval=checkpoint_interval, **server_params)
+    if server_mode == "asyncio":
+        return AsyncServer(port, listen_backlog, metrics_port=config_params["metrics_port"], metrics_host=config_params["metrics_host"],
+                           checkpoint_interval=checkpoint_interval, **writer_params)
+    if server_mode == "processes":
+        return MultiprocessServer(port, listen_backlog, config_params["processes"], server_params, checkpoint_interval)
+    raise ValueError(f"Unknown server mode: {server_mode}. Aborting server")
+
+def initialize_log(logging_level, queued=False, sample_every=1):
     """
     Python custom logging initialization
 
     Current timestamp is added to be able to identify in docker
     compose logs the date when the log has arrived
+
+    With LOGGING_QUEUE the records are formatted and written by a background
+    thread, so logging never blocks a request on stdout/stderr. With
+    LOGGING_SAMPLE_EVERY > 1 only one of every that many lines of the
+    high-frequency actions (per batch or per connection) is logged
     """
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging_level,
-        datefmt='%Y-%m-%d %H:%M:%S',
-    )
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    if queued:
+        handler = log_queue.queue_handler(handler)
+    if sample_every > 1:
+        handler.addFilter(log_queue.SamplingFilter(sample_every))
+    logging.basicConfig(level=logging_level, handlers=[handler])
 
 
 if __name__ == "__main__":
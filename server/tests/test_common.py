@@ -1,12 +1,42 @@
 from common.utils import *
+from benchmark import encode_batch, percentile, synthetic_bets
+from common.binary_batch import decode_bets, encode_bets
+from common import binary_batch, dedup, draw_engine, log_queue, storage
+from common.async_server import AsyncServer
+from common.checkpoint import Checkpointer, LotteryCheckpoint, save_checkpoint
+from common.draw_engine import DrawRule
+from common.client_handler import BatchWindow, ClientHandler, decode_batch
+from common.group_commit import GroupCommitWriter
+from common.ingestion_pipeline import IngestionPipeline
+from common.lottery import Lottery, number_of_agencies
+from common.multiprocess_server import MultiprocessServer
+from common.metrics import MetricsRegistry, MetricsServer
+from common.protocol_uitls import COMPRESSION_THRESHOLD, ConnectionClosed, FrameReader, OperationCode, SerializationError, SimpleProtocol
+from common.winners_notifier import WinnersNotifier
+from common.worker_pool import WorkerPool
+import io
+import logging
+import multiprocessing
 import os
+import random
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+import zlib
+
+def remove_stored_bets():
+    for path in (STORAGE_FILEPATH, os.path.splitext(STORAGE_FILEPATH)[0] + '.document.idx'):
+        if os.path.exists(path):
+            os.remove(path)
 
 class TestUtils(unittest.TestCase):
 
     def tearDown(self):
-        if os.path.exists(STORAGE_FILEPATH):
-            os.remove(STORAGE_FILEPATH)
+        remove_stored_bets()
 
     def test_bet_init_must_keep_fields(self):
         b = Bet('1', 'first', 'last', '10000000','2000-12-20', 7500)
@@ -54,6 +84,1002 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(b1.birthdate, b2.birthdate)
         self.assertEqual(b1.number, b2.number)
 
+    def test_binary_batch_round_trip_keeps_fields_data(self):
+        to_encode = [
+            Bet('1', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033),
+            Bet('2', 'first', 'last', '10000000', '1965-12-20', LOTTERY_WINNER_NUMBER),
+        ]
+        decoded = decode_bets(encode_bets(to_encode))
+
+        self.assertEqual(2, len(decoded))
+        self._assert_equal_bets(to_encode[0], decoded[0])
+        self._assert_equal_bets(to_encode[1], decoded[1])
+
+    def test_binary_batch_truncated_payload_is_rejected(self):
+        payload = encode_bets([Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)])
+        with self.assertRaises(ValueError):
+            decode_bets(payload[:-1])
+
+    def test_binary_batch_with_a_number_out_of_the_stored_range_is_answered_with_an_error(self):
+        payload = encode_bets([Bet('1', 'first', 'last', '10000000', '2000-12-20', 3000000000)])
+        with self.assertRaises(ValueError):
+            decode_bets(payload)
+
+        response = ClientHandler.handle_operation(OperationCode.BATCH_BINARY, payload, '127.0.0.1',
+                                                  logging, Lottery(), threading.Lock(), threading.Lock())
+        self.assertEqual(OperationCode.ERROR, response[0])
+        self.assertFalse(os.path.exists(STORAGE_FILEPATH))
+
+    def test_binary_batch_with_a_birthdate_out_of_the_date_range_is_answered_with_an_error(self):
+        payload = bytearray(encode_bets([Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)]))
+        for days in (10 ** 9, -10 ** 9):
+            binary_batch.FIXED_RECORD.pack_into(payload, binary_batch.BATCH_COUNT.size, 1, 10000000, days, 7500)
+            with self.assertRaises(ValueError):
+                binary_batch.decode_bet_batch(payload)
+
+        response = ClientHandler.handle_operation(OperationCode.BATCH_BINARY, payload, '127.0.0.1',
+                                                  logging, Lottery(), threading.Lock(), threading.Lock())
+        self.assertEqual(OperationCode.ERROR, response[0])
+        self.assertFalse(os.path.exists(STORAGE_FILEPATH))
+
+class TestBetBatch(unittest.TestCase):
+
+    def test_batch_keeps_bets_fields_data(self):
+        to_batch = [
+            Bet('1', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033),
+            Bet('2', 'first', 'last', '10000000', '1965-12-20', LOTTERY_WINNER_NUMBER),
+        ]
+        batch = BetBatch.from_bets(to_batch)
+
+        self.assertEqual(2, len(batch))
+        for expected, bet in zip(to_batch, batch):
+            TestUtils._assert_equal_bets(self, expected, bet)
+
+    def test_extend_with_batch_keeps_strings_of_both(self):
+        batch = BetBatch.from_bets([Bet('1', 'a', 'b', '1', '2000-01-01', 1)])
+        batch.extend(BetBatch.from_bets([Bet('2', 'c', 'd', '2', '2000-01-01', LOTTERY_WINNER_NUMBER)]))
+
+        self.assertEqual(['1', 'a', 'b'], batch.strings(0))
+        self.assertEqual(['2'], [bet.document for bet in batch.bets_with_number(LOTTERY_WINNER_NUMBER)])
+
+    def test_store_batch_and_load_batches_keeps_fields_data(self):
+        to_store = [Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)]
+        store_bets(BetBatch.from_bets(to_store))
+        batches = list(load_bet_batches())
+
+        self.assertEqual(1, len(batches))
+        TestUtils._assert_equal_bets(self, to_store[0], batches[0].bet(0))
+
+    def test_out_of_range_bet_is_rejected_keeping_the_columns_aligned(self):
+        batch = BetBatch.from_bets([Bet('1', 'a', 'b', '1', '2000-01-01', 1)])
+        with self.assertRaises(ValueError):
+            batch.append_bet(Bet('2', 'c', 'd', '2', '2000-01-01', 99999999999))
+
+        self.assertEqual((1, 1, 1), (len(batch.agencies), len(batch.numbers), len(batch.birthdates)))
+
+    def test_out_of_range_batch_is_answered_with_an_error(self):
+        response = ClientHandler.handle_operation(OperationCode.BATCH, '1,a,b,10,2000-01-01,99999999999', '127.0.0.1',
+                                                  logging, Lottery(), threading.Lock(), threading.Lock())
+
+        self.assertEqual(OperationCode.ERROR, response[0])
+        self.assertFalse(os.path.exists(STORAGE_FILEPATH))
+
+    def tearDown(self):
+        remove_stored_bets()
+
+class TestBinaryBetStorage(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        storage.set_storage(storage.BinaryBetStorage(os.path.join(self._directory.name, 'bets')))
+
+    def tearDown(self):
+        storage.set_storage(None)
+        self._directory.cleanup()
+
+    def test_store_bets_and_load_bets_keeps_registry_order(self):
+        to_store = [
+            Bet('1', 'first_0', 'last_0', '10000000', '2000-12-20', 7500),
+            Bet('2', 'first_1', 'last_1', '10000001', '1960-12-21', LOTTERY_WINNER_NUMBER),
+        ]
+        store_bets(to_store)
+        from_load = list(load_bets())
+
+        self.assertEqual(2, len(from_load))
+        TestUtils._assert_equal_bets(self, to_store[0], from_load[0])
+        TestUtils._assert_equal_bets(self, to_store[1], from_load[1])
+
+    def test_indexed_loads_only_return_matching_bets(self):
+        store_bets([Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER)])
+        store_bets([
+            Bet('2', 'b', 'b', '2', '2000-01-01', 1),
+            Bet('2', 'c', 'c', '3', '2000-01-01', LOTTERY_WINNER_NUMBER),
+        ])
+
+        self.assertEqual(['2', '3'], [bet.document for bet in load_bets_for_agency(2)])
+        self.assertEqual(['1', '3'], [bet.document for bet in load_bets_with_number(LOTTERY_WINNER_NUMBER)])
+        self.assertEqual([], list(load_bets_for_agency(3)))
+
+class TestShardedBetStorage(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        storage.set_storage(storage.ShardedBetStorage(storage.CSV_BACKEND, self._directory.name, 2))
+
+    def tearDown(self):
+        storage.set_storage(None)
+        self._directory.cleanup()
+
+    def test_mixed_batch_is_split_by_agency_shard(self):
+        store_bets([
+            Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER),
+            Bet('2', 'b', 'b', '2', '2000-01-01', 1),
+            Bet('1', 'c', 'c', '3', '2000-01-01', 2),
+        ])
+
+        self.assertEqual(['agency-1.csv', 'agency-1.document.idx', 'agency-2.csv', 'agency-2.document.idx'],
+                         sorted(os.listdir(self._directory.name)))
+        self.assertEqual(['1', '3'], [bet.document for bet in load_bets_for_agency(1)])
+        self.assertEqual(['1'], [bet.document for bet in load_bets_with_number(LOTTERY_WINNER_NUMBER)])
+        self.assertEqual(['1', '2', '3'], sorted(bet.document for bet in load_bets()))
+
+        bets_lock = threading.Lock()
+        self.assertIsNot(bets_lock, storage_lock(bets_lock))
+
+    def test_agencies_without_bets_load_empty(self):
+        store_bets([Bet('3', 'a', 'a', '1', '2000-01-01', 1)])
+
+        self.assertEqual([], list(load_bets_for_agency(1)))
+        self.assertEqual([], list(load_bets_for_agency(2)))
+        self.assertEqual([3], [bet.agency for bet in load_bets()])
+
+class TestLookup(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._directory.name, 'bets.csv')
+        storage.set_storage(storage.CsvBetStorage(self._path))
+
+    def tearDown(self):
+        storage.set_storage(None)
+        self._directory.cleanup()
+
+    def _lookup(self, message):
+        return ClientHandler.handle_operation(OperationCode.LOOKUP, message, '127.0.0.1', logging, Lottery(),
+                                              threading.Lock(), threading.Lock())
+
+    def test_bets_are_looked_up_by_document_from_the_index(self):
+        store_bets([
+            Bet('1', 'José', 'a,b', '10', '2000-01-01', 1),
+            Bet('2', 'b', 'b', '20', '2000-01-02', 2),
+            Bet('3', 'c', 'c', '10', '2000-01-03', 3),
+        ])
+
+        self.assertEqual((OperationCode.LOOKUP, '1,José,a,b,10,2000-01-01,1;3,c,c,10,2000-01-03,3'), self._lookup('10'))
+        self.assertEqual((OperationCode.LOOKUP, '3,c,c,10,2000-01-03,3'), self._lookup('10,3'))
+        self.assertEqual((OperationCode.LOOKUP, ''), self._lookup('30'))
+
+    def test_missing_index_is_built_from_the_stored_bets(self):
+        store_bets([Bet('1', 'a', 'a', '10', '2000-01-01', 1), Bet('2', 'b', 'b', '20', '2000-01-02', 2)])
+        os.remove(os.path.join(self._directory.name, 'bets.document.idx'))
+        storage.set_storage(storage.CsvBetStorage(self._path))
+
+        self.assertEqual([2], [bet.number for bet in load_bets_by_document('20')])
+
+class TestLottery(unittest.TestCase):
+
+    def tearDown(self):
+        remove_stored_bets()
+
+    def _ready_lottery(self):
+        lottery = Lottery()
+        for agency_id in range(1, len(lottery.agencies()) + 1):
+            lottery.mark_agency_ready(agency_id)
+        return lottery
+
+    def test_winners_recorded_during_ingestion_are_drawn(self):
+        lottery = self._ready_lottery()
+        lottery.recover_winners()
+        lottery.record_bets([
+            Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'b', 'b', '2', '2000-01-01', 1),
+            Bet('2', 'c', 'c', '3', '2000-01-01', LOTTERY_WINNER_NUMBER),
+        ])
+        lottery.make_draw()
+
+        self.assertEqual('1', lottery.get_winners_for_agency(1))
+        self.assertEqual('3', lottery.get_winners_for_agency(2))
+
+    def test_recover_winners_rebuilds_state_from_storage(self):
+        store_bets([
+            Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'b', 'b', '2', '2000-01-01', LOTTERY_WINNER_NUMBER),
+        ])
+        lottery = self._ready_lottery()
+        lottery.recover_winners()
+        lottery.make_draw()
+
+        self.assertEqual('1,2', lottery.get_winners_for_agency(1))
+        self.assertEqual('', lottery.get_winners_for_agency(2))
+
+    def test_winners_payloads_are_cached_after_the_draw(self):
+        lottery = self._ready_lottery()
+        lottery.recover_winners()
+        lottery.record_bets([
+            Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'b', 'b', '2', '2000-01-01', LOTTERY_WINNER_NUMBER),
+        ])
+        self.assertIsNone(lottery.winners_payload(1))
+
+        lottery.make_draw()
+
+        self.assertEqual(b'1,2', lottery.winners_payload(1))
+        self.assertEqual(b'', lottery.winners_payload(2))
+        lottery.recover_winners()
+        self.assertIsNone(lottery.winners_payload(1))
+
+    def test_shared_state_draws_once_and_shares_the_winners(self):
+        store_bets([Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER)])
+        agencies = multiprocessing.Array('b', number_of_agencies())
+        draw_flag = multiprocessing.Value('b', False)
+        with tempfile.TemporaryDirectory() as directory:
+            winners_path = os.path.join(directory, 'lottery.winners')
+            drawer = Lottery(agencies, draw_flag, shared_winners_path=winners_path)
+            other = Lottery(agencies, draw_flag, shared_winners_path=winners_path)
+            for agency_id in range(1, len(agencies) + 1):
+                other.mark_agency_ready(agency_id)
+            self.assertTrue(drawer.all_agencies_ready())
+
+            drawer.make_draw()
+            self.assertTrue(other.draw_done())
+            # el otro proceso usa los ganadores del sorteo, sin recorrer las apuestas
+            remove_stored_bets()
+            self.assertEqual('1', other.get_winners_for_agency(1))
+            self.assertEqual(b'1', other.winners_payload(1))
+
+class TestMultiprocessServer(unittest.TestCase):
+
+    def setUp(self):
+        remove_stored_bets()
+        self.handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+        self.directory = tempfile.TemporaryDirectory()
+        self.winners_path = os.path.join(self.directory.name, 'lottery.winners')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        self.directory.cleanup()
+        remove_stored_bets()
+
+    def server(self) -> MultiprocessServer:
+        return MultiprocessServer(self.port, 5, 2, {'workers': 2, 'queue_size': 10, 'queue_timeout': 5},
+                                  shared_winners_path=self.winners_path)
+
+    def request(self, op, message):
+        for _ in range(100):
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+                    SimpleProtocol.serialize_to_socket(sock, op, message)
+                    if op == OperationCode.READY:
+                        return None
+                    return SimpleProtocol.deserialize_from_socket(sock)
+            except ConnectionRefusedError:
+                # los workers todavia no escuchan
+                time.sleep(0.05)
+        raise AssertionError('el servidor no acepta conexiones')
+
+    def test_workers_share_the_draw(self):
+        server = self.server()
+        results = {}
+
+        def client():
+            try:
+                results['ack'] = self.request(OperationCode.BATCH, '1,A,B,30904465,1999-03-17,7574')
+                for agency_id in range(1, number_of_agencies() + 1):
+                    self.request(OperationCode.READY, str(agency_id))
+                # cada consulta puede atenderla un worker distinto
+                for agency_id in (1, 1, 2, 2):
+                    op, message = self.request(OperationCode.WINNERS, str(agency_id))
+                    while op == OperationCode.NOT_READY:
+                        time.sleep(0.05)
+                        op, message = self.request(OperationCode.WINNERS, str(agency_id))
+                    results.setdefault(agency_id, set()).add((op, message))
+                results['shared'] = os.path.exists(self.winners_path)
+            finally:
+                server._shutdown()
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        server.run()
+        thread.join()
+
+        self.assertEqual(OperationCode.CONFIRMACION, results['ack'][0])
+        self.assertEqual({(OperationCode.WINNERS, '30904465')}, results[1])
+        self.assertEqual({(OperationCode.WINNERS, '')}, results[2])
+        self.assertTrue(results['shared'])
+
+    def test_exits_with_an_error_when_the_workers_fail(self):
+        with socket.socket() as sock:
+            # sin SO_REUSEPORT ningun worker puede escuchar en el puerto
+            sock.bind(('', self.port))
+            sock.listen()
+            with self.assertRaises(SystemExit) as exit:
+                self.server().run()
+        self.assertEqual(1, exit.exception.code)
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._directory.name, 'lottery.ckpt')
+        storage.set_storage(storage.CsvBetStorage(os.path.join(self._directory.name, 'bets.csv')))
+
+    def tearDown(self):
+        storage.set_storage(None)
+        self._directory.cleanup()
+
+    def test_restart_replays_only_bets_after_the_checkpoint(self):
+        lottery = Lottery(checkpoint_path=self._path)
+        lottery.mark_agency_ready(1)
+        store_bets([Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER)])
+        checkpointer = Checkpointer(lottery, 60, self._path)
+        self.assertTrue(checkpointer.write())
+        self.assertFalse(checkpointer.write())
+        store_bets([Bet('2', 'b', 'b', '2', '2000-01-01', LOTTERY_WINNER_NUMBER)])
+
+        restarted = Lottery(checkpoint_path=self._path)
+        restarted.recover_winners()
+        restarted.restore_checkpoint()
+
+        self.assertEqual([True, False], restarted.agencies()[:2])
+        for agency_id in range(2, len(restarted.agencies()) + 1):
+            restarted.mark_agency_ready(agency_id)
+        self.assertEqual('1', restarted.get_winners_for_agency(1))
+        self.assertEqual('2', restarted.get_winners_for_agency(2))
+
+    def test_checkpoint_past_the_storage_is_ignored(self):
+        checkpoint = LotteryCheckpoint(storage.CSV_BACKEND, 1000, str(Lottery().rule()), [True] * 5, True, {})
+        save_checkpoint(self._path, checkpoint)
+
+        lottery = Lottery(checkpoint_path=self._path)
+        lottery.restore_checkpoint()
+
+        self.assertFalse(lottery.draw_done())
+        self.assertFalse(any(lottery.agencies()))
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        storage.set_storage(storage.CsvBetStorage(os.path.join(self._directory.name, 'bets.csv')))
+        configure_dedup()
+
+    def tearDown(self):
+        configure_dedup(False)
+        storage.set_storage(None)
+        self._directory.cleanup()
+
+    def test_retried_batch_is_not_stored_twice(self):
+        batch = [
+            Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'b', 'b', '2', '2000-01-01', 1),
+        ]
+        self.assertEqual(2, len(store_bets(batch)))
+        stored = store_bets(batch + [Bet('1', 'c', 'c', '3', '2000-01-01', 1), Bet('1', 'c', 'c', '3', '2000-01-01', 1)])
+
+        self.assertEqual(['3'], [bet.document for bet in stored])
+        self.assertEqual(['1', '2', '3'], [bet.document for bet in load_bets()])
+        # el indice se reconstruye desde el almacenamiento
+        self.assertEqual(3, configure_dedup())
+        self.assertEqual(0, len(store_bets(batch)))
+
+    def test_fingerprint_collisions_are_confirmed_against_storage(self):
+        original = dedup.fingerprint
+        dedup.fingerprint = lambda agency, document, number: 1
+        try:
+            store_bets([Bet('1', 'a', 'a', '1', '2000-01-01', 1)])
+            stored = store_bets([Bet('1', 'b', 'b', '2', '2000-01-01', 1), Bet('1', 'a', 'a', '1', '2000-01-01', 1)])
+        finally:
+            dedup.fingerprint = original
+
+        self.assertEqual(['2'], [bet.document for bet in stored])
+
+    def test_shared_filter_holds_the_bets_lock_with_sharded_storage(self):
+        storage.set_storage(storage.ShardedBetStorage(storage.CSV_BACKEND, self._directory.name, 2))
+        bets_lock = multiprocessing.Lock()
+        configure_dedup(shared=False)
+        self.assertIsNot(bets_lock, storage_lock(bets_lock))
+
+        # otro proceso puede guardar la misma apuesta entre la verificacion y la escritura
+        configure_dedup(shared=True)
+        self.assertIs(bets_lock, storage_lock(bets_lock))
+
+class TestBatchWindow(unittest.TestCase):
+
+    def test_acks_are_cumulative(self):
+        window = BatchWindow()
+        for request_id in (1, 2, 3):
+            self.assertTrue(window.accepts(request_id))
+            self.assertIsNone(window.record(request_id, None))
+
+        self.assertEqual((OperationCode.CONFIRMACION, 'Apuestas recibidas', 3), window.take_ack())
+        self.assertIsNone(window.take_ack())
+
+    def test_ack_reports_the_duplicates_of_every_batch_it_confirms(self):
+        window = BatchWindow()
+        window.record(1, None, 2)
+        window.record(2, None, 0)
+        window.record(3, None, 1)
+
+        self.assertEqual((OperationCode.CONFIRMACION, 'Apuestas recibidas, duplicadas: 3', 3), window.take_ack())
+
+    def test_batches_after_a_failure_are_dropped_until_it_is_resent(self):
+        window = BatchWindow()
+        window.record(1, None)
+        self.assertEqual((OperationCode.ERROR, 'bad', 2), window.record(2, ValueError('bad')))
+
+        self.assertFalse(window.accepts(3))
+        self.assertIsNone(window.take_ack())
+        self.assertTrue(window.accepts(2))
+        self.assertTrue(window.accepts(3))
+
+class TestWinnersNotifier(unittest.TestCase):
+
+    def tearDown(self):
+        remove_stored_bets()
+
+    def test_subscribers_receive_winners_when_the_draw_is_done(self):
+        lottery = Lottery()
+        lottery.recover_winners()
+        lottery.record_bets([Bet('1', 'a', 'a', '1', '2000-01-01', LOTTERY_WINNER_NUMBER)])
+        notifier = WinnersNotifier(lottery, threading.Lock())
+        sent = {}
+        notifier.subscribe(1, lambda payload: sent.setdefault(1, payload), lambda: None)
+        notifier.notify()
+        self.assertEqual({}, sent)
+
+        for agency_id in range(1, len(lottery.agencies()) + 1):
+            lottery.mark_agency_ready(agency_id)
+        lottery.make_draw()
+        notifier.notify()
+        notifier.subscribe(2, lambda payload: sent.setdefault(2, payload), lambda: None)
+
+        self.assertEqual({1: b'1', 2: b''}, sent)
+
+class TestDrawEngine(unittest.TestCase):
+
+    def test_draw_matches_has_won(self):
+        bets = [Bet(str(i % 3 + 1), 'a', 'b', str(i), '2000-01-01', LOTTERY_WINNER_NUMBER if i % 4 == 0 else i)
+                for i in range(20)]
+        expected = {}
+        for bet in bets:
+            if has_won(bet):
+                expected.setdefault(bet.agency, []).append(bet.document)
+
+        winners = draw_engine.draw([BetBatch.from_bets(bets)], DrawRule([LOTTERY_WINNER_NUMBER]))
+
+        self.assertEqual(expected, {agency: [bet.document for bet in agency_winners]
+                                    for agency, agency_winners in winners.items()})
+
+    def test_rule_with_numbers_and_ranges(self):
+        rule = DrawRule.parse('7574, 10-12')
+        batch = BetBatch.from_bets(Bet('1', 'a', 'b', str(n), '2000-01-01', n) for n in (9, 10, 12, 13, 7574))
+
+        winners = draw_engine.draw([batch], rule)
+
+        self.assertEqual(['10', '12', '7574'], [bet.document for bet in winners[1]])
+
+    def test_parallel_draw_over_csv_chunks_keeps_stored_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_storage = storage.CsvBetStorage(os.path.join(directory, 'bets.csv'))
+            csv_storage.store(BetBatch.from_bets(
+                Bet(str(i % 2 + 1), 'Nicolás', 'b', str(i), '2000-01-01', LOTTERY_WINNER_NUMBER if i % 3 == 0 else i)
+                for i in range(60)))
+            chunks = csv_storage.chunks(100)
+            rule = DrawRule([LOTTERY_WINNER_NUMBER])
+
+            self.assertGreater(len(chunks), 2)
+            self.assertEqual(60, sum(len(batch) for chunk in chunks for batch in chunk.load_batches()))
+            expected = draw_engine.draw(csv_storage.load_batches(), rule)
+            winners = draw_engine.draw_parallel(chunks, rule, 2)
+
+        self.assertEqual({agency: [bet.document for bet in bets] for agency, bets in expected.items()},
+                         {agency: [bet.document for bet in bets] for agency, bets in winners.items()})
+
+class TestGroupCommitWriter(unittest.TestCase):
+
+    def tearDown(self):
+        remove_stored_bets()
+
+    def test_concurrent_writes_are_stored_before_returning(self):
+        writer = GroupCommitWriter(threading.Lock(), window=0.01)
+        writer.start()
+        threads = [
+            threading.Thread(target=writer.write, args=([Bet(str(i), 'a', 'b', str(i), '2000-01-01', i)],))
+            for i in range(1, 6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.stop()
+
+        self.assertEqual([1, 2, 3, 4, 5], sorted(bet.agency for bet in load_bets()))
+
+    def test_write_raises_the_storage_error(self):
+        writer = GroupCommitWriter(threading.Lock(), window=0)
+        writer.start()
+        with self.assertRaises(AttributeError):
+            writer.write([object()])
+        writer.stop()
+
+    def test_an_invalid_batch_only_fails_its_own_write(self):
+        writer = GroupCommitWriter(threading.Lock(), window=0.5)
+        good = writer.submit([Bet('1', 'a', 'b', '10', '2000-01-01', 7)])
+        bad = writer.submit([object()])
+        writer.start()
+        self.assertEqual(0, good.wait())
+        with self.assertRaises(AttributeError):
+            bad.wait()
+        writer.stop()
+
+        self.assertEqual(['10'], [bet.document for bet in load_bets()])
+
+class TestIngestionPipeline(unittest.TestCase):
+
+    def tearDown(self):
+        remove_stored_bets()
+
+    def test_batches_are_parsed_and_stored_before_returning(self):
+        pipeline = IngestionPipeline(decode_batch, threading.Lock(), parsers=2, window=0)
+        pipeline.start()
+        amount = pipeline.ingest(OperationCode.BATCH, '1,a,b,10,2000-01-01,7;1,c,d,11,2000-01-02,8')
+        with self.assertRaises(ValueError):
+            pipeline.ingest(OperationCode.BATCH, '1,a,b,12,not-a-date,9')
+        pipeline.stop()
+
+        self.assertEqual(2, amount)
+        self.assertEqual(['10', '11'], [bet.document for bet in load_bets()])
+        stats = pipeline.stage_stats()
+        self.assertEqual(2, stats['parse']['processed'])
+        self.assertEqual(1, stats['store']['processed'])
+
+class TestMetrics(unittest.TestCase):
+
+    def test_metrics_server_renders_counters_and_cumulative_histograms(self):
+        registry = MetricsRegistry()
+        frames = registry.counter('frames_total', 'frames', ('op',))
+        latency = registry.histogram('store_seconds', 'latency', (0.1, 1.0))
+        frames.inc('BATCH')
+        frames.inc('BATCH', amount=2)
+        latency.observe(0.05)
+        latency.observe(0.5)
+        registry.register_collector(lambda: [('queue_depth', 'depth', {'stage': 'parse'}, 3)])
+        server = MetricsServer(0, registry, host='127.0.0.1')
+        server.start()
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port()}/metrics') as response:
+                text = response.read().decode('utf-8')
+        finally:
+            server.stop()
+
+        self.assertIn('frames_total{op="BATCH"} 3', text)
+        self.assertIn('store_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('store_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('store_seconds_count 2', text)
+        self.assertIn('queue_depth{stage="parse"} 3', text)
+
+    def test_metrics_server_is_scraped_from_the_local_interface_by_default(self):
+        registry = MetricsRegistry()
+        registry.counter('frames_total', 'frames', ('op',)).inc('BATCH')
+        server = MetricsServer(0, registry)
+        server.start()
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port()}/', timeout=5) as response:
+                status, text = response.status, response.read().decode('utf-8')
+            address = server._httpd.server_address[0]
+        finally:
+            server.stop()
+
+        self.assertEqual('127.0.0.1', address)
+        self.assertEqual(200, status)
+        self.assertIn('frames_total{op="BATCH"} 1', text)
+
+class TestLogQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.output = io.StringIO()
+        self.stream_handler = logging.StreamHandler(self.output)
+        self.stream_handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger = logging.getLogger('test_log_queue')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        log_queue.stop()
+        self.logger.handlers.clear()
+
+    def test_queued_lines_keep_the_format_and_are_written_on_stop(self):
+        self.logger.addHandler(log_queue.queue_handler(self.stream_handler))
+        for amount in range(3):
+            self.logger.info('action: apuesta_recibida | result: success | cantidad: %d', amount)
+        self.logger.error('action: sorteo | result: fail | error: %s', 'boom')
+        log_queue.stop()
+
+        self.assertEqual(['INFO action: apuesta_recibida | result: success | cantidad: 0',
+                          'INFO action: apuesta_recibida | result: success | cantidad: 1',
+                          'INFO action: apuesta_recibida | result: success | cantidad: 2',
+                          'ERROR action: sorteo | result: fail | error: boom'], self.output.getvalue().splitlines())
+
+    def test_forked_child_restarts_a_single_writer_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            file_handler = logging.FileHandler(path)
+            file_handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            for _ in range(3):
+                self.logger.handlers = [log_queue.queue_handler(file_handler)]
+
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self.logger.info('action: hijo | result: success')
+                    # el hilo que hizo el fork y un solo hilo escritor
+                    status = 0 if threading.active_count() == 2 else 2
+                    log_queue.stop()
+                finally:
+                    os._exit(status)
+            _, status = os.waitpid(pid, 0)
+            file_handler.close()
+            with open(path) as log:
+                lines = log.read().splitlines()
+
+        self.assertEqual(0, os.waitstatus_to_exitcode(status))
+        self.assertEqual(['INFO action: hijo | result: success'], lines)
+
+    def test_sampling_only_drops_high_frequency_info_lines(self):
+        self.stream_handler.addFilter(log_queue.SamplingFilter(3))
+        self.logger.addHandler(self.stream_handler)
+        for amount in range(6):
+            self.logger.info('action: apuesta_recibida | result: success | cantidad: %d', amount)
+            self.logger.error('action: apuesta_recibida | result: fail | cantidad: %d', amount)
+            self.logger.info('action: agencia_lista | result: success | agency_id: %d', amount)
+
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(['INFO action: apuesta_recibida | result: success | cantidad: 0',
+                          'INFO action: apuesta_recibida | result: success | cantidad: 3'],
+                         [line for line in lines if line.startswith('INFO action: apuesta_recibida')])
+        self.assertEqual(6, sum(line.startswith('ERROR') for line in lines))
+        self.assertEqual(6, sum('agencia_lista' in line for line in lines))
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_batches_decode_and_percentiles(self):
+        bets = synthetic_bets(3, 10, random.Random(1))
+        op, payload = encode_batch(bets, text=False)
+
+        self.assertEqual(OperationCode.BATCH_BINARY, op)
+        self.assertEqual([bet.document for bet in bets], [bet.document for bet in decode_bets(payload)])
+        self.assertEqual(2, percentile([4, 1, 3, 2], 0.5))
+        self.assertEqual(4, percentile([4, 1, 3, 2], 0.99))
+
+class TestClientHandlerSession(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.client = socket.create_connection(self.listener.getsockname(), timeout=5)
+        self.connection, _ = self.listener.accept()
+        self.result = {}
+
+    def tearDown(self):
+        self.client.close()
+        self.listener.close()
+        remove_stored_bets()
+
+    def handle(self, idle_timeout) -> threading.Thread:
+        def handle_client():
+            start = time.monotonic()
+            self.result['subscribed'] = ClientHandler.handle_client(self.connection, logging, Lottery(), threading.Lock(),
+                                                                    threading.Lock(), idle_timeout=idle_timeout)
+            self.result['elapsed'] = time.monotonic() - start
+        thread = threading.Thread(target=handle_client)
+        thread.start()
+        return thread
+
+    def test_windowed_session_is_acked_and_ends_on_winners_before_the_draw(self):
+        thread = self.handle(idle_timeout=None)
+        SimpleProtocol.serialize_to_socket(self.client, OperationCode.HANDSHAKE, 'SESSION,BATCH_WINDOW')
+        self.assertEqual((OperationCode.HANDSHAKE, 'SESSION,BATCH_WINDOW'), SimpleProtocol.deserialize_from_socket(self.client))
+
+        SimpleProtocol.send_frames(self.client, [
+            (OperationCode.BATCH, '1,a,b,10,2000-01-01,1', 1),
+            (OperationCode.BATCH, '1,c,d,11,2000-01-01,2', 2),
+            (OperationCode.BATCH, '1,e,f,12,not-a-date,3', 3),
+            (OperationCode.WINNERS, '1', 4),
+        ])
+        replies = []
+        with self.assertRaises(ConnectionClosed):
+            while True:
+                replies.append(SimpleProtocol.deserialize_session_from_socket(self.client))
+        thread.join(5)
+
+        # el error confirma los lotes anteriores y la consulta antes del sorteo cierra la sesion
+        self.assertEqual([OperationCode.ERROR, OperationCode.NOT_READY], [op for op, _, _ in replies[-2:]])
+        self.assertEqual([3, 4], [request_id for _, request_id, _ in replies[-2:]])
+        self.assertFalse(self.result['subscribed'])
+        self.assertEqual(['10', '11'], [bet.document for bet in load_bets()])
+
+    def test_idle_session_is_closed_releasing_the_worker(self):
+        thread = self.handle(idle_timeout=0.2)
+        SimpleProtocol.serialize_to_socket(self.client, OperationCode.HANDSHAKE, 'SESSION')
+        SimpleProtocol.deserialize_from_socket(self.client)
+
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(self.result['elapsed'], 2)
+        self.assertEqual(b'', self.client.recv(1))
+
+    def test_compressed_batch_without_negotiating_compression_is_rejected(self):
+        thread = self.handle(idle_timeout=5)
+        SimpleProtocol.serialize_to_socket(self.client, OperationCode.BATCH, '1,Santiago,Lorenzo,30904465,1999-03-17,7574;' * 100, compress=True)
+
+        self.assertEqual(OperationCode.ERROR, SimpleProtocol.deserialize_from_socket(self.client)[0])
+        thread.join(5)
+        self.assertFalse(os.path.exists(STORAGE_FILEPATH))
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        remove_stored_bets()
+        self.server = AsyncServer(0, 5)
+        self.thread = threading.Thread(target=self.server.run, kwargs={'handle_signals': False})
+        self.thread.start()
+        self.assertTrue(self.server.wait_started(5))
+        self.address = ('127.0.0.1', self.server.port())
+        self.sockets = []
+
+    def tearDown(self):
+        # el servidor espera a que terminen las conexiones abiertas
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        self.thread.join(10)
+        remove_stored_bets()
+
+    def connect(self) -> socket.socket:
+        sock = socket.create_connection(self.address, timeout=5)
+        self.sockets.append(sock)
+        return sock
+
+    def send_ready(self, *agencies):
+        for agency_id in agencies:
+            with socket.create_connection(self.address, timeout=5) as sock:
+                SimpleProtocol.serialize_to_socket(sock, OperationCode.READY, str(agency_id))
+
+    def test_compressed_batch_without_negotiating_compression_is_rejected(self):
+        sock = self.connect()
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.BATCH, ';'.join(['1,Santiago,Lorenzo,30904465,1999-03-17,7574'] * 100), compress=True)
+        self.assertEqual(OperationCode.ERROR, SimpleProtocol.deserialize_from_socket(sock)[0])
+
+        # negociada, la conexion acepta los lotes comprimidos
+        sock = self.connect()
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.HANDSHAKE, 'COMPRESSION')
+        SimpleProtocol.deserialize_from_socket(sock)
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.BATCH, ';'.join(['1,Santiago,Lorenzo,30904465,1999-03-17,7574'] * 100), compress=True)
+        self.assertEqual(OperationCode.CONFIRMACION, SimpleProtocol.deserialize_from_socket(sock, True)[0])
+
+    def test_batches_are_acked_and_stored(self):
+        sock = self.connect()
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.BATCH, '1,A,B,30904465,1999-03-17,7574;1,C,D,1,2000-01-01,1')
+        self.assertEqual(OperationCode.CONFIRMACION, SimpleProtocol.deserialize_from_socket(sock)[0])
+
+        # en una sesion con ventana los lotes se envian sin esperar cada ack
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.HANDSHAKE, 'SESSION,BATCH_WINDOW')
+        self.assertEqual((OperationCode.HANDSHAKE, 'SESSION,BATCH_WINDOW'), SimpleProtocol.deserialize_from_socket(sock))
+        for request_id in range(1, 4):
+            SimpleProtocol.serialize_to_socket(sock, OperationCode.BATCH, f'2,E,F,{request_id},2000-01-01,1', request_id)
+        acked = 0
+        while acked < 3:
+            op, acked, _ = SimpleProtocol.deserialize_session_from_socket(sock)
+            self.assertEqual(OperationCode.CONFIRMACION, op)
+
+        self.assertEqual(5, len(list(load_bets())))
+
+    def test_ready_from_every_agency_makes_the_draw(self):
+        sock = self.connect()
+        SimpleProtocol.serialize_to_socket(sock, OperationCode.BATCH, '1,A,B,30904465,1999-03-17,7574')
+        SimpleProtocol.deserialize_from_socket(sock)
+        self.send_ready(*range(1, len(self.server._lottery.agencies()) + 1))
+
+        for _ in range(100):
+            with socket.create_connection(self.address, timeout=5) as sock:
+                SimpleProtocol.serialize_to_socket(sock, OperationCode.WINNERS, '1')
+                op, message = SimpleProtocol.deserialize_from_socket(sock)
+            if op != OperationCode.NOT_READY:
+                break
+            time.sleep(0.02)
+        self.assertEqual((OperationCode.WINNERS, '30904465'), (op, message))
+
+    def test_subscribers_get_the_winners_of_a_draw_completed_while_shutting_down(self):
+        subscriber = self.connect()
+        SimpleProtocol.serialize_to_socket(subscriber, OperationCode.SUBSCRIBE, '1')
+        agencies = len(self.server._lottery.agencies())
+        self.send_ready(*range(2, agencies))
+        last = self.connect()
+        SimpleProtocol.serialize_to_socket(last, OperationCode.HANDSHAKE, 'SESSION')
+        SimpleProtocol.deserialize_from_socket(last)
+
+        # la ultima agencia completa el sorteo con el servidor ya apagandose
+        self.server.stop()
+        time.sleep(0.1)
+        SimpleProtocol.serialize_to_socket(last, OperationCode.READY, str(agencies), 1)
+        last.close()
+
+        self.assertEqual((OperationCode.WINNERS, ''), SimpleProtocol.deserialize_from_socket(subscriber))
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_queued_item_is_rejected_when_deadline_expires(self):
+        release = threading.Event()
+        handled, rejected = [], []
+
+        def handler(item):
+            release.wait()
+            handled.append(item)
+
+        pool = WorkerPool(1, 1, 0.05, handler, rejected.append)
+        pool.start()
+        pool.submit('a')
+        pool.submit('b')
+        threading.Event().wait(0.1)
+        release.set()
+        pool.shutdown(1)
+
+        self.assertEqual(['a'], handled)
+        self.assertEqual(['b'], rejected)
+        self.assertEqual(1, pool.stats()['rejected'])
+
+    def test_queued_items_wait_for_a_free_worker(self):
+        handled = []
+        pool = WorkerPool(2, 10, 5, handled.append, lambda item: None)
+        pool.start()
+        for i in range(5):
+            pool.submit(i)
+        pool.shutdown(1)
+
+        self.assertEqual(list(range(5)), sorted(handled))
+        self.assertEqual(0, pool.stats()['rejected'])
+
+    def test_shutdown_with_a_full_queue_rejects_the_queued_items(self):
+        release = threading.Event()
+        started = threading.Event()
+        rejected = []
+
+        def handler(item):
+            started.set()
+            release.wait()
+
+        pool = WorkerPool(1, 1, 5, handler, rejected.append)
+        pool.start()
+        pool.submit('a')
+        started.wait(1)
+        pool.submit('b')
+        try:
+            self.assertEqual(1, pool.shutdown(0.1))
+            self.assertEqual(['b'], rejected)
+            self.assertFalse(pool.submit('c'))
+            self.assertEqual(['b', 'c'], rejected)
+        finally:
+            release.set()
+
+    def test_shutdown_returns_when_every_worker_is_blocked_and_the_queue_is_smaller(self):
+        release = threading.Event()
+        busy = threading.Semaphore(0)
+        rejected = []
+
+        def handler(item):
+            busy.release()
+            release.wait()
+
+        pool = WorkerPool(3, 1, 5, handler, rejected.append)
+        pool.start()
+        for item in ('a', 'b', 'c'):
+            pool.submit(item)
+        for _ in range(3):
+            self.assertTrue(busy.acquire(timeout=1))
+        pool.submit('d')
+        result = {}
+        shutdown = threading.Thread(target=lambda: result.setdefault('remaining', pool.shutdown(0.3)))
+        try:
+            shutdown.start()
+            shutdown.join(5)
+            self.assertFalse(shutdown.is_alive())
+            self.assertEqual(3, result['remaining'])
+            self.assertEqual(['d'], rejected)
+        finally:
+            release.set()
+
+class TestFrameReader(unittest.TestCase):
+
+    def setUp(self):
+        self.writer, self.reader = socket.socketpair()
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    def test_reads_every_buffered_frame_in_order(self):
+        messages = ['a' * i for i in range(20)]
+        for message in messages:
+            SimpleProtocol.serialize_to_socket(self.writer, OperationCode.BATCH, message)
+
+        frame_reader = FrameReader(64)
+        for message in messages:
+            op, body = frame_reader.read_frame(self.reader)
+            self.assertEqual(OperationCode.BATCH, op)
+            self.assertEqual(message.encode(), bytes(body))
+
+    def test_frame_larger_than_buffer_is_read_whole(self):
+        message = 'x' * 1000
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.WINNERS, message)
+
+        op, body = FrameReader(16).read_frame(self.reader)
+        self.assertEqual(OperationCode.WINNERS, op)
+        self.assertEqual(message.encode(), bytes(body))
+
+    def test_deserialize_keeps_frames_buffered_between_calls(self):
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.BATCH, 'first')
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.READY, '1')
+
+        self.assertEqual((OperationCode.BATCH, 'first'), SimpleProtocol.deserialize_from_socket(self.reader))
+        self.assertEqual((OperationCode.READY, '1'), SimpleProtocol.deserialize_from_socket(self.reader))
+
+    def test_send_frames_flushes_every_frame(self):
+        SimpleProtocol.send_frames(self.writer, [(OperationCode.CONFIRMACION, str(i), None) for i in range(5)])
+
+        for i in range(5):
+            self.assertEqual((OperationCode.CONFIRMACION, str(i)), SimpleProtocol.deserialize_from_socket(self.reader))
+
+    def test_session_frames_carry_the_request_id(self):
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.WINNERS, '1', request_id=7)
+        self.writer.close()
+
+        self.assertEqual((OperationCode.WINNERS, 7, '1'), SimpleProtocol.deserialize_session_from_socket(self.reader))
+        with self.assertRaises(ConnectionClosed):
+            SimpleProtocol.deserialize_session_from_socket(self.reader)
+
+    def test_compressed_frames_are_flagged_and_inflated(self):
+        large = '1,Santiago,Lorenzo,30904465,1999-03-17,7574;' * 100
+        small = large[:COMPRESSION_THRESHOLD - 1]
+        header, body = SimpleProtocol.encode_frame_parts(OperationCode.BATCH, large, request_id=3, compress=True)
+        self.assertTrue(header[0] & SimpleProtocol.COMPRESSED_FLAG)
+        self.assertLess(len(body), len(large))
+        header, _ = SimpleProtocol.encode_frame_parts(OperationCode.BATCH, small, compress=True)
+        self.assertFalse(header[0] & SimpleProtocol.COMPRESSED_FLAG)
+        header, _ = SimpleProtocol.encode_frame_parts(OperationCode.ERROR, large, compress=True)
+        self.assertFalse(header[0] & SimpleProtocol.COMPRESSED_FLAG)
+
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.BATCH, large, request_id=3, compress=True)
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.BATCH, small, request_id=4, compress=True)
+        self.assertEqual((OperationCode.BATCH, 3, large), SimpleProtocol.deserialize_session_from_socket(self.reader, True))
+        self.assertEqual((OperationCode.BATCH, 4, small), SimpleProtocol.deserialize_session_from_socket(self.reader, True))
+
+    def test_compressed_frames_are_rejected_unless_compression_was_negotiated(self):
+        large = '1,Santiago,Lorenzo,30904465,1999-03-17,7574;' * 100
+        SimpleProtocol.serialize_to_socket(self.writer, OperationCode.BATCH, large, compress=True)
+
+        with self.assertRaises(SerializationError):
+            SimpleProtocol.deserialize_from_socket(self.reader)
+
+    def test_inflated_size_is_capped(self):
+        bomb = zlib.compress(b'0' * (SimpleProtocol.MAX_INFLATED_SIZE + 1))
+
+        with self.assertRaises(SerializationError):
+            SimpleProtocol.inflate(bomb)
+
 if __name__ == '__main__':
     unittest.main()
 